@@ -1,15 +1,22 @@
+import functools
+import gzip
+import json
 import os
 from pathlib import Path
 import toml
 
-from flask import Flask, request
+from flask import Flask, Response, request
 from flask_cors import CORS
 
-from running_routes.assembler import RestAPIAssembler
-from running_routes.local_search import BacktrackEliminationLocalSearch
-from running_routes.model import SavingsModel
-from running_routes.network import OSMNetwork
-from running_routes.pipeline import pipeline
+from running_routes import registry
+from running_routes.catalogue import RouteCatalogue
+from running_routes.graph_cache import GraphCache
+from running_routes.metrics import PipelineMetrics, Registry
+from running_routes.path_store import ShortestPathStore
+from running_routes.pipeline import LocalSearchPool, pipeline
+from running_routes.prewarm import Prewarmer, load_regions
+from running_routes.profiling import RequestProfiler
+from running_routes.single_flight import SingleFlight
 
 BACKEND_ROOT = Path(__file__).parent
 PYPROJECT_FILE = BACKEND_ROOT / "pyproject.toml"
@@ -18,11 +25,141 @@ with PYPROJECT_FILE.open() as f:
 
 app = Flask(__name__)
 CORS(app)
+metrics_registry = Registry()
 
-network = OSMNetwork()
-model = SavingsModel()
-local_searches = [BacktrackEliminationLocalSearch()]
-assembler = RestAPIAssembler()
+graph_cache = None
+if os.environ.get("GRAPH_CACHE_DIR"):
+    graph_cache = GraphCache(
+        os.environ["GRAPH_CACHE_DIR"],
+        max_bytes=int(os.environ.get("GRAPH_CACHE_MAX_BYTES", 2*1024**3)),
+        ttl=float(os.environ.get("GRAPH_CACHE_TTL", 7*24*60*60)),
+    )
+path_store = ShortestPathStore(os.environ["PATH_STORE"]) if os.environ.get("PATH_STORE") else None
+local_search_workers = int(os.environ.get("LOCAL_SEARCH_WORKERS", 1))
+
+# Profiling is opt-in per request, and only available when PROFILE_DIR is set
+profiler = None
+if os.environ.get("PROFILE_DIR"):
+    profiler = RequestProfiler(
+        os.environ["PROFILE_DIR"],
+        limit=int(os.environ.get("PROFILE_LIMIT", 1)),
+        period=float(os.environ.get("PROFILE_PERIOD", 60)),
+    )
+
+# Concurrent requests with the same normalized parameters share one pipeline run
+single_flight = None
+if os.environ.get("COALESCE_REQUESTS", "1").lower() in ["1", "true"]:
+    single_flight = SingleFlight(on_complete=lambda key, callers: metrics_registry.observe_flight(callers))
+
+# Requests within CATALOGUE_MAX_OFFSET meters of a catalogue grid point are answered from the catalogue.
+# It is mapped at import, so gunicorn workers forked after `preload` share its pages
+catalogue = RouteCatalogue(os.environ["CATALOGUE_DIR"]) if os.environ.get("CATALOGUE_DIR") else None
+CATALOGUE_MAX_OFFSET = float(os.environ.get("CATALOGUE_MAX_OFFSET", 100))
+
+# Seconds each request should take, unless it asks for its own `deadline`
+DEFAULT_DEADLINE = float(os.environ["DEFAULT_DEADLINE"]) if os.environ.get("DEFAULT_DEADLINE") else None
+
+# Start coordinates are rounded to about a meter to key coalesced requests and hot regions,
+# requests are otherwise run at their exact start
+COORDINATE_PRECISION = 5
+
+# Model and parameters chosen by `python -m benchmarks tune --config`, the model overrides MODEL
+MODEL_CONFIG = {}
+if os.environ.get("MODEL_CONFIG"):
+    with open(os.environ["MODEL_CONFIG"]) as f:
+        MODEL_CONFIG = json.load(f)
+
+# Implementations are looked up by name in the registry
+NETWORK = os.environ.get("NETWORK", "osm")
+MODEL = MODEL_CONFIG.get("model") or os.environ.get("MODEL", "savings")
+LOCAL_SEARCHES = os.environ.get("LOCAL_SEARCHES", "backtrack_elimination").split(",")
+CONTRACTION_HIERARCHY = os.environ.get("CONTRACTION_HIERARCHY", "").lower() in ("1", "true")
+
+
+def network_parameters():
+    if NETWORK == "mapped":
+        # Opened in the gunicorn master by `preload`, workers share the mapping
+        return {
+            "directory": os.environ["MAPPED_GRAPH_DIR"],
+            "path_store": path_store,
+            "contraction_hierarchy": CONTRACTION_HIERARCHY,
+        }
+    return {
+        "graph_cache": graph_cache,
+        "path_store": path_store,
+        "contraction_hierarchy": CONTRACTION_HIERARCHY,
+        "compact": os.environ.get("COMPACT_GRAPHS", "").lower() in ["1", "true"],
+        "isochrone": os.environ.get("ISOCHRONE", "").lower() in ["1", "true"],
+        "tile_size": int(os.environ["TILE_SIZE"]) if os.environ.get("TILE_SIZE") else None,
+        "coarsen": os.environ.get("COARSEN", "").lower() in ["1", "true"],
+    }
+
+
+@functools.lru_cache(maxsize=None)
+def components():
+    """Built on the first request, or by `preload` before gunicorn forks its workers"""
+    if os.environ.get("OVERPASS_URL"):
+        # e.g. a private Overpass instance, or the stand-in of `python -m benchmarks load`
+        import osmnx
+        setting = "overpass_url" if hasattr(osmnx.settings, "overpass_url") else "overpass_endpoint"
+        setattr(osmnx.settings, setting, os.environ["OVERPASS_URL"])
+    return {
+        "network": registry.create("network", NETWORK, **network_parameters()),
+        "model": registry.create("model", MODEL, **MODEL_CONFIG.get("parameters", {})),
+        "local_searches": [registry.create("local_search", name) for name in LOCAL_SEARCHES if name],
+        "assembler": registry.create("assembler", "rest_api"),
+    }
+
+
+@functools.lru_cache(maxsize=None)
+def local_search_pool():
+    """LOCAL_SEARCH_WORKERS processes of this worker, started by gunicorn's `post_fork` before it runs threads"""
+    if local_search_workers <= 1:
+        return None
+    return LocalSearchPool(local_search_workers, components()["local_searches"])
+
+
+@functools.lru_cache(maxsize=None)
+def prewarmer():
+    """Warms the hot regions listed in the HOT_REGIONS json file, if any"""
+    regions = load_regions(os.environ["HOT_REGIONS"], COORDINATE_PRECISION) if os.environ.get("HOT_REGIONS") else []
+    return Prewarmer(
+        regions, lambda: registry.create("network", NETWORK, **network_parameters()), components()["model"])
+
+
+def preload():
+    """Imports the heavy dependencies, builds the components and warms the hot regions, see gunicorn.conf.py
+
+    Workers forked afterwards start warm
+    """
+    registry.preload()
+    components()
+    prewarmer().warm()
+
+# Responses smaller than this are not worth compressing
+MINIMUM_COMPRESSION_SIZE = 500
+
+
+@app.after_request
+def compress(response):
+    accept_encoding = request.headers.get("Accept-Encoding", "")
+    if (
+        "gzip" not in accept_encoding.lower()
+        or response.direct_passthrough
+        or "Content-Encoding" in response.headers
+        or not 200 <= response.status_code < 300
+    ):
+        return response
+
+    data = response.get_data()
+    if len(data) < MINIMUM_COMPRESSION_SIZE:
+        return response
+
+    response.set_data(gzip.compress(data, compresslevel=6))
+    response.headers["Content-Encoding"] = "gzip"
+    response.headers["Content-Length"] = len(response.get_data())
+    response.vary.add("Accept-Encoding")
+    return response
 
 @app.route("/about")
 def about():
@@ -35,16 +172,119 @@ def about():
         }
     }
 
+@app.route("/metrics")
+def metrics():
+    in_flight_waiters = single_flight.waiters() if single_flight else None
+    return Response(metrics_registry.render(in_flight_waiters), mimetype="text/plain; version=0.0.4")
+
+@app.route("/health")
+def health():
+    """Ready once the hot regions are warm, so load balancers only route to warm workers"""
+    warmer = prewarmer()
+    if not warmer.ready.is_set():
+        # Without `preload` the regions are warmed in the background of the first health check
+        warmer.start()
+    status = warmer.status()
+    return status, 200 if status["ready"] else 503
+
 @app.route("/pipeline/")
 def rest_pipeline():
     arguments = request.args.to_dict()
     n = int(arguments["n"])
     start_coordinate = {"lat": float(arguments["lat"]), "lng": float(arguments["lng"])}
+    rounded_coordinate = {
+        "lat": round(start_coordinate["lat"], COORDINATE_PRECISION),
+        "lng": round(start_coordinate["lng"], COORDINATE_PRECISION),
+    }
     distance = int(arguments["distance"])
-    return pipeline(
-        n=n, start_coordinate=start_coordinate, distance=distance, 
-        network=network, model=model, local_searches=local_searches, assembler=assembler
-        )
+    deadline = float(arguments["deadline"]) if arguments.get("deadline") else DEFAULT_DEADLINE
+    request_components = components()
+    request_assembler = request_components["assembler"]
+    output_parameters = {}
+    if arguments.get("format") == "polyline":
+        output_parameters = {
+            "output": "polyline",
+            "precision": int(arguments.get("precision", 5)),
+            "tolerance": float(arguments.get("tolerance", 0)),
+        }
+        request_assembler = registry.create("assembler", "rest_api", **output_parameters)
+    request_metrics = PipelineMetrics()
+
+    if catalogue is not None and not _profile_requested(arguments):
+        with request_metrics.stage("catalogue"):
+            match = catalogue.lookup(start_coordinate, distance, n, CATALOGUE_MAX_OFFSET)
+            if match:
+                routes = request_assembler.format_routes(match["routes"])
+        if match:
+            metrics_registry.observe(request_metrics, status="catalogue")
+            if deadline is not None:
+                routes = dict(routes, degradations=[])
+            if arguments.get("metadata", "").lower() in ["1", "true"]:
+                catalogue_metadata = {"point": match["point"], "offset": match["offset"]}
+                routes = dict(routes, metadata=dict(request_metrics.as_dict(), catalogue=catalogue_metadata))
+            return routes
+
+    request_network = prewarmer().network_for(rounded_coordinate, distance)
+    if request_network is not None:
+        # The warm network is only reused when created for the region's start
+        start_coordinate = rounded_coordinate
+    else:
+        request_network = request_components["network"]
+
+    def run_pipeline():
+        try:
+            routes = pipeline(
+                n=n, start_coordinate=start_coordinate, distance=distance,
+                network=request_network, model=request_components["model"],
+                local_searches=request_components["local_searches"], assembler=request_assembler,
+                pool=local_search_pool(), metrics=request_metrics, deadline=deadline,
+                )
+        except Exception:
+            metrics_registry.observe(request_metrics, status="error")
+            raise
+        metrics_registry.observe(request_metrics)
+        return routes, request_metrics
+
+    profile_id = None
+    coalesced = False
+    if _profile_requested(arguments) and profiler and profiler.allow():
+        # A profile has to measure its own run
+        with profiler.profile(request.headers.get("X-Request-ID"), {"arguments": arguments}) as profile:
+            profile_id = profile["request_id"]
+            try:
+                routes, pipeline_metrics = run_pipeline()
+            finally:
+                profile["metrics"] = request_metrics.as_dict()
+    elif single_flight:
+        key = _flight_key(n, rounded_coordinate, distance, dict(output_parameters, deadline=deadline))
+        (routes, pipeline_metrics), coalesced = single_flight.do(key, run_pipeline)
+    else:
+        routes, pipeline_metrics = run_pipeline()
+
+    # Coalesced requests share `routes`, so it is copied rather than modified
+    if deadline is not None:
+        routes = dict(routes, degradations=pipeline_metrics.degradations)
+    if arguments.get("metadata", "").lower() in ["1", "true"]:
+        routes = dict(routes, metadata=dict(pipeline_metrics.as_dict(), coalesced=coalesced))
+    response = app.make_response(routes)
+    if profile_id:
+        response.headers["X-Profile-ID"] = profile_id
+    return response
+
+def _flight_key(n, start_coordinate, distance, output_parameters):
+    """Requests with the same key produce the same routes"""
+    parameters = dict(
+        n=n, lat=start_coordinate["lat"], lng=start_coordinate["lng"], distance=distance, **output_parameters)
+    return ",".join(f"{name}={value}" for name, value in parameters.items())
+
+def _profile_requested(arguments):
+    return (
+        request.headers.get("X-Profile", "").lower() in ["1", "true"]
+        or arguments.get("profile", "").lower() in ["1", "true"]
+    )
 
 if __name__ == "__main__":
+    # Forked before any thread starts
+    local_search_pool()
+    prewarmer().start()
     app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 8080)))
\ No newline at end of file
@@ -0,0 +1 @@
+"""Offline benchmarks for each stage of the running-routes pipeline"""
@@ -0,0 +1,141 @@
+import json
+from pathlib import Path
+import sys
+import time
+
+import click
+
+from benchmarks.fixtures import FIXTURES, is_available, record_fixture
+from benchmarks.load_test import (
+    MemorySampler, format_summary, load_mix, replay, serve_app, summarize, synthetic_mix)
+from benchmarks.suite import BASELINE_FILE, benchmark, compare, format_report, load_baseline, save_baseline
+from benchmarks.tuning import DEFAULT_GRIDS, choose, format_front, parameter_grid, pareto_front, save_model_config, sweep
+
+
+@click.group()
+def cli():
+    """Offline benchmarks for each pipeline stage"""
+
+
+@cli.command()
+@click.option("--fixture", "fixture_names", multiple=True, type=click.Choice(list(FIXTURES)),
+              help="Fixtures to benchmark. Defaults to every available fixture")
+@click.option("--repeat", type=click.IntRange(1), default=3, show_default=True)
+@click.option("--baseline", type=click.Path(dir_okay=False, path_type=Path), default=BASELINE_FILE, show_default=True)
+@click.option("--save-baseline", "save", is_flag=True, help="Store these results as the new baseline")
+@click.option("--tolerance", type=float, default=0.2, show_default=True,
+              help="Relative slow down that counts as a regression")
+def run(fixture_names, repeat, baseline, save, tolerance):
+    """Benchmark each stage and compare against the baseline"""
+    fixture_names = fixture_names or [name for name in FIXTURES if is_available(name)]
+    results = {}
+    for name in fixture_names:
+        if not is_available(name):
+            click.echo(f"Skipping {name}, record it with `python -m benchmarks record {name}`", err=True)
+            continue
+        results[name] = benchmark(name, repeat)
+
+    rows = compare(results, load_baseline(baseline), tolerance)
+    click.echo(format_report(rows))
+
+    if save:
+        save_baseline(results, baseline)
+    elif any(row["regression"] for row in rows):
+        sys.exit(1)
+
+
+@cli.command()
+@click.argument("fixture_names", nargs=-1, type=click.Choice([name for name in FIXTURES if "grid" not in FIXTURES[name]]))
+def record(fixture_names):
+    """Download city fixtures from OSM, the only command that needs network access"""
+    for name in fixture_names:
+        click.echo(record_fixture(name))
+
+
+@cli.command()
+@click.option("--url", default=None, help="Load an app that is already running instead of starting one")
+@click.option("--mix", "mix_path", type=click.Path(dir_okay=False, exists=True, path_type=Path), default=None,
+              help="Recorded requests, one per line as json query parameters or `/pipeline/?...` paths")
+@click.option("--synthetic", type=click.IntRange(1), default=200, show_default=True,
+              help="Size of the synthetic mix used without --mix")
+@click.option("--grid", type=click.IntRange(10), default=60, show_default=True,
+              help="Rows and columns of the grid served by the stand-in Overpass API")
+@click.option("--workers", type=click.IntRange(1), default=2, show_default=True, help="gunicorn workers")
+@click.option("--threads", type=click.IntRange(1), default=4, show_default=True, help="gunicorn threads per worker")
+@click.option("--concurrency", type=click.IntRange(1), default=8, show_default=True)
+@click.option("--duration", type=click.FloatRange(0, min_open=True), default=None,
+              help="Seconds to run for, defaults to one pass over the mix")
+@click.option("--requests", "total_requests", type=click.IntRange(1), default=None)
+@click.option("--warmup", type=click.IntRange(0), default=10, show_default=True,
+              help="Requests sent before measuring, memory growth is counted from after them")
+@click.option("--memory-interval", type=click.FloatRange(0, min_open=True), default=5, show_default=True)
+@click.option("--output", type=click.Path(dir_okay=False, path_type=Path), default=None,
+              help="Also write the summary as json")
+def load(url, mix_path, synthetic, grid, workers, threads, concurrency, duration, total_requests, warmup,
+         memory_interval, output):
+    """Replay a request mix against the app at a fixed concurrency"""
+    mix = load_mix(mix_path) if mix_path else synthetic_mix(synthetic, grid)
+
+    def measure(url, pid=None):
+        replay(url, mix[:warmup], concurrency)
+        sampler = MemorySampler(pid, memory_interval) if pid else None
+        start = time.perf_counter()
+        if sampler:
+            with sampler:
+                results = replay(url, mix, concurrency, duration, total_requests)
+        else:
+            results = replay(url, mix, concurrency, duration, total_requests)
+        return summarize(results, time.perf_counter() - start, sampler.samples if sampler else None)
+
+    if url:
+        summary = measure(url)
+    else:
+        with serve_app(grid, workers, threads) as (app_url, process):
+            summary = measure(app_url, process.pid)
+
+    click.echo(format_summary(summary))
+    if output:
+        with output.open("w") as f:
+            json.dump(summary, f, indent=2)
+
+
+@cli.command()
+@click.option("--model", "model_name", type=click.Choice(list(DEFAULT_GRIDS)), default="savings", show_default=True)
+@click.option("--fixture", "fixture_names", multiple=True, type=click.Choice(list(FIXTURES)),
+              help="Fixtures to tune on. Defaults to every available fixture")
+@click.option("--starts", type=click.IntRange(1), default=3, show_default=True, help="Start points per fixture")
+@click.option("--param", "parameters", multiple=True, metavar="NAME=VALUE,...",
+              help="Values to sweep for one parameter, replacing its default values, e.g. max_node=4,8")
+@click.option("--workers", type=click.IntRange(1), default=1, show_default=True,
+              help="Processes running configurations in parallel, at most the physical cores for fair timings")
+@click.option("--max-seconds", type=click.FloatRange(0, min_open=True), default=None,
+              help="Choose the most accurate configuration of the front within this mean time")
+@click.option("--config", "config_path", type=click.Path(dir_okay=False, path_type=Path), default=None,
+              help="Write the chosen configuration for the Flask app's MODEL_CONFIG")
+@click.option("--output", type=click.Path(dir_okay=False, path_type=Path), default=None,
+              help="Also write every configuration's results and the front as json")
+def tune(model_name, fixture_names, starts, parameters, workers, max_seconds, config_path, output):
+    """Sweep model parameters and report the Pareto front of route quality against time"""
+    fixture_names = fixture_names or [name for name in FIXTURES if is_available(name)]
+    grid = dict(DEFAULT_GRIDS[model_name])
+    for parameter in parameters:
+        name, _, values = parameter.partition("=")
+        grid[name] = [json.loads(value) for value in values.split(",")]
+
+    results = sweep(model_name, parameter_grid(grid), fixture_names, starts, workers=workers)
+    front = pareto_front(results)
+    chosen = choose(front, max_seconds)
+    click.echo(format_front(front, chosen))
+
+    if output:
+        with output.open("w") as f:
+            json.dump({"results": results, "front": front, "chosen": chosen}, f, indent=2)
+    if config_path:
+        if chosen is None:
+            click.echo(f"No configuration runs within {max_seconds}s", err=True)
+            sys.exit(1)
+        save_model_config(chosen, config_path)
+
+
+if __name__ == "__main__":
+    cli()
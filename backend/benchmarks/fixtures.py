@@ -0,0 +1,99 @@
+"""Stored and synthetic graphs the benchmarks run on, without network access"""
+from pathlib import Path
+
+import networkx as nx
+import numpy as np
+import osmnx
+
+from running_routes.network import OSMNetwork
+
+from typing import Dict
+
+FIXTURE_DIRECTORY = Path(__file__).parent / "fixtures"
+
+MELBOURNE_CENTRAL = {"lat": -37.8102361, "lng": 144.9627652}
+
+# Recorded city graphs are stored as `FIXTURE_DIRECTORY/<name>.graphml`, see `record_fixture`
+# Synthetic grids are generated on load and are always available
+FIXTURES = {
+    "grid-small": {"grid": (10, 10), "distance": 800, "n": 3},
+    "grid-medium": {"grid": (30, 30), "distance": 2500, "n": 5},
+    "grid-large": {"grid": (60, 60), "distance": 5000, "n": 5},
+    "melbourne-small": {"start_coordinate": MELBOURNE_CENTRAL, "distance": 500, "n": 1},
+    "melbourne-medium": {"start_coordinate": MELBOURNE_CENTRAL, "distance": 3000, "n": 5},
+    "melbourne-10km": {"start_coordinate": MELBOURNE_CENTRAL, "distance": 10000, "n": 5},
+}
+
+
+class FixtureNetwork(OSMNetwork):
+    """OSMNetwork that reads a stored graph instead of downloading one"""
+
+    def __init__(self, fixture_graph: nx.MultiDiGraph, **parameters) -> None:
+        super().__init__(**parameters)
+        self.fixture_graph = fixture_graph
+
+    def _download(self, start_coordinate: Dict, radius: float, network_type: str) -> nx.MultiDiGraph:
+        return self.fixture_graph.copy()
+
+
+def grid_graph(
+        rows: int = 5, columns: int = 5, spacing: float = 0.001,
+        origin: Dict = MELBOURNE_CENTRAL) -> nx.MultiDiGraph:
+    """Synthetic walking network shaped like an osmnx graph
+
+    Nodes are numbered row by row from `origin`, the south west corner, and are `spacing` degrees apart
+    """
+    G = nx.MultiDiGraph(crs="epsg:4326")
+    for row in range(rows):
+        for column in range(columns):
+            G.add_node(row*columns + column, y=origin["lat"] + row*spacing, x=origin["lng"] + column*spacing)
+
+    for row in range(rows):
+        for column in range(columns):
+            source = row*columns + column
+            targets = []
+            if column + 1 < columns:
+                targets.append(source + 1)
+            if row + 1 < rows:
+                targets.append(source + columns)
+            for target in targets:
+                length = osmnx.distance.great_circle_vec(
+                    G.nodes[source]["y"], G.nodes[source]["x"], G.nodes[target]["y"], G.nodes[target]["x"])
+                G.add_edge(source, target, length=length)
+                G.add_edge(target, source, length=length)
+    return G
+
+
+def fixture_path(name: str) -> Path:
+    return FIXTURE_DIRECTORY / f"{name}.graphml"
+
+
+def is_available(name: str) -> bool:
+    return "grid" in FIXTURES[name] or fixture_path(name).exists()
+
+
+def load_fixture(name: str) -> Dict:
+    """Returns the fixture's graph, start coordinate, distance and n"""
+    fixture = dict(FIXTURES[name])
+    if "grid" in fixture:
+        rows, columns = fixture["grid"]
+        G = grid_graph(rows, columns)
+        latitudes, longitudes = zip(*[(data["y"], data["x"]) for _, data in G.nodes(data=True)])
+        fixture["start_coordinate"] = {"lat": float(np.mean(latitudes)), "lng": float(np.mean(longitudes))}
+    else:
+        G = osmnx.load_graphml(fixture_path(name))
+    fixture["graph"] = G
+    return fixture
+
+
+def record_fixture(name: str, network_type: str = "walk") -> Path:
+    """Downloads a city fixture from OSM so later benchmark runs are offline"""
+    fixture = FIXTURES[name]
+    G = osmnx.graph_from_point(
+        (fixture["start_coordinate"]["lat"], fixture["start_coordinate"]["lng"]),
+        dist=fixture["distance"]/2,
+        network_type=network_type,
+    )
+    FIXTURE_DIRECTORY.mkdir(parents=True, exist_ok=True)
+    osmnx.save_graphml(G, fixture_path(name))
+    return fixture_path(name)
@@ -0,0 +1,262 @@
+"""Replays a request mix against the Flask app at a fixed concurrency
+
+The app runs in its own process, under gunicorn when installed, and downloads its graphs
+from a stand-in Overpass API serving a synthetic grid, so a run needs no network access.
+A run reports latency percentiles, throughput, error rate and the memory of each worker
+process sampled throughout, so long soak runs expose memory that keeps growing.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import importlib.util
+import itertools
+import json
+import os
+from pathlib import Path
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+from urllib.parse import parse_qsl, urlsplit
+
+import numpy as np
+import requests
+
+from benchmarks import overpass
+from benchmarks.fixtures import MELBOURNE_CENTRAL, grid_graph
+
+from typing import Dict, Iterator, List, Optional, Tuple
+
+BACKEND_ROOT = Path(__file__).parent.parent
+
+# Degrees between the stand-in grid's nodes, about 110m north to south
+GRID_SPACING = 0.001
+
+PERCENTILES = (50, 90, 99)
+
+
+def grid_center(rows: int) -> Dict:
+    return {
+        "lat": MELBOURNE_CENTRAL["lat"] + rows*GRID_SPACING/2,
+        "lng": MELBOURNE_CENTRAL["lng"] + rows*GRID_SPACING/2,
+    }
+
+
+def synthetic_mix(
+        count: int, rows: int, distances: Tuple[int, ...] = (1000, 2000, 3000), ns: Tuple[int, ...] = (1, 2, 3),
+        seed: int = 0) -> List[Dict]:
+    """Requests starting around the centre of the stand-in grid, far enough in for their whole run to fit"""
+    generator = random.Random(seed)
+    center = grid_center(rows)
+    # Meters from the centre to the grid's nearest edge, which is east-west
+    half_width = rows*GRID_SPACING/2*111_000*np.cos(np.radians(center["lat"]))
+    mix = []
+    for _ in range(count):
+        distance = generator.choice(distances)
+        offset = max(0, half_width - distance/2)/111_000
+        mix.append({
+            "n": generator.choice(ns),
+            "lat": round(center["lat"] + generator.uniform(-offset, offset), 6),
+            "lng": round(center["lng"] + generator.uniform(-offset, offset), 6),
+            "distance": distance,
+        })
+    return mix
+
+
+def load_mix(path: Path) -> List[Dict]:
+    """Reads recorded requests, one per line, as json query parameters or as `/pipeline/?...` paths"""
+    mix = []
+    with Path(path).open() as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith("{"):
+                mix.append(json.loads(line))
+            else:
+                mix.append(dict(parse_qsl(urlsplit(line).query)))
+    return mix
+
+
+@contextmanager
+def serve_app(
+        rows: int, workers: int = 1, threads: int = 4, environment: Optional[Dict] = None,
+        startup_timeout: float = 300) -> Iterator[Tuple[str, subprocess.Popen]]:
+    """Starts the app against a stand-in Overpass API serving a `rows` x `rows` grid
+
+    Yields the app's url and process. Without gunicorn the app runs Flask's threaded server, in one process.
+    """
+    with overpass.serve(grid_graph(rows, rows, spacing=GRID_SPACING), configure_osmnx=False) as stand_in:
+        port = _free_port()
+        environment = dict(os.environ, **(environment or {}), OVERPASS_URL=stand_in.url, PORT=str(port))
+        if importlib.util.find_spec("gunicorn"):
+            command = [
+                sys.executable, "-m", "gunicorn", "--config", "gunicorn.conf.py", "--bind", f"127.0.0.1:{port}",
+                "--workers", str(workers), "--threads", str(threads), "--timeout", "0", "app:app"]
+        else:
+            command = [sys.executable, "app.py"]
+        process = subprocess.Popen(command, cwd=BACKEND_ROOT, env=environment)
+        url = f"http://127.0.0.1:{port}"
+        try:
+            _wait_until_healthy(url, process, startup_timeout)
+            yield url, process
+        finally:
+            process.terminate()
+            try:
+                process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+def worker_pids(pid: int) -> List[int]:
+    """Processes serving requests, gunicorn's workers or the app's own process"""
+    children = []
+    for task in Path(f"/proc/{pid}/task").glob("*"):
+        try:
+            children += [int(child) for child in (task / "children").read_text().split()]
+        except OSError:
+            continue
+    return sorted(children) or [pid]
+
+
+def rss_bytes(pid: int) -> Optional[int]:
+    """Resident memory of the process, None where /proc is unavailable or the process exited"""
+    try:
+        resident_pages = int(Path(f"/proc/{pid}/statm").read_text().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    return resident_pages*os.sysconf("SC_PAGE_SIZE")
+
+
+class MemorySampler:
+    """Samples the resident memory of each worker every `interval` seconds in the background"""
+
+    def __init__(self, pid: int, interval: float = 5):
+        self.pid = pid
+        self.interval = interval
+        self.samples: Dict[int, List[Tuple[float, int]]] = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="memory-sampler", daemon=True)
+
+    def __enter__(self) -> "MemorySampler":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self._stop.set()
+        self._thread.join()
+        self.sample()
+
+    def sample(self) -> None:
+        now = time.perf_counter()
+        for pid in worker_pids(self.pid):
+            rss = rss_bytes(pid)
+            if rss is not None:
+                self.samples.setdefault(pid, []).append((now, rss))
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self.sample()
+            self._stop.wait(self.interval)
+
+
+def replay(
+        url: str, mix: List[Dict], concurrency: int, duration: Optional[float] = None,
+        total_requests: Optional[int] = None, timeout: float = 120) -> List[Dict]:
+    """Sends the mix in order, cycling, from `concurrency` clients until `duration` seconds or `total_requests`
+
+    Returns the status and latency of each request, status 0 when no response arrived
+    """
+    if duration is None and total_requests is None:
+        total_requests = len(mix)
+    requests_iterator = itertools.cycle(mix)
+    count = itertools.count()
+    lock = threading.Lock()
+    end = time.perf_counter() + duration if duration is not None else None
+    results: List[Dict] = []
+
+    def client() -> None:
+        session = requests.Session()
+        while end is None or time.perf_counter() < end:
+            with lock:
+                if total_requests is not None and next(count) >= total_requests:
+                    return
+                parameters = next(requests_iterator)
+            start = time.perf_counter()
+            try:
+                status = session.get(f"{url}/pipeline/", params=parameters, timeout=timeout).status_code
+            except requests.RequestException:
+                status = 0
+            result = {"status": status, "seconds": time.perf_counter() - start}
+            with lock:
+                results.append(result)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for future in [executor.submit(client) for _ in range(concurrency)]:
+            future.result()
+    return results
+
+
+def summarize(results: List[Dict], seconds: float, memory: Optional[Dict[int, List[Tuple[float, int]]]] = None) -> Dict:
+    latencies = np.array([result["seconds"] for result in results])
+    errors = sum(1 for result in results if not 200 <= result["status"] < 300)
+    summary = {
+        "requests": len(results),
+        "seconds": seconds,
+        "throughput": len(results)/seconds if seconds else 0,
+        "error_rate": errors/len(results) if results else 0,
+        "latency_seconds": {
+            **{f"p{percentile}": float(np.percentile(latencies, percentile)) if len(latencies) else None
+               for percentile in PERCENTILES},
+            "max": float(latencies.max()) if len(latencies) else None,
+        },
+        "workers": {},
+    }
+    for pid, samples in (memory or {}).items():
+        rss = [sample[1] for sample in samples]
+        summary["workers"][pid] = {
+            "start_bytes": rss[0],
+            "end_bytes": rss[-1],
+            "peak_bytes": max(rss),
+            "growth_bytes": rss[-1] - rss[0],
+        }
+    return summary
+
+
+def format_summary(summary: Dict) -> str:
+    latency = summary["latency_seconds"]
+    lines = [
+        f"""requests   {summary["requests"]} in {summary["seconds"]:.1f}s, {summary["throughput"]:.2f}/s""",
+        f"""errors     {summary["error_rate"]:.2%}""",
+        "latency    " + "  ".join(
+            f"{name} {value*1000:.0f}ms" for name, value in latency.items() if value is not None),
+    ]
+    if summary["workers"]:
+        lines.append(f"""{"worker":<10}{"start MiB":>12}{"end MiB":>12}{"peak MiB":>12}{"growth MiB":>12}""")
+        for pid, worker in summary["workers"].items():
+            lines.append(
+                f"""{pid:<10}{worker["start_bytes"]/2**20:>12.1f}{worker["end_bytes"]/2**20:>12.1f}"""
+                f"""{worker["peak_bytes"]/2**20:>12.1f}{worker["growth_bytes"]/2**20:>12.1f}""")
+    return "\n".join(lines)
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _wait_until_healthy(url: str, process: subprocess.Popen, timeout: float) -> None:
+    """Waits for /health to answer 200, i.e. the app is up and its hot regions are warm"""
+    end = time.perf_counter() + timeout
+    while time.perf_counter() < end:
+        if process.poll() is not None:
+            raise RuntimeError(f"The app exited with {process.returncode}")
+        try:
+            if requests.get(f"{url}/health", timeout=5).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.5)
+    raise TimeoutError(f"The app did not become healthy within {timeout}s")
@@ -0,0 +1,133 @@
+"""Local stand-in for the Overpass API, so osmnx downloads work without network access
+
+Used by the tests, and by the load test to serve the app's downloads
+"""
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import re
+import threading
+from urllib.parse import parse_qs
+
+import networkx as nx
+import osmnx
+
+from typing import Dict, Iterator, List, Optional
+
+# osmnx posts `[bbox]` free queries, either `(poly:"lat lng ...")` or `(south,west,north,east)`
+_POLYGON = re.compile(r'\(poly:"([^"]+)"\)')
+_BBOX = re.compile(r"\((-?[\d.]+),(-?[\d.]+),(-?[\d.]+),(-?[\d.]+)\)")
+
+
+def overpass_response(G: nx.MultiDiGraph) -> Dict:
+    """Canned Overpass json with one street per edge of `G`, using its node ids as OSM ids"""
+    elements = [
+        {"type": "node", "id": node, "lat": data["y"], "lon": data["x"]}
+        for node, data in G.nodes(data=True)]
+    edges = {tuple(sorted((u, v))) for u, v in G.edges()}
+    elements += [
+        {"type": "way", "id": i + 1, "nodes": list(edge), "tags": {"highway": "residential"}}
+        for i, edge in enumerate(sorted(edges))]
+    return {"version": 0.6, "elements": elements}
+
+
+class OverpassStandIn:
+    """Serves the canned response, restricted to the bbox of each query
+
+    `failures` lists status codes returned, in order, before answering normally
+    """
+
+    def __init__(self, G: nx.MultiDiGraph, failures: Optional[List[int]] = None):
+        self.response = overpass_response(G)
+        self.failures = list(failures or [])
+        self.queries: List[str] = []
+        self._lock = threading.Lock()
+
+    def answer(self, query: str):
+        with self._lock:
+            self.queries.append(query)
+            if self.failures:
+                return self.failures.pop(0), {}
+        south, west, north, east = _query_bounds(query)
+        nodes = [
+            element for element in self.response["elements"]
+            if element["type"] == "node" and south <= element["lat"] <= north and west <= element["lon"] <= east]
+        node_ids = {node["id"] for node in nodes}
+        ways = [
+            element for element in self.response["elements"]
+            if element["type"] == "way" and node_ids.intersection(element["nodes"])]
+        # Ways are returned whole, like Overpass's recursion `>;` does
+        way_node_ids = {node for way in ways for node in way["nodes"]}
+        nodes = [
+            element for element in self.response["elements"]
+            if element["type"] == "node" and element["id"] in way_node_ids]
+        return 200, {"version": 0.6, "elements": nodes + ways}
+
+
+def _query_bounds(query: str):
+    polygon = _POLYGON.search(query)
+    if polygon:
+        values = [float(value) for value in polygon.group(1).split()]
+        latitudes, longitudes = values[0::2], values[1::2]
+        return min(latitudes), min(longitudes), max(latitudes), max(longitudes)
+    bbox = _BBOX.search(query)
+    if bbox:
+        return tuple(float(value) for value in bbox.groups())
+    return -90, -180, 90, 180
+
+
+def _handler(stand_in: OverpassStandIn):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            # osmnx checks the status endpoint for its rate limit
+            self._send(200, b"Connected as: 0\nRate limit: 0\n2 slots available now.\n", "text/plain")
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode()
+            query = parse_qs(body).get("data", [body])[0]
+            status, response = stand_in.answer(query)
+            self._send(status, json.dumps(response).encode(), "application/json")
+
+        def _send(self, status: int, body: bytes, content_type: str):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+    return Handler
+
+
+@contextmanager
+def serve(
+        G: nx.MultiDiGraph, failures: Optional[List[int]] = None,
+        configure_osmnx: bool = True) -> Iterator[OverpassStandIn]:
+    """Serves `G` from a stand-in Overpass API at `stand_in.url` for the duration of the block
+
+    With `configure_osmnx`, osmnx in this process is pointed at the stand-in
+    """
+    stand_in = OverpassStandIn(G, failures)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _handler(stand_in))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    stand_in.url = f"http://127.0.0.1:{server.server_address[1]}/api"
+    original_settings = {}
+    if configure_osmnx:
+        endpoint_setting = "overpass_url" if hasattr(osmnx.settings, "overpass_url") else "overpass_endpoint"
+        original_settings = {
+            endpoint_setting: getattr(osmnx.settings, endpoint_setting),
+            "overpass_rate_limit": osmnx.settings.overpass_rate_limit,
+            "use_cache": osmnx.settings.use_cache,
+        }
+        osmnx.settings.overpass_rate_limit = False
+        osmnx.settings.use_cache = False
+        setattr(osmnx.settings, endpoint_setting, stand_in.url)
+    try:
+        yield stand_in
+    finally:
+        for setting, value in original_settings.items():
+            setattr(osmnx.settings, setting, value)
+        server.shutdown()
+        server.server_close()
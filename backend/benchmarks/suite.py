@@ -0,0 +1,165 @@
+"""Times each pipeline stage on the benchmark fixtures and compares against a saved baseline"""
+from contextlib import contextmanager
+import json
+from pathlib import Path
+import statistics
+import time
+import tracemalloc
+
+from benchmarks.fixtures import FixtureNetwork, load_fixture
+from running_routes.assembler import RestAPIAssembler
+from running_routes.local_search import BacktrackEliminationLocalSearch
+from running_routes.model import CPModel, SavingsModel
+from running_routes.pipeline import _local_search
+
+from typing import Dict, List
+
+BASELINE_FILE = Path(__file__).parent / "baseline.json"
+
+# Keep the CP solve short, it otherwise runs for its whole time limit
+CP_TIME_LIMIT = 1
+
+# Differences smaller than these are noise, whatever the ratio
+MINIMUM_REGRESSION_SECONDS = 0.005
+MINIMUM_REGRESSION_BYTES = 2**20
+
+
+class StageRecorder:
+    """Records the wall time, and optionally the peak traced memory, of each stage"""
+
+    def __init__(self, measure_memory: bool = False) -> None:
+        self.measure_memory = measure_memory
+        self.seconds: Dict[str, float] = {}
+        self.peak_bytes: Dict[str, int] = {}
+
+    @contextmanager
+    def __call__(self, stage: str):
+        if self.measure_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[stage] = time.perf_counter() - start
+            if self.measure_memory:
+                self.peak_bytes[stage] = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+
+
+def run_stages(fixture: Dict, recorder: StageRecorder) -> None:
+    """Runs every stage once on a fresh network, so no stage benefits from an earlier run's caches"""
+    n, distance, start_coordinate = fixture["n"], fixture["distance"], fixture["start_coordinate"]
+
+    network = FixtureNetwork(fixture["graph"])
+    with recorder("network.create"):
+        network.create(start_coordinate, distance)
+
+    model = SavingsModel()
+    parameters = model.parameters
+    with recorder("SavingsModel._downsample"):
+        sample_coordinates = model._downsample(
+            network, parameters["sample_percent"], parameters["max_sample_size"], parameters["seed"])
+    with recorder("SavingsModel._find_sample_nodes"):
+        sample_nodes = model._find_sample_nodes(start_coordinate, sample_coordinates, network)
+    with recorder("SavingsModel._calculate_savings"):
+        savings = model._calculate_savings(sample_nodes, network)
+    depot = sample_nodes[0]
+    routes = [[depot, node, depot] for node in sample_nodes[1:]]
+    with recorder("SavingsModel._merge_routes"):
+        for saving in savings:
+            routes = model._merge_routes(saving, routes, network, parameters["max_node"], distance)
+    with recorder("SavingsModel._circularity_filter"):
+        tours = model._circularity_filter(n, routes, network)
+
+    cp_network = FixtureNetwork(fixture["graph"])
+    cp_network.create(start_coordinate, distance)
+    with recorder("CPModel.solve"):
+        CPModel(time_limit=CP_TIME_LIMIT).solve(n, distance, start_coordinate, cp_network)
+
+    with recorder("local_search"):
+        tours = _local_search(tours, distance, network, [BacktrackEliminationLocalSearch()])
+    with recorder("RestAPIAssembler.coordinates"):
+        RestAPIAssembler().generate_output(tours, distance, network)
+    with recorder("RestAPIAssembler.polyline"):
+        RestAPIAssembler(output="polyline").generate_output(tours, distance, network)
+
+
+def benchmark(fixture_name: str, repeat: int = 3) -> Dict[str, Dict]:
+    """Returns the median seconds and the peak memory of each stage
+
+    Memory is measured in a separate run because tracing allocations slows every stage down
+    """
+    fixture = load_fixture(fixture_name)
+    seconds: Dict[str, List[float]] = {}
+    for _ in range(repeat):
+        recorder = StageRecorder()
+        run_stages(fixture, recorder)
+        for stage, stage_seconds in recorder.seconds.items():
+            seconds.setdefault(stage, []).append(stage_seconds)
+
+    memory_recorder = StageRecorder(measure_memory=True)
+    run_stages(fixture, memory_recorder)
+
+    return {
+        stage: {
+            "seconds": statistics.median(stage_seconds),
+            "peak_bytes": memory_recorder.peak_bytes[stage],
+        }
+        for stage, stage_seconds in seconds.items()
+    }
+
+
+def load_baseline(path: Path = BASELINE_FILE) -> Dict:
+    if not path.exists():
+        return {}
+    with path.open() as f:
+        return json.load(f)
+
+
+def save_baseline(results: Dict, path: Path = BASELINE_FILE) -> None:
+    baseline = load_baseline(path)
+    baseline.update(results)
+    with path.open("w") as f:
+        json.dump(baseline, f, indent=2, sort_keys=True)
+
+
+def compare(results: Dict, baseline: Dict, tolerance: float = 0.2) -> List[Dict]:
+    """Returns one row per fixture and stage, flagging stages slower, or with a higher peak memory,
+    than the baseline by `tolerance`
+    """
+    rows = []
+    for fixture_name, stages in results.items():
+        for stage, measurement in stages.items():
+            row = {
+                "fixture": fixture_name, "stage": stage, **measurement,
+                "ratio": None, "memory_ratio": None, "regression": False,
+            }
+            baseline_measurement = baseline.get(fixture_name, {}).get(stage)
+            if baseline_measurement and baseline_measurement["seconds"]:
+                row["ratio"] = measurement["seconds"] / baseline_measurement["seconds"]
+                row["regression"] = (
+                    row["ratio"] > 1 + tolerance
+                    and measurement["seconds"] - baseline_measurement["seconds"] > MINIMUM_REGRESSION_SECONDS
+                )
+            if baseline_measurement and baseline_measurement.get("peak_bytes"):
+                row["memory_ratio"] = measurement["peak_bytes"] / baseline_measurement["peak_bytes"]
+                row["regression"] = row["regression"] or (
+                    row["memory_ratio"] > 1 + tolerance
+                    and measurement["peak_bytes"] - baseline_measurement["peak_bytes"] > MINIMUM_REGRESSION_BYTES
+                )
+            rows.append(row)
+    return rows
+
+
+def format_report(rows: List[Dict]) -> str:
+    lines = [
+        f"""{"fixture":<18}{"stage":<36}{"seconds":>10}{"peak MiB":>10}{"time vs base":>14}{"memory vs base":>16}"""]
+    for row in rows:
+        ratio = f"""{row["ratio"]:.2f}x""" if row["ratio"] is not None else "-"
+        memory_ratio = f"""{row["memory_ratio"]:.2f}x""" if row["memory_ratio"] is not None else "-"
+        if row["regression"]:
+            memory_ratio += " !"
+        lines.append(
+            f"""{row["fixture"]:<18}{row["stage"]:<36}{row["seconds"]:>10.4f}"""
+            f"""{row["peak_bytes"]/2**20:>10.2f}{ratio:>14}{memory_ratio:>16}""")
+    return "\n".join(lines)
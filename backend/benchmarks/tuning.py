@@ -0,0 +1,196 @@
+"""Sweeps model parameters over the benchmark fixtures and finds the Pareto front of quality against time
+
+Each configuration runs the whole pipeline, network aside, for several start points of each fixture.
+Quality is the relative error of each route's length against the requested distance and the
+circularity of its street path; time is the wall time of the model, local search and assembler.
+A configuration is on the front when no other one is at least as good on all three and better on one.
+"""
+from concurrent.futures import ProcessPoolExecutor
+import itertools
+import json
+from pathlib import Path
+import random
+import statistics
+import time
+
+import numpy as np
+
+from benchmarks.fixtures import FixtureNetwork, load_fixture
+from running_routes import model, registry
+from running_routes.assembler import decode_polyline
+from running_routes.geometry import great_circle_vec
+from running_routes.pipeline import pipeline
+
+from typing import Dict, List, Optional, Tuple
+
+# Parameters swept by default, the model's other parameters keep their defaults
+DEFAULT_GRIDS = {
+    "savings": {
+        "sample_percent": [0.1, 0.2, 0.4],
+        "max_sample_size": [50, 100, 200],
+        "max_node": [4, 8, 12],
+    },
+    "cp": {
+        "sample_percent": [0.1, 0.2, 0.4],
+        "max_sample_size": [25, 50, 100],
+        "time_limit": [1, 3, 10],
+    },
+}
+
+# Extra start points are graph nodes within this share of the distance from the fixture's start
+START_RADIUS_SHARE = 0.25
+
+# Polylines keep about 10cm, precise enough to measure circularity
+POLYLINE_PRECISION = 6
+
+# Objectives, and whether larger is better
+OBJECTIVES = {"length_error": False, "circularity": True, "seconds": False}
+
+# Fixtures a worker process has loaded, keyed by fixture name, and the cases it has warmed up
+_fixtures: Dict[str, Dict] = {}
+_warmed: set = set()
+
+
+def parameter_grid(grid: Dict[str, List]) -> List[Dict]:
+    """Every combination of the values in `grid`"""
+    names = sorted(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+
+
+def start_points(fixture: Dict, count: int, seed: int = 0) -> List[Dict]:
+    """The fixture's start coordinate, and `count - 1` graph nodes near it"""
+    start = fixture["start_coordinate"]
+    radius = fixture["distance"]*START_RADIUS_SHARE
+    nearby = [
+        {"lat": data["y"], "lng": data["x"]} for _, data in fixture["graph"].nodes(data=True)
+        if great_circle_vec(start["lat"], start["lng"], data["y"], data["x"]) <= radius
+    ]
+    generator = random.Random(seed)
+    return [start] + generator.sample(nearby, min(count - 1, len(nearby)))
+
+
+def evaluate(
+        model_name: str, parameters: Dict, fixture_name: str, start_coordinate: Dict,
+        local_searches: List[str]) -> Dict:
+    """Runs the pipeline once and measures the quality of its routes
+
+    Routes missing from the `n` requested count as a length error of 1 and a circularity of 0
+    """
+    if fixture_name not in _fixtures:
+        _fixtures[fixture_name] = load_fixture(fixture_name)
+    fixture = _fixtures[fixture_name]
+    n, distance = fixture["n"], fixture["distance"]
+
+    def run() -> Tuple[Dict, float]:
+        # Every run starts cold, whatever ran before it: a new network, created outside the timing, and
+        # no cached KMeans centres, so only the stages being tuned are timed and sweep order does not matter
+        network = FixtureNetwork(fixture["graph"])
+        network.create(start_coordinate, distance)
+        model._kmeans_cache.clear()
+        start = time.perf_counter()
+        routes = pipeline(
+            n, start_coordinate, distance, network=network,
+            model=registry.create("model", model_name, **parameters),
+            local_searches=[registry.create("local_search", name) for name in local_searches],
+            assembler=registry.create("assembler", "rest_api", output="polyline", precision=POLYLINE_PRECISION))
+        return routes, time.perf_counter() - start
+
+    # The first run of a case in a process also pays for lazy imports, so it is not timed
+    key = (model_name, fixture_name, start_coordinate["lat"], start_coordinate["lng"])
+    if key not in _warmed:
+        run()
+        _warmed.add(key)
+    routes, seconds = run()
+
+    length_errors = [abs(route["distance"] - distance)/distance for route in routes["routes"]]
+    circularities = [
+        model.circularity(np.array(decode_polyline(route["polyline"], POLYLINE_PRECISION)))
+        for route in routes["routes"]]
+    missing = max(n - len(routes["routes"]), 0)
+    return {
+        "fixture": fixture_name,
+        "start_coordinate": start_coordinate,
+        "routes": len(routes["routes"]),
+        "length_error": float(np.mean(length_errors + [1]*missing)),
+        "circularity": float(np.mean(circularities + [0]*missing)),
+        "seconds": seconds,
+    }
+
+
+def _evaluate(arguments: tuple) -> Dict:
+    return evaluate(*arguments)
+
+
+def sweep(
+        model_name: str, configurations: List[Dict], fixture_names: List[str], starts: int = 3,
+        local_searches: Optional[List[str]] = None, workers: int = 1, seed: int = 0) -> List[Dict]:
+    """Evaluates every configuration on every case, returning each configuration with its mean objectives
+
+    Runs share the machine with `workers - 1` others, so keep `workers` to the number of physical cores
+    for representative times.
+    """
+    local_searches = ["backtrack_elimination"] if local_searches is None else local_searches
+    cases = [
+        (name, start) for name in fixture_names for start in start_points(load_fixture(name), starts, seed)]
+    tasks = [
+        (model_name, parameters, name, start, local_searches)
+        for parameters in configurations for name, start in cases]
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            runs = list(executor.map(_evaluate, tasks))
+    else:
+        runs = [_evaluate(task) for task in tasks]
+
+    results = []
+    for i, parameters in enumerate(configurations):
+        configuration_runs = runs[i*len(cases):(i + 1)*len(cases)]
+        results.append({
+            "model": model_name,
+            "parameters": parameters,
+            **{objective: statistics.mean(run[objective] for run in configuration_runs) for objective in OBJECTIVES},
+            "p90_seconds": float(np.percentile([run["seconds"] for run in configuration_runs], 90)),
+            "runs": configuration_runs,
+        })
+    return results
+
+
+def dominates(a: Dict, b: Dict) -> bool:
+    """Whether `a` is at least as good as `b` on every objective and better on one"""
+    better = False
+    for objective, larger_is_better in OBJECTIVES.items():
+        difference = a[objective] - b[objective] if larger_is_better else b[objective] - a[objective]
+        if difference < 0:
+            return False
+        better = better or difference > 0
+    return better
+
+
+def pareto_front(results: List[Dict]) -> List[Dict]:
+    """Results no other result dominates, fastest first"""
+    front = [result for result in results if not any(dominates(other, result) for other in results)]
+    return sorted(front, key=lambda result: result["seconds"])
+
+
+def choose(front: List[Dict], max_seconds: Optional[float] = None) -> Optional[Dict]:
+    """The most accurate configuration of the front within `max_seconds`, ties broken by circularity"""
+    candidates = [result for result in front if max_seconds is None or result["seconds"] <= max_seconds]
+    if not candidates:
+        return None
+    return min(candidates, key=lambda result: (result["length_error"], -result["circularity"], result["seconds"]))
+
+
+def save_model_config(result: Dict, path: Path) -> None:
+    """Writes the configuration the Flask app reads from `MODEL_CONFIG`"""
+    with Path(path).open("w") as f:
+        json.dump({"model": result["model"], "parameters": result["parameters"]}, f, indent=2, sort_keys=True)
+
+
+def format_front(front: List[Dict], chosen: Optional[Dict] = None) -> str:
+    lines = [f"""{"parameters":<60}{"length error":>14}{"circularity":>13}{"seconds":>10}{"p90":>10}"""]
+    for result in front:
+        parameters = ", ".join(f"{name}={value}" for name, value in sorted(result["parameters"].items()))
+        marker = " *" if result is chosen else ""
+        lines.append(
+            f"""{parameters:<60}{result["length_error"]:>14.2%}{result["circularity"]:>13.3f}"""
+            f"""{result["seconds"]:>10.3f}{result["p90_seconds"]:>10.3f}{marker}""")
+    return "\n".join(lines)
@@ -0,0 +1,14 @@
+# Load the app in the master and warm it before forking, so workers start with the
+# heavy dependencies imported and the first request does not pay for them
+preload_app = True
+
+
+def when_ready(server):
+    from app import preload
+    preload()
+
+
+def post_fork(server, worker):
+    # Local search processes are forked once per worker, before it starts its threads
+    from app import local_search_pool
+    local_search_pool()
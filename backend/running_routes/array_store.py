@@ -0,0 +1,66 @@
+"""Directories of `.npy` arrays that are rewritten while other processes map them
+
+The directory is a symlink to its current version, a sibling `.{name}.{version}` directory.
+`write_arrays` writes a new version and repoints the symlink with one rename, so the directory
+always exists and always holds a whole version. `read_arrays` resolves the symlink once, so a
+reader maps every array of the same version.
+
+The previous version is kept for readers still opening it, older versions are deleted.
+"""
+import json
+import os
+from pathlib import Path
+import re
+import shutil
+import uuid
+
+import numpy as np
+
+from typing import Dict, Iterable, Optional, Tuple
+
+META_FILE = "meta.json"
+
+
+def write_arrays(directory: Path, arrays: Dict[str, np.ndarray], meta: Dict) -> Path:
+    """Writes `arrays` and `meta` as the new version of `directory`"""
+    directory = Path(directory)
+    directory.parent.mkdir(parents=True, exist_ok=True)
+    version = directory.with_name(f".{directory.name}.{uuid.uuid4().hex}")
+    version.mkdir()
+    for name, array in arrays.items():
+        np.save(version / f"{name}.npy", array)
+    with (version / META_FILE).open("w") as f:
+        json.dump(meta, f)
+
+    previous = None
+    if directory.is_symlink():
+        previous = directory.resolve()
+    elif directory.exists():
+        # Written before directories were versioned, moved aside once
+        previous = directory.with_name(f".{directory.name}.{uuid.uuid4().hex}")
+        os.replace(directory, previous)
+    link = directory.with_name(f".{directory.name}.{uuid.uuid4().hex}.link")
+    os.symlink(version.name, link)
+    os.replace(link, directory)
+    _remove_old_versions(directory, previous)
+    return directory
+
+
+def read_arrays(directory: Path, names: Iterable[str]) -> Tuple[Path, Dict, Dict[str, np.ndarray]]:
+    """Maps the arrays of the current version read-only, returns its directory, its meta and the arrays"""
+    version = Path(directory).resolve()
+    with (version / META_FILE).open() as f:
+        meta = json.load(f)
+    return version, meta, {name: np.load(version / f"{name}.npy", mmap_mode="r") for name in names}
+
+
+def _remove_old_versions(directory: Path, previous: Optional[Path]) -> None:
+    """Deletes the versions written before `previous`, versions other writers are still writing are newer"""
+    if previous is None or not previous.exists():
+        return
+    pattern = re.compile(rf"\.{re.escape(directory.name)}\.[0-9a-f]{{32}}")
+    previous_time = previous.stat().st_mtime
+    for path in directory.parent.iterdir():
+        if (pattern.fullmatch(path.name) and path != previous and not path.is_symlink()
+                and path.stat().st_mtime < previous_time):
+            shutil.rmtree(path, ignore_errors=True)
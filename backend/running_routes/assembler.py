@@ -1,8 +1,20 @@
 from abc import ABC, abstractmethod
+import itertools
 
+import numpy as np
+import shapely.geometry
+
+from running_routes.geometry import METERS_PER_DEGREE
 from running_routes.network import NetworkFactory
+from running_routes.tour import Tour, as_tours
+
+from typing import Dict, List, Optional
 
-from typing import List, Optional
+REST_API_DEFAULT_PARAMETERS = {
+    "output": "coordinates",
+    "precision": 5,
+    "tolerance": None,
+}
 
 
 class AssemblerFactory(ABC):
@@ -12,7 +24,7 @@ class AssemblerFactory(ABC):
 
     @abstractmethod
     def generate_output(
-            self, tours: List[List], distance: int, network: NetworkFactory) -> List:
+            self, tours: List[Tour], distance: int, network: NetworkFactory) -> List:
         pass
 
 
@@ -22,30 +34,138 @@ class TourAssembler(AssemblerFactory):
     def __init__(self):
         pass
 
-    def generate_output(self, tours: List[List], distance: int, network: NetworkFactory) -> List:
-        network_nodes = network.nodes
-        routes = [
-            [[network_nodes[node]["y"], network_nodes[node]["x"]] for node in tour]
-            for tour in tours]
+    def generate_output(self, tours: List[Tour], distance: int, network: NetworkFactory) -> List:
+        routes = [tour.coordinates(network).tolist() for tour in as_tours(tours, network)]
         return routes
 
 
 class RestAPIAssembler(AssemblerFactory):
-    """Converts tours to routes with distance as metadata"""
+    """Converts tours to routes with distance as metadata
 
-    def __init__(self):
-        pass
+    `output` is either
+    - "coordinates": the tour nodes as lat-long coordinates and a Google Maps url
+    - "polyline": the full street path of the tour as a Google encoded polyline
+        https://developers.google.com/maps/documentation/utilities/polylinealgorithm
+        `precision` is the number of decimal places kept and `tolerance`, in meters,
+        simplifies the path before encoding
+    """
+
+    def __init__(self, **parameters):
+        self.parameters = parameters
+
+        # Set default parameters
+        for key, value in REST_API_DEFAULT_PARAMETERS.items():
+            if key not in self.parameters:
+                self.parameters[key] = value
+
+        if self.parameters["output"] not in ["coordinates", "polyline"]:
+            raise ValueError(f"""Unknown output {self.parameters["output"]}""")
+
+    def generate_output(self, tours: List[Tour], distance: int, network: NetworkFactory) -> Dict:
+        tours = as_tours(tours, network)
+        if self.parameters["output"] == "polyline":
+            routes = [
+                {"path": network.node_coordinates(self._expand_tour(tour, network)), "distance": tour.length}
+                for tour in tours]
+        else:
+            routes = [{"coordinates": tour.coordinates(network), "distance": tour.length} for tour in tours]
+        return self.format_routes(routes)
+
+    def format_routes(self, routes: List[Dict]) -> Dict:
+        """Output of routes whose coordinates are already known, e.g. read from a route catalogue
+
+        Each route has its `distance`, and the (lat, lng) of its tour nodes as `coordinates` for the
+        coordinates output, or of its full street path as `path` for the polyline output.
+        """
+        if self.parameters["output"] == "polyline":
+            return self._generate_polylines(routes)
 
-    def generate_output(self, tours: List[List], distance: int, network: NetworkFactory) -> List:
-        network_nodes = network.nodes
-        routes = {"routes": []}
-        for tour in tours:
-            coordinates = [[network_nodes[node]["y"], network_nodes[node]["x"]] for node in tour]
-            route_distance = sum(network.length(x, y) for x, y in zip(tour, tour[1:]))
+        output = {"routes": []}
+        for route in routes:
+            coordinates = np.asarray(route["coordinates"]).tolist()
             url = (
                 "https://google.com/maps/dir/" + 
-                "/".join([f"""{network_nodes[node]["y"]},{network_nodes[node]["x"]}""" for node in tour])
+                "/".join([f"{lat},{lng}" for lat, lng in coordinates])
             )
-            route = {"coordinates": coordinates, "distance": route_distance, "url": url}
-            routes["routes"].append(route)
-        return routes
+            output["routes"].append({"coordinates": coordinates, "distance": route["distance"], "url": url})
+        return output
+
+    def _generate_polylines(self, routes: List[Dict]) -> Dict:
+        precision = self.parameters["precision"]
+        output = {"precision": precision, "routes": []}
+        for route in routes:
+            coordinates = np.asarray(route["path"]).tolist()
+            if self.parameters["tolerance"]:
+                coordinates = simplify(coordinates, self.parameters["tolerance"])
+            output["routes"].append(
+                {"polyline": encode_polyline(coordinates, precision), "distance": route["distance"]})
+        return output
+
+    def _expand_tour(self, tour: Tour, network: NetworkFactory) -> List:
+        """Replaces each leg of the tour with the streets between its nodes"""
+        nodes = list(tour)
+        street_path = nodes[:1]
+        for source, target in zip(nodes, nodes[1:]):
+            street_path.extend(network.path(source, target)[1:])
+        return [group[0] for group in itertools.groupby(street_path)]
+
+
+def simplify(coordinates: List[List[float]], tolerance: float) -> List[List[float]]:
+    """Douglas-Peucker simplification of lat-long coordinates, `tolerance` is in meters
+
+    The route is simplified in meters, projected equirectangularly around its mean latitude,
+    where a degree of longitude is shorter than a degree of latitude
+    """
+    if len(coordinates) < 3:
+        return coordinates
+    points = np.asarray(coordinates, dtype=float)
+    scale = METERS_PER_DEGREE*np.array([np.cos(np.radians(points[:, 0].mean())), 1])
+    projected = [tuple(point) for point in points[:, ::-1]*scale]
+    simplified_line = shapely.geometry.LineString(projected).simplify(tolerance, preserve_topology=False)
+    # The simplified line keeps a subset of the projected points, which map back to the exact coordinates
+    kept = {point: coordinate for point, coordinate in zip(projected, coordinates)}
+    return [list(kept[point]) for point in simplified_line.coords]
+
+
+def encode_polyline(coordinates: List[List[float]], precision: int = 5) -> str:
+    """Encodes lat-long coordinates with Google's encoded polyline algorithm
+
+    https://developers.google.com/maps/documentation/utilities/polylinealgorithm
+    """
+    factor = 10**precision
+    encoded = []
+    previous_lat, previous_lng = 0, 0
+    for lat, lng in coordinates:
+        lat, lng = round(lat*factor), round(lng*factor)
+        for delta in [lat - previous_lat, lng - previous_lng]:
+            # Left shift, inverting negative values, then emit 5-bit chunks smallest first
+            value = ~(delta << 1) if delta < 0 else delta << 1
+            while value >= 0x20:
+                encoded.append(chr((0x20 | (value & 0x1f)) + 63))
+                value >>= 5
+            encoded.append(chr(value + 63))
+        previous_lat, previous_lng = lat, lng
+    return "".join(encoded)
+
+
+def decode_polyline(polyline: str, precision: int = 5) -> List[List[float]]:
+    """Inverse of `encode_polyline`"""
+    factor = 10**precision
+    coordinates = []
+    index, lat, lng = 0, 0, 0
+    while index < len(polyline):
+        deltas = []
+        for _ in range(2):
+            shift, value = 0, 0
+            while True:
+                chunk = ord(polyline[index]) - 63
+                index += 1
+                value |= (chunk & 0x1f) << shift
+                shift += 5
+                if chunk < 0x20:
+                    break
+            deltas.append(~(value >> 1) if value & 1 else value >> 1)
+        lat += deltas[0]
+        lng += deltas[1]
+        coordinates.append([lat / factor, lng / factor])
+    return coordinates
@@ -0,0 +1,210 @@
+"""Precomputed routes for a grid of start points, answered without running the pipeline
+
+`running_routes.catalogue_build.build_catalogue` runs the pipeline for each standard distance from
+each point of a regular grid, `spacing` meters apart, and `write_catalogue` stores the routes as a
+directory of `.npy` arrays
+- `point_keys`: packed (row, column) of each grid point with routes, sorted
+- `points`: (lat, lng) of each grid point, in the order of `point_keys`
+- `entry_keys`: (point, distance) packed into one key per solved pair, sorted
+- `entry_offsets`: routes of each entry, `route_distances`: length of each route in meters
+- `tour_offsets`, `tour_coordinates`: tour nodes of each route
+- `path_offsets`, `path_coordinates`: full street path of each route
+Coordinates are stored as int32 microdegrees, about 10cm.
+
+`RouteCatalogue` maps the arrays read-only. A request's nearest grid points follow from the grid's
+origin and steps, so a lookup is a few binary searches and no graph is touched. This module only
+needs numpy, so the Flask app reads catalogues without importing the pipeline's dependencies.
+"""
+import json
+import math
+from pathlib import Path
+import uuid
+
+import click
+import numpy as np
+
+from running_routes import registry
+from running_routes.array_store import read_arrays, write_arrays
+from running_routes.geometry import degree_deltas, great_circle_vec
+
+from typing import Dict, List, Optional, Tuple
+
+ARRAYS = (
+    "point_keys", "points", "entry_keys", "entry_offsets", "route_distances",
+    "tour_offsets", "tour_coordinates", "path_offsets", "path_coordinates")
+
+# Coordinates are stored as integers of this many units per degree
+COORDINATE_SCALE = 10**6
+
+# Grid rows and columns are packed into one key, offset so they are never negative
+_POINT_OFFSET = 2**24
+_POINT_STRIDE = 2**25
+# Distances in meters are packed below the point's index
+_DISTANCE_STRIDE = 2**32
+
+
+class RouteCatalogue:
+    def __init__(self, directory: Path):
+        self.directory, self.meta, arrays = read_arrays(directory, ARRAYS)
+        for name, array in arrays.items():
+            setattr(self, name, array)
+        self.origin: Tuple[float, float] = tuple(self.meta["origin"])
+        self.lat_step: float = self.meta["lat_step"]
+        self.lng_step: float = self.meta["lng_step"]
+
+    def __len__(self) -> int:
+        return len(self.entry_keys)
+
+    def lookup(self, start_coordinate: Dict, distance: int, n: int, max_offset: float) -> Optional[Dict]:
+        """Routes of the nearest grid point within `max_offset` meters that has at least `n` routes of `distance`
+
+        Returns the grid `point`, its `offset` in meters from `start_coordinate` and its first `n` `routes`,
+        each with its tour `coordinates`, street `path` and `distance`, or None.
+        """
+        lat, lng = start_coordinate["lat"], start_coordinate["lng"]
+        row = round((lat - self.origin[0])/self.lat_step)
+        column = round((lng - self.origin[1])/self.lng_step)
+        # The nearest point may have no routes, its neighbours are still close enough for a large `max_offset`
+        keys = np.array(
+            [_point_key(row + i, column + j) for i in (-1, 0, 1) for j in (-1, 0, 1)], dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.point_keys, keys), len(self.point_keys) - 1)
+        positions = positions[self.point_keys[positions] == keys]
+        if not len(positions):
+            return None
+        offsets = great_circle_vec(lat, lng, self.points[positions, 0], self.points[positions, 1])
+
+        for order in np.argsort(offsets, kind="stable"):
+            if offsets[order] > max_offset:
+                break
+            routes = self._routes(int(positions[order]), distance, n)
+            if routes is not None:
+                point = self.points[positions[order]]
+                return {
+                    "point": {"lat": float(point[0]), "lng": float(point[1])},
+                    "offset": float(offsets[order]),
+                    "routes": routes,
+                }
+        return None
+
+    def _routes(self, point: int, distance: int, n: int) -> Optional[List[Dict]]:
+        key = point*_DISTANCE_STRIDE + int(distance)
+        entry = np.searchsorted(self.entry_keys, key)
+        if entry >= len(self.entry_keys) or self.entry_keys[entry] != key:
+            return None
+        start, end = self.entry_offsets[entry], self.entry_offsets[entry + 1]
+        if end - start < n:
+            return None
+        return [
+            {
+                "coordinates": _coordinates(self.tour_coordinates, self.tour_offsets, route),
+                "path": _coordinates(self.path_coordinates, self.path_offsets, route),
+                "distance": float(self.route_distances[route]),
+            }
+            for route in range(start, start + n)]
+
+
+def grid_points(center: Dict, radius: float, spacing: float) -> Tuple[Dict, List[Tuple[int, int, Dict]]]:
+    """Grid of points `spacing` meters apart within `radius` meters of `center`
+
+    Returns the grid, its origin and steps in degrees, and the (row, column, coordinate) of each point
+    """
+    lat_step, lng_step = degree_deltas(center["lat"], spacing)
+    grid = {"origin": [center["lat"], center["lng"]], "lat_step": lat_step, "lng_step": lng_step, "spacing": spacing}
+    steps = int(radius//spacing)
+    points = []
+    for row in range(-steps, steps + 1):
+        for column in range(-steps, steps + 1):
+            if math.hypot(row, column)*spacing <= radius:
+                points.append((row, column, {"lat": center["lat"] + row*lat_step, "lng": center["lng"] + column*lng_step}))
+    return grid, points
+
+
+def write_catalogue(grid: Dict, entries: List[Dict], directory: Path, meta: Optional[Dict] = None) -> Path:
+    """Writes the entries of `catalogue_build.build_catalogue`, replacing any catalogue in `directory`"""
+    point_keys, point_rows = np.unique(
+        np.array([_point_key(entry["row"], entry["column"]) for entry in entries], dtype=np.int64),
+        return_inverse=True)
+    points = np.zeros((len(point_keys), 2), dtype=np.float64)
+    for entry, point in zip(entries, point_rows):
+        points[point] = entry["point"]["lat"], entry["point"]["lng"]
+
+    entry_keys = point_rows.astype(np.int64)*_DISTANCE_STRIDE + np.array([entry["distance"] for entry in entries], dtype=np.int64)
+    order = np.argsort(entry_keys, kind="stable")
+    routes = [route for i in order for route in entries[i]["routes"]]
+    route_counts = [len(entries[i]["routes"]) for i in order]
+    tour_coordinates, tour_offsets = _pack([route["coordinates"] for route in routes])
+    path_coordinates, path_offsets = _pack([route["path"] for route in routes])
+    arrays = {
+        "point_keys": point_keys,
+        "points": points,
+        "entry_keys": entry_keys[order],
+        "entry_offsets": np.concatenate(([0], np.cumsum(route_counts))).astype(np.int64),
+        "route_distances": np.array([route["distance"] for route in routes], dtype=np.float64),
+        "tour_offsets": tour_offsets,
+        "tour_coordinates": tour_coordinates,
+        "path_offsets": path_offsets,
+        "path_coordinates": path_coordinates,
+    }
+    meta = dict(meta or {}, **grid, entries=len(entries), routes=len(routes), version=uuid.uuid4().hex)
+
+    # A new version, swapped in atomically, so app workers never find a partial or missing catalogue
+    return write_arrays(directory, arrays, meta)
+
+
+def _pack(arrays: List[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+    """Concatenates (lat, lng) arrays as microdegrees, with the offset of each"""
+    offsets = np.concatenate(([0], np.cumsum([len(array) for array in arrays]))).astype(np.int64)
+    if not arrays:
+        return np.zeros((0, 2), dtype=np.int32), offsets
+    coordinates = np.round(np.concatenate([np.asarray(array).reshape(-1, 2) for array in arrays])*COORDINATE_SCALE)
+    return coordinates.astype(np.int32), offsets
+
+
+def _coordinates(coordinates: np.ndarray, offsets: np.ndarray, index: int) -> np.ndarray:
+    return coordinates[offsets[index]:offsets[index + 1]]/COORDINATE_SCALE
+
+
+def _point_key(row: int, column: int) -> int:
+    return (row + _POINT_OFFSET)*_POINT_STRIDE + column + _POINT_OFFSET
+
+
+@click.command(context_settings=dict(max_content_width=600))
+@click.option("--lat", type=float, required=True)
+@click.option("--lng", type=float, required=True)
+@click.option("--radius", type=click.FloatRange(0), required=True, help="Meters from the centre covered by the grid")
+@click.option("--spacing", type=click.FloatRange(0, min_open=True), default=250, show_default=True,
+              help="Meters between grid points")
+@click.option("--distance", "distances", type=click.IntRange(500, 10000), multiple=True,
+              default=[3000, 5000, 10000], show_default=True)
+@click.option("--n", type=click.IntRange(1, 10), default=5, show_default=True,
+              help="Routes stored per point and distance, requests for more are solved live")
+@click.option("--workers", type=click.IntRange(1), default=1, show_default=True)
+@click.option("--model", "model_name", type=click.Choice(registry.names("model")), default="savings", show_default=True)
+@click.option("--model-config", type=click.Path(dir_okay=False, exists=True), default=None,
+              help="Model and parameters written by `python -m benchmarks tune --config`")
+@click.option("--mapped-graph", type=click.Path(file_okay=False, exists=True), default=None,
+              help="Slice the networks from a regional graph written by running_routes.mapped_graph")
+@click.option("--output", type=click.Path(file_okay=False), required=True)
+def _cli(lat, lng, radius, spacing, distances, n, workers, model_name, model_config, mapped_graph, output):
+    """Precomputes routes for a grid of start points and writes them as a route catalogue"""
+    # Imports the pipeline's dependencies, which readers of catalogues do without
+    from running_routes.catalogue_build import build_catalogue
+
+    model_parameters = {}
+    if model_config:
+        with open(model_config) as f:
+            config = json.load(f)
+        model_name, model_parameters = config.get("model") or model_name, config.get("parameters", {})
+    if mapped_graph:
+        network_name, network_parameters = "mapped", {"directory": mapped_graph}
+    else:
+        network_name, network_parameters = "osm", {}
+    grid, entries = build_catalogue(
+        {"lat": lat, "lng": lng}, radius, spacing, distances, n, network_name, network_parameters,
+        model_name, model_parameters, workers=workers)
+    meta = {"distances": list(distances), "n": n, "model": model_name, "model_parameters": model_parameters}
+    directory = write_catalogue(grid, entries, Path(output), meta)
+    click.echo(f"Wrote {len(entries)} entries to {directory}", err=True)
+
+if __name__ == "__main__":
+    _cli()
@@ -0,0 +1,82 @@
+"""Builds route catalogues by running the pipeline from every point of a grid
+
+Kept apart from `running_routes.catalogue`, whose reader the Flask app imports, because solving
+routes needs the network, model and assembler dependencies.
+"""
+from concurrent.futures import ProcessPoolExecutor
+import logging
+import multiprocessing
+
+from running_routes import registry
+from running_routes.assembler import RestAPIAssembler
+from running_routes.catalogue import grid_points
+from running_routes.pipeline import pipeline
+from running_routes.tour import Tour, as_tours
+
+from typing import Dict, Iterable, List, Optional, Tuple, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from running_routes.network import NetworkFactory
+
+logger = logging.getLogger(__name__)
+
+# State of each catalogue build worker, set once by `_initialise_worker`
+_WORKER_STATE: Dict = {}
+
+
+class CatalogueAssembler(RestAPIAssembler):
+    """Keeps the tour coordinates and street path of each route, so either output can be served later"""
+
+    def generate_output(self, tours: List[Tour], distance: int, network: "NetworkFactory") -> List[Dict]:
+        return [
+            {
+                "coordinates": tour.coordinates(network),
+                "path": network.node_coordinates(self._expand_tour(tour, network)),
+                "distance": tour.length,
+            }
+            for tour in as_tours(tours, network)]
+
+
+def build_catalogue(
+        center: Dict, radius: float, spacing: float, distances: Iterable[int], n: int, network_name: str = "osm",
+        network_parameters: Optional[Dict] = None, model_name: str = "savings", model_parameters: Optional[Dict] = None,
+        local_search_names: Iterable[str] = ("backtrack_elimination",), workers: int = 1) -> Tuple[Dict, List[Dict]]:
+    """Solves every distance from every grid point, spreading the points across `workers` processes
+
+    Returns the grid and an entry per solved point and distance, points that fail are logged and left out
+    """
+    grid, points = grid_points(center, radius, spacing)
+    tasks = [(row, column, point, distance, n) for row, column, point in points for distance in distances]
+    initargs = (
+        network_name, network_parameters or {}, model_name, model_parameters or {}, list(local_search_names))
+    if workers <= 1:
+        _initialise_worker(*initargs)
+        entries = [_solve(task) for task in tasks]
+    else:
+        context = None
+        if "fork" in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context("fork")
+        with ProcessPoolExecutor(
+                max_workers=workers, mp_context=context, initializer=_initialise_worker, initargs=initargs) as executor:
+            entries = list(executor.map(_solve, tasks))
+    return grid, [entry for entry in entries if entry is not None]
+
+
+def _initialise_worker(
+        network_name: str, network_parameters: Dict, model_name: str, model_parameters: Dict,
+        local_search_names: List[str]) -> None:
+    _WORKER_STATE["network"] = registry.create("network", network_name, **network_parameters)
+    _WORKER_STATE["model"] = registry.create("model", model_name, **model_parameters)
+    _WORKER_STATE["local_searches"] = [registry.create("local_search", name) for name in local_search_names]
+
+
+def _solve(task: Tuple) -> Optional[Dict]:
+    row, column, point, distance, n = task
+    try:
+        routes = pipeline(
+            n, point, distance, network=_WORKER_STATE["network"], model=_WORKER_STATE["model"],
+            local_searches=_WORKER_STATE["local_searches"], assembler=CatalogueAssembler())
+    except Exception:
+        logger.exception("Failed to solve %sm from %s", distance, point)
+        return None
+    return {"row": row, "column": column, "point": point, "distance": distance, "routes": routes}
@@ -0,0 +1,111 @@
+"""Coarsened street graphs for the model stage of long runs
+
+The model only needs lengths between sample nodes hundreds of meters apart, which a
+much smaller graph answers almost as well as the full pedestrian network:
+- chains of degree 2 nodes, e.g. the points shaping a curved footpath, merge into one edge
+- connected nodes in the same `cell_size` meter grid cell, e.g. the crossings and kerb ramps
+  of one intersection, merge into a super-node
+
+Each super-node is labelled by one of its member nodes, its representative, so tours over the
+coarse graph are already tours over the full graph and expand to street paths through it.
+Lengths inside a super-node count as zero, so coarse lengths err by at most a cell diagonal per hop.
+"""
+import math
+
+import networkx as nx
+
+from running_routes.geometry import degree_deltas
+
+from typing import Dict, Hashable, List, Tuple
+
+
+def coarsen_graph(G: nx.MultiDiGraph, cell_size: float) -> Tuple[nx.DiGraph, Dict[Hashable, List]]:
+    """Coarse copy of `G`, and the full graph members of each super-node except the merged chain nodes"""
+    H = _shortest_edges(G)
+    merge_chains(H)
+    clusters = _cluster(H, cell_size)
+
+    members: Dict[Hashable, List] = {}
+    for node, cluster in clusters.items():
+        members.setdefault(cluster, []).append(node)
+    label = {}
+    for cluster, nodes in members.items():
+        # The member closest to the centroid stands for the super-node
+        lat = sum(H.nodes[node]["y"] for node in nodes)/len(nodes)
+        lng = sum(H.nodes[node]["x"] for node in nodes)/len(nodes)
+        representative = min(nodes, key=lambda node: (H.nodes[node]["y"] - lat)**2 + (H.nodes[node]["x"] - lng)**2)
+        for node in nodes:
+            label[node] = representative
+
+    coarse = nx.DiGraph(crs=G.graph.get("crs"))
+    coarse.add_nodes_from(
+        (node, {"x": G.nodes[node]["x"], "y": G.nodes[node]["y"]}) for node in set(label.values()))
+    for u, v, length in H.edges(data="length"):
+        u, v = label[u], label[v]
+        if u != v and (not coarse.has_edge(u, v) or length < coarse[u][v]["length"]):
+            coarse.add_edge(u, v, length=length)
+    return coarse, {label[nodes[0]]: nodes for nodes in members.values()}
+
+
+def merge_chains(H: nx.DiGraph) -> int:
+    """Replaces the nodes in the middle of two-way or one-way chains by edges, returns how many were removed
+
+    Removing a node keeps the shortest length between every remaining pair of nodes
+    """
+    removed = 0
+    for node in list(H.nodes):
+        predecessors, successors = set(H.pred[node]), set(H.succ[node])
+        neighbours = predecessors | successors
+        if len(neighbours) != 2 or node in neighbours:
+            continue
+        two_way = predecessors == successors
+        one_way = len(predecessors) == 1 and len(successors) == 1 and predecessors != successors
+        if not (two_way or one_way):
+            continue
+        for predecessor in predecessors:
+            for successor in successors:
+                if predecessor == successor:
+                    continue
+                length = H[predecessor][node]["length"] + H[node][successor]["length"]
+                if not H.has_edge(predecessor, successor) or length < H[predecessor][successor]["length"]:
+                    H.add_edge(predecessor, successor, length=length)
+        H.remove_node(node)
+        removed += 1
+    return removed
+
+
+def _shortest_edges(G: nx.MultiDiGraph) -> nx.DiGraph:
+    """Copy of `G` with coordinates and lengths only, parallel edges collapse to the shortest one"""
+    H = nx.DiGraph()
+    H.add_nodes_from((node, {"x": data["x"], "y": data["y"]}) for node, data in G.nodes(data=True))
+    for u, v, length in G.edges(data="length"):
+        if u != v and (not H.has_edge(u, v) or length < H[u][v]["length"]):
+            H.add_edge(u, v, length=length)
+    return H
+
+
+def _cluster(H: nx.DiGraph, cell_size: float) -> Dict[Hashable, Hashable]:
+    """Cluster of every node, nodes sharing a grid cell and connected within it share a cluster"""
+    if not len(H):
+        return {}
+    latitude = sum(y for _, y in H.nodes(data="y"))/len(H)
+    lat_size, lng_size = degree_deltas(latitude, cell_size)
+    cell = {
+        node: (math.floor(data["y"]/lat_size), math.floor(data["x"]/lng_size))
+        for node, data in H.nodes(data=True)}
+
+    # Union find over the edges inside a cell
+    parent = {node: node for node in H.nodes}
+
+    def find(node):
+        while parent[node] != node:
+            parent[node] = parent[parent[node]]
+            node = parent[node]
+        return node
+
+    for u, v in H.edges():
+        if cell[u] == cell[v]:
+            root_u, root_v = find(u), find(v)
+            if root_u != root_v:
+                parent[root_u] = root_v
+    return {node: find(node) for node in H.nodes}
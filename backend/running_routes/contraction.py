@@ -0,0 +1,321 @@
+"""Contraction hierarchies for fast point-to-point and many-to-many shortest paths
+
+Geisberger et al. 2008, Contraction Hierarchies: Faster and Simpler Hierarchical Routing in Road Networks
+https://doi.org/10.1007/978-3-540-68552-4_24
+
+Nodes are contracted one at a time, from least to most important, adding shortcut edges
+that preserve shortest path lengths between the remaining nodes. A query then only
+searches upwards in the hierarchy from both ends, which visits a small fraction of the graph.
+Many-to-many queries use the bucket algorithm of Knopp et al. 2007.
+
+Building a hierarchy takes seconds to minutes in pure Python, so it is built once per region,
+i.e. per graph cache entry or mapped graph, offline with
+    python -m running_routes.contraction --graph-cache DIR
+    python -m running_routes.contraction --mapped-graph DIR
+or while prewarming, and requests only load it.
+"""
+from collections import defaultdict
+import functools
+import heapq
+import math
+import os
+import pickle
+from pathlib import Path
+import uuid
+
+import click
+import networkx as nx
+import numpy as np
+
+from typing import Dict, Hashable, Iterable, List, Optional, Tuple
+
+# Bounds the local searches that look for paths avoiding the node being contracted.
+# Stopping early only adds unnecessary shortcuts, it never makes a query wrong.
+WITNESS_SETTLE_LIMIT = 60
+
+
+class ContractionHierarchy:
+    def __init__(
+            self, node_ids: List[Hashable], forward: List[List[Tuple[int, float]]],
+            backward: List[List[Tuple[int, float]]], middle: Dict[Tuple[int, int], int],
+            fingerprint: Optional[str] = None):
+        self.node_ids = node_ids
+        self.node_index = {node: index for index, node in enumerate(node_ids)}
+        # Upward edges, `forward[a]` holds (b, weight) of a -> b and `backward[b]` holds (a, weight) of a -> b
+        self.forward = forward
+        self.backward = backward
+        # Shortcut (a, b) replaces the path a -> middle -> b
+        self.middle = middle
+        self.fingerprint = fingerprint
+
+    @classmethod
+    def build(
+            cls, G: nx.DiGraph, weight: str = "length", fingerprint: Optional[str] = None,
+            witness_settle_limit: int = WITNESS_SETTLE_LIMIT) -> "ContractionHierarchy":
+        node_ids = list(G.nodes)
+        index = {node: i for i, node in enumerate(node_ids)}
+        edges = ((index[u], index[v], data.get(weight, 1)) for u, v, data in G.edges(data=True))
+        return cls._contract(node_ids, edges, fingerprint, witness_settle_limit)
+
+    @classmethod
+    def from_csr(
+            cls, node_ids: np.ndarray, indptr: np.ndarray, indices: np.ndarray, lengths: np.ndarray,
+            fingerprint: Optional[str] = None,
+            witness_settle_limit: int = WITNESS_SETTLE_LIMIT) -> "ContractionHierarchy":
+        """Hierarchy of a graph stored in compressed sparse row form, e.g. a mapped region"""
+        sources = np.repeat(np.arange(len(node_ids)), np.diff(indptr))
+        edges = zip(sources.tolist(), np.asarray(indices).tolist(), np.asarray(lengths).tolist())
+        return cls._contract(np.asarray(node_ids).tolist(), edges, fingerprint, witness_settle_limit)
+
+    @classmethod
+    def _contract(
+            cls, node_ids: List[Hashable], edges: Iterable[Tuple[int, int, float]], fingerprint: Optional[str],
+            witness_settle_limit: int) -> "ContractionHierarchy":
+        """Contracts the graph of (source position, target position, length) `edges`"""
+        size = len(node_ids)
+
+        # Parallel edges collapse to the shortest one
+        out_edges: List[Dict[int, float]] = [{} for _ in range(size)]
+        in_edges: List[Dict[int, float]] = [{} for _ in range(size)]
+        for a, b, length in edges:
+            if a == b:
+                continue
+            if length < out_edges[a].get(b, math.inf):
+                out_edges[a][b] = length
+                in_edges[b][a] = length
+
+        contracted = [False]*size
+        deleted_neighbours = [0]*size
+        rank = [0]*size
+        middle: Dict[Tuple[int, int], int] = {}
+
+        def witness_distances(source: int, excluded: int, limit: float, targets: Dict[int, float]) -> Dict[int, float]:
+            distances = {source: 0}
+            heap = [(0, source)]
+            remaining = set(targets)
+            settled = 0
+            while heap and remaining and settled < witness_settle_limit:
+                distance, node = heapq.heappop(heap)
+                if distance > distances[node]:
+                    continue
+                if distance > limit:
+                    break
+                remaining.discard(node)
+                settled += 1
+                for neighbour, length in out_edges[node].items():
+                    if contracted[neighbour] or neighbour == excluded:
+                        continue
+                    candidate = distance + length
+                    if candidate < distances.get(neighbour, math.inf):
+                        distances[neighbour] = candidate
+                        heapq.heappush(heap, (candidate, neighbour))
+            return distances
+
+        def shortcuts(node: int) -> List[Tuple[int, int, float]]:
+            incoming = [(u, length) for u, length in in_edges[node].items() if not contracted[u]]
+            outgoing = [(w, length) for w, length in out_edges[node].items() if not contracted[w]]
+            if not incoming or not outgoing:
+                return []
+            max_outgoing = max(length for _, length in outgoing)
+
+            result = []
+            for u, incoming_length in incoming:
+                targets = {w: incoming_length + length for w, length in outgoing if w != u}
+                if not targets:
+                    continue
+                witnesses = witness_distances(u, node, incoming_length + max_outgoing, targets)
+                result.extend(
+                    (u, w, length) for w, length in targets.items()
+                    if witnesses.get(w, math.inf) > length)
+            return result
+
+        def priority(node: int) -> int:
+            edges = sum(not contracted[u] for u in in_edges[node]) + sum(not contracted[w] for w in out_edges[node])
+            return len(shortcuts(node)) - edges + deleted_neighbours[node]
+
+        # Lazy updates: a node's priority is recomputed when it reaches the top of the queue
+        queue = [(priority(node), node) for node in range(size)]
+        heapq.heapify(queue)
+        order = 0
+        while queue:
+            _, node = heapq.heappop(queue)
+            current_priority = priority(node)
+            if queue and current_priority > queue[0][0]:
+                heapq.heappush(queue, (current_priority, node))
+                continue
+
+            for u, w, length in shortcuts(node):
+                if length < out_edges[u].get(w, math.inf):
+                    out_edges[u][w] = length
+                    in_edges[w][u] = length
+                    middle[u, w] = node
+            contracted[node] = True
+            rank[node] = order
+            order += 1
+            for neighbour in set(in_edges[node]).union(out_edges[node]):
+                deleted_neighbours[neighbour] += 1
+
+        forward = [
+            [(b, length) for b, length in out_edges[a].items() if rank[b] > rank[a]]
+            for a in range(size)]
+        backward = [
+            [(a, length) for a, length in in_edges[b].items() if rank[a] > rank[b]]
+            for b in range(size)]
+        return cls(node_ids, forward, backward, middle, fingerprint)
+
+    def distance(self, source: Hashable, target: Hashable) -> float:
+        return self._query(source, target)[0]
+
+    def path(self, source: Hashable, target: Hashable) -> List[Hashable]:
+        return self.shortest_path(source, target)[1]
+
+    def shortest_path(self, source: Hashable, target: Hashable) -> Tuple[float, List[Hashable]]:
+        """Length and nodes of the shortest path, from a single query"""
+        distance, meeting_node, forward_parents, backward_parents = self._query(source, target)
+        if distance == math.inf:
+            raise nx.NetworkXNoPath(f"No path between {source} and {target}")
+
+        upward = [meeting_node]
+        while upward[-1] in forward_parents:
+            upward.append(forward_parents[upward[-1]])
+        downward = [meeting_node]
+        while downward[-1] in backward_parents:
+            downward.append(backward_parents[downward[-1]])
+        hierarchy_path = upward[::-1] + downward[1:]
+
+        path = [hierarchy_path[0]]
+        for a, b in zip(hierarchy_path, hierarchy_path[1:]):
+            path.extend(self._unpack(a, b))
+        return distance, [self.node_ids[node] for node in path]
+
+    def many_to_many(self, sources: List[Hashable], targets: List[Hashable]) -> List[List[float]]:
+        """Lengths from every source to every target"""
+        buckets: Dict[int, List[Tuple[int, float]]] = defaultdict(list)
+        for j, target in enumerate(targets):
+            for node, distance in self._upward_search(self._index(target), self.backward).items():
+                buckets[node].append((j, distance))
+
+        lengths = []
+        for source in sources:
+            row = [math.inf]*len(targets)
+            for node, distance in self._upward_search(self._index(source), self.forward).items():
+                for j, target_distance in buckets.get(node, ()):
+                    if distance + target_distance < row[j]:
+                        row[j] = distance + target_distance
+            lengths.append(row)
+        return lengths
+
+    def save(self, path: Path) -> None:
+        """Written next to `path` and swapped in, so concurrent loads never read a partial hierarchy"""
+        path = Path(path)
+        temporary_path = path.with_name(f".{path.name}.{uuid.uuid4().hex}")
+        with temporary_path.open("wb") as f:
+            pickle.dump(
+                (self.node_ids, self.forward, self.backward, self.middle, self.fingerprint),
+                f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary_path, path)
+
+    @classmethod
+    def load(cls, path: Path) -> "ContractionHierarchy":
+        with Path(path).open("rb") as f:
+            return cls(*pickle.load(f))
+
+    def _index(self, node: Hashable) -> int:
+        try:
+            return self.node_index[node]
+        except KeyError:
+            raise nx.NodeNotFound(f"{node}")
+
+    def _upward_search(self, source: int, edges: List[List[Tuple[int, float]]]) -> Dict[int, float]:
+        """Distances to every node reachable upwards from `source`"""
+        distances = {source: 0}
+        heap = [(0, source)]
+        while heap:
+            distance, node = heapq.heappop(heap)
+            if distance > distances[node]:
+                continue
+            for neighbour, length in edges[node]:
+                candidate = distance + length
+                if candidate < distances.get(neighbour, math.inf):
+                    distances[neighbour] = candidate
+                    heapq.heappush(heap, (candidate, neighbour))
+        return distances
+
+    def _query(self, source: Hashable, target: Hashable):
+        """Bidirectional upward Dijkstra, each direction stops once it cannot improve the best meeting"""
+        source, target = self._index(source), self._index(target)
+        distances = ({source: 0}, {target: 0})
+        parents: Tuple[Dict[int, int], Dict[int, int]] = ({}, {})
+        heaps = ([(0, source)], [(0, target)])
+        edges = (self.forward, self.backward)
+        best, meeting_node = (0, source) if source == target else (math.inf, None)
+
+        while any(heaps):
+            # Expand the direction with the smaller frontier
+            direction = 0 if heaps[0] and (not heaps[1] or heaps[0][0] <= heaps[1][0]) else 1
+            distance, node = heapq.heappop(heaps[direction])
+            if distance >= best:
+                heaps[direction].clear()
+                continue
+            if distance > distances[direction][node]:
+                continue
+
+            other_distance = distances[1 - direction].get(node)
+            if other_distance is not None and distance + other_distance < best:
+                best, meeting_node = distance + other_distance, node
+
+            for neighbour, length in edges[direction][node]:
+                candidate = distance + length
+                if candidate < distances[direction].get(neighbour, math.inf):
+                    distances[direction][neighbour] = candidate
+                    parents[direction][neighbour] = node
+                    heapq.heappush(heaps[direction], (candidate, neighbour))
+
+        return best, meeting_node, parents[0], parents[1]
+
+    def _unpack(self, a: int, b: int) -> List[int]:
+        """Original nodes after `a` on the edge a -> b, expanding shortcuts"""
+        nodes = []
+        stack = [(a, b)]
+        while stack:
+            u, w = stack.pop()
+            node = self.middle.get((u, w))
+            if node is None:
+                nodes.append(w)
+            else:
+                stack.append((node, w))
+                stack.append((u, node))
+        return nodes
+
+
+
+@functools.lru_cache(maxsize=16)
+def load_hierarchy(path: str) -> ContractionHierarchy:
+    """Loads each stored hierarchy once per process, processes forked afterwards inherit it"""
+    return ContractionHierarchy.load(Path(path))
+
+
+@click.command(context_settings=dict(max_content_width=600))
+@click.option("--graph-cache", type=click.Path(file_okay=False, exists=True), help="Graph cache directory")
+@click.option("--mapped-graph", type=click.Path(file_okay=False, exists=True), help="Mapped graph directory")
+def _cli(graph_cache, mapped_graph):
+    """Builds the hierarchy of every cached graph, or of a mapped region, that does not have one yet"""
+    from running_routes.graph_cache import GraphCache
+    from running_routes.network import MappedNetwork, OSMNetwork
+
+    if mapped_graph:
+        network = MappedNetwork(mapped_graph, contraction_hierarchy=True)
+        if network.hierarchy is None:
+            network.preprocess()
+        click.echo(f"Built the hierarchy of {mapped_graph}", err=True)
+    if graph_cache:
+        cache = GraphCache(graph_cache)
+        for entry in cache.entries():
+            key = Path(entry["file"]).stem
+            if not cache.sidecar(key, OSMNetwork.HIERARCHY_FILE).exists():
+                OSMNetwork.build_region_hierarchy(cache, key)
+                click.echo(f"Built the hierarchy of {key}", err=True)
+
+
+if __name__ == "__main__":
+    _cli()
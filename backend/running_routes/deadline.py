@@ -0,0 +1,34 @@
+"""End-to-end deadlines, shared out across the pipeline stages"""
+import time
+
+from typing import Dict, List, Optional
+
+# Share of the time left after the network is created that the model may use,
+# the local search and assembler get the rest
+MODEL_SHARE = 0.8
+
+
+class Deadline:
+    """Seconds left until a deadline, and the degradations made to meet it
+
+    `split` hands a stage a share of the time left. The stage's deadline records
+    its degradations in the same list, so they are all reported together.
+    """
+
+    def __init__(self, seconds: float, degradations: Optional[List[Dict]] = None):
+        self.seconds = seconds
+        self.start = time.perf_counter()
+        self.degradations: List[Dict] = degradations if degradations is not None else []
+
+    def remaining(self) -> float:
+        return max(0.0, self.seconds - (time.perf_counter() - self.start))
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def split(self, share: float) -> "Deadline":
+        return Deadline(self.remaining()*share, self.degradations)
+
+    def degrade(self, stage: str, parameter: str, requested, used) -> None:
+        """Records that `parameter` of `stage` was lowered from `requested` to `used`"""
+        self.degradations.append({"stage": stage, "parameter": parameter, "requested": requested, "used": used})
@@ -0,0 +1,40 @@
+"""Distances and extents on the earth's surface
+
+Only needs numpy and the standard library, so modules that avoid importing osmnx, e.g. the graph
+cache, the mapped graph and the route catalogue, share it.
+"""
+import math
+
+import numpy as np
+
+from typing import Tuple
+
+# Mean radius of the earth in meters, as used by osmnx
+EARTH_RADIUS = 6_371_009
+
+# Meters in one degree of latitude
+METERS_PER_DEGREE = math.radians(EARTH_RADIUS)
+
+
+def great_circle_vec(lat1, lng1, lat2, lng2) -> np.ndarray:
+    """Haversine distance in meters, without importing osmnx"""
+    phi1, phi2 = np.radians(lat1), np.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = np.radians(np.asarray(lng2) - lng1)
+    h = np.sin(d_phi/2)**2 + np.cos(phi1)*np.cos(phi2)*np.sin(d_lambda/2)**2
+    return 2*EARTH_RADIUS*np.arcsin(np.minimum(1, np.sqrt(h)))
+
+
+def great_circle(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+    """`great_circle_vec` of a single pair of points, without numpy's overhead"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(lng2 - lng1)
+    h = math.sin(d_phi/2)**2 + math.cos(phi1)*math.cos(phi2)*math.sin(d_lambda/2)**2
+    return 2*EARTH_RADIUS*math.asin(min(1, math.sqrt(h)))
+
+
+def degree_deltas(lat: float, meters: float) -> Tuple[float, float]:
+    """Degrees of latitude and of longitude spanning `meters` at latitude `lat`"""
+    lat_delta = math.degrees(meters/EARTH_RADIUS)
+    return lat_delta, lat_delta/max(math.cos(math.radians(lat)), 1e-6)
@@ -0,0 +1,198 @@
+"""On-disk cache of downloaded graphs, reused by any request whose circle they contain"""
+from contextlib import contextmanager
+import fcntl
+import json
+import os
+from pathlib import Path
+import pickle
+import threading
+import time
+import uuid
+
+from running_routes.geometry import great_circle
+
+from typing import Dict, Iterator, List, Optional, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import networkx as nx
+
+GRAPH_CACHE_DEFAULT_PARAMETERS = {
+    "max_bytes": 2*1024**3,
+    "ttl": 7*24*60*60,
+    # Seconds between writes of the entries' last use
+    "flush_interval": 10,
+}
+
+
+class GraphCache:
+    """Caches downloaded graphs by center and radius
+
+    A request is served from the smallest cached graph of the same network type whose
+    circle contains the request's circle, the caller then truncates it to the request.
+    Entries older than `ttl` seconds are refreshed by downloading them again, and the
+    least recently used entries are evicted once the cache exceeds `max_bytes`.
+
+    Several processes can share a directory. Lookups only read the index, which is replaced
+    atomically. Writes update it under an exclusive `flock` of `LOCK_FILE`, and remove files
+    the index does not list, e.g. of a writer that crashed, so every file counts towards
+    `max_bytes`. The last use of each entry is kept in memory and written with the next
+    `put`, or by a lookup at most every `flush_interval` seconds. Expired entries are skipped by
+    lookups and removed by the next `put`.
+
+    An entry's key identifies its region, data derived from the region's graph, e.g. its
+    contraction hierarchy, is stored next to it under `sidecar` and removed with it.
+    """
+
+    INDEX_FILE = "index.json"
+    LOCK_FILE = "index.lock"
+
+    def __init__(self, directory: Path, **parameters):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.parameters = parameters
+
+        # Set default parameters
+        for key, value in GRAPH_CACHE_DEFAULT_PARAMETERS.items():
+            if key not in self.parameters:
+                self.parameters[key] = value
+
+        # Serialises this process' threads, `flock` serialises the processes
+        self._lock = threading.Lock()
+        # Last use of the entries found since the last write
+        self._last_used: Dict[str, float] = {}
+        self._flushed = time.time()
+
+    def get(self, start_coordinate: Dict, radius: float, network_type: str) -> Optional["nx.MultiDiGraph"]:
+        key = self.find(start_coordinate, radius, network_type)
+        return self.load(key) if key is not None else None
+
+    def find(self, start_coordinate: Dict, radius: float, network_type: str) -> Optional[str]:
+        """Key of the smallest entry containing the request, which also identifies its region"""
+        now = time.time()
+        entries = [
+            (key, entry) for key, entry in self._read_index().items()
+            if entry["network_type"] == network_type and now - entry["created"] <= self.parameters["ttl"]
+            and _contains(entry, start_coordinate, radius)
+        ]
+        key = min(entries, key=lambda item: item[1]["radius"])[0] if entries else None
+        with self._lock:
+            if key is not None:
+                self._last_used[key] = now
+            flush = bool(self._last_used) and now - self._flushed >= self.parameters["flush_interval"]
+        if flush:
+            # Writes the recorded last uses
+            with self._index():
+                pass
+        return key
+
+    def load(self, key: str) -> Optional["nx.MultiDiGraph"]:
+        try:
+            with (self.directory / f"{key}.pickle").open("rb") as f:
+                return pickle.load(f)
+        except FileNotFoundError:
+            # Evicted by another process since the index was read
+            return None
+
+    def put(self, start_coordinate: Dict, radius: float, network_type: str, G: "nx.MultiDiGraph") -> str:
+        key = uuid.uuid4().hex
+        file = f"{key}.pickle"
+        data = pickle.dumps(G, protocol=pickle.HIGHEST_PROTOCOL)
+
+        # Written under the lock, so any file the index does not list is an orphan
+        with self._index() as index:
+            _atomic_write(self.directory / file, data)
+            now = time.time()
+            index[key] = {
+                "file": file,
+                "lat": start_coordinate["lat"],
+                "lng": start_coordinate["lng"],
+                "radius": radius,
+                "network_type": network_type,
+                "bytes": len(data),
+                "created": now,
+                "last_used": now,
+            }
+            self._expire(index)
+            self._evict(index)
+        return key
+
+    def sidecar(self, key: str, name: str) -> Path:
+        """Path of data derived from an entry's graph, removed along with the entry"""
+        return self.directory / f"{key}.{name}"
+
+    def entries(self) -> List[Dict]:
+        now = time.time()
+        return [entry for entry in self._read_index().values() if now - entry["created"] <= self.parameters["ttl"]]
+
+    @contextmanager
+    def _index(self) -> Iterator[Dict]:
+        """The index, locked across processes and written back with the recorded last uses"""
+        with self._lock, (self.directory / self.LOCK_FILE).open("a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                index = self._read_index()
+                for key, last_used in self._last_used.items():
+                    if key in index:
+                        index[key]["last_used"] = max(index[key]["last_used"], last_used)
+                yield index
+                self._remove_orphans(index)
+                self._write_index(index)
+                self._last_used = {}
+                self._flushed = time.time()
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _expire(self, index: Dict) -> None:
+        now = time.time()
+        for key, entry in list(index.items()):
+            if now - entry["created"] > self.parameters["ttl"]:
+                self._remove(index, key)
+
+    def _evict(self, index: Dict) -> None:
+        total_bytes = sum(entry["bytes"] for entry in index.values())
+        for key, entry in sorted(index.items(), key=lambda item: item[1]["last_used"]):
+            if total_bytes <= self.parameters["max_bytes"]:
+                break
+            total_bytes -= entry["bytes"]
+            self._remove(index, key)
+
+    def _remove(self, index: Dict, key: str) -> None:
+        index.pop(key)
+        for path in self.directory.glob(f"{key}.*"):
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+
+    def _remove_orphans(self, index: Dict) -> None:
+        """Deletes the entries' files and sidecars that the index lost"""
+        for path in self.directory.iterdir():
+            if path.name.startswith(".") or path.name in (self.INDEX_FILE, self.LOCK_FILE):
+                continue
+            if path.name.split(".", 1)[0] not in index:
+                try:
+                    path.unlink()
+                except FileNotFoundError:
+                    pass
+
+    def _read_index(self) -> Dict:
+        try:
+            with (self.directory / self.INDEX_FILE).open() as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _write_index(self, index: Dict) -> None:
+        _atomic_write(self.directory / self.INDEX_FILE, json.dumps(index).encode())
+
+
+def _contains(entry: Dict, start_coordinate: Dict, radius: float) -> bool:
+    """Whether the entry's circle contains the circle of `radius` around `start_coordinate`"""
+    offset = great_circle(entry["lat"], entry["lng"], start_coordinate["lat"], start_coordinate["lng"])
+    return offset + radius <= entry["radius"]
+
+
+def _atomic_write(path: Path, data: bytes) -> None:
+    temporary_path = path.with_name(f".{path.name}.{uuid.uuid4().hex}")
+    temporary_path.write_bytes(data)
+    os.replace(temporary_path, path)
@@ -1,10 +1,11 @@
 from abc import ABC, abstractmethod
 
-import networkx as nx
+import numpy as np
 
 from running_routes.network import NetworkFactory
+from running_routes.tour import Tour, as_tours
 
-from typing import List, Optional
+from typing import List
 
 
 class LocalSearchFactory(ABC):
@@ -14,8 +15,8 @@ class LocalSearchFactory(ABC):
 
     @abstractmethod
     def iterate(
-            self, tours: List[List], distance: int, network: NetworkFactory
-    ) -> List[List]:
+            self, tours: List[Tour], distance: int, network: NetworkFactory
+    ) -> List[Tour]:
         """Takes a set of routes and reoptimises them"""
 
 
@@ -32,23 +33,20 @@ class BacktrackEliminationLocalSearch(LocalSearchFactory):
         self.parameters = parameters
 
     def iterate(
-            self, tours: List[List], distance: int, network: NetworkFactory) -> List[List]:
+            self, tours: List[Tour], distance: int, network: NetworkFactory) -> List[Tour]:
+        tours = as_tours(tours, network)
         output_tours = []
         start_node = tours[0][0]
         for tour in tours:
+            nodes = tour.nodes().tolist()
+            piecewise_paths = [np.asarray(network.path(source, target)) for source, target in zip(nodes, nodes[1:])]
+
             backtrack_elimination_tour = []
-            piecewise_paths = []
-            for source, target in zip(tour, tour[1:]):
-                piecewise_paths.append(network.path(source, target))
-            
             for path1, path2 in zip(piecewise_paths, piecewise_paths[1:]):
-                try:
-                    first_divergence_index = next(
-                        index 
-                        for index, (node1, node2) in enumerate(zip(path1[::-1], path2))
-                        if node1 != node2)
-                except StopIteration:
-                    first_divergence_index = 1
-                backtrack_elimination_tour.append(path2[first_divergence_index-1])
-            output_tours.append(backtrack_elimination_tour + [start_node]) 
-        return output_tours
\ No newline at end of file
+                # Walking back along path1 while walking out along path2 is a backtrack
+                overlap = min(len(path1), len(path2))
+                divergences = np.flatnonzero(path1[::-1][:overlap] != path2[:overlap])
+                first_divergence_index = divergences[0] if len(divergences) else 1
+                backtrack_elimination_tour.append(path2[first_divergence_index-1].item())
+            output_tours.append(Tour.from_nodes(backtrack_elimination_tour + [start_node], network))
+        return output_tours
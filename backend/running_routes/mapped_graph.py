@@ -0,0 +1,174 @@
+"""Read-only regional graphs stored as memory-mapped arrays
+
+A regional graph is written once with `write_mapped_graph`, as a directory of `.npy` arrays
+- `node_ids`: OSM node ids, sorted so ids are looked up by binary search without a dict
+- `coordinates`: (lat, lng) of each node
+- `indptr`, `indices`, `lengths`: outgoing edges in compressed sparse row form, parallel edges
+  collapse to the shortest one
+- `cell_keys`, `cell_offsets`, `cell_nodes`: a grid index of the nodes in each `cell_size` degree cell
+
+`MappedGraph` maps the arrays read-only instead of reading them, so opening one takes milliseconds
+and every worker process shares the same pages of the operating system's page cache. Writing the
+region again swaps in a new version atomically, see `running_routes.array_store`.
+"""
+import functools
+import math
+from pathlib import Path
+import uuid
+
+import click
+import numpy as np
+import scipy.sparse
+from scipy.sparse import csgraph
+
+from running_routes.array_store import read_arrays, write_arrays
+from running_routes.geometry import degree_deltas, great_circle_vec
+
+from typing import Dict, Tuple, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import networkx as nx
+
+# Degrees, about 550m north to south
+CELL_SIZE = 0.005
+
+ARRAYS = ("node_ids", "coordinates", "indptr", "indices", "lengths", "cell_keys", "cell_offsets", "cell_nodes")
+
+# Cell rows and columns are packed into one key, offset so they are never negative
+_CELL_OFFSET = 2**24
+_CELL_STRIDE = 2**25
+
+
+class MappedGraph:
+    def __init__(self, directory: Path):
+        # The version mapped, data derived from it, e.g. its contraction hierarchy, is stored next to the arrays
+        self.directory, self.meta, arrays = read_arrays(directory, ARRAYS)
+        for name, array in arrays.items():
+            setattr(self, name, array)
+        self.cell_size = self.meta["cell_size"]
+        self.version: str = self.meta["version"]
+
+    def __len__(self) -> int:
+        return len(self.node_ids)
+
+    def positions(self, nodes) -> np.ndarray:
+        """Positions of the node ids `nodes`, raises KeyError for unknown nodes"""
+        nodes = np.asarray(nodes, dtype=np.int64)
+        positions = np.searchsorted(self.node_ids, nodes)
+        found = positions < len(self.node_ids)
+        found[found] = self.node_ids[positions[found]] == nodes[found]
+        if not found.all():
+            raise KeyError(nodes[~found][0].item())
+        return positions
+
+    def within(self, lat: float, lng: float, radius: float) -> np.ndarray:
+        """Sorted positions of the nodes within `radius` meters, found through the grid index"""
+        lat_delta, lng_delta = degree_deltas(lat, radius)
+        row_min, col_min = _cell(lat - lat_delta, self.cell_size), _cell(lng - lng_delta, self.cell_size)
+        row_max, col_max = _cell(lat + lat_delta, self.cell_size), _cell(lng + lng_delta, self.cell_size)
+
+        # Cells of a row are contiguous in `cell_keys`, so each row is a single slice
+        chunks = []
+        for row in range(row_min, row_max + 1):
+            start = np.searchsorted(self.cell_keys, _cell_key(row, col_min))
+            end = np.searchsorted(self.cell_keys, _cell_key(row, col_max), side="right")
+            if start < end:
+                chunks.append(self.cell_nodes[self.cell_offsets[start]:self.cell_offsets[end]])
+        if not chunks:
+            return np.empty(0, dtype=np.int64)
+
+        candidates = np.sort(np.concatenate(chunks))
+        distances = great_circle_vec(lat, lng, self.coordinates[candidates, 0], self.coordinates[candidates, 1])
+        return candidates[distances <= radius]
+
+    def subgraph(self, positions: np.ndarray) -> scipy.sparse.csr_matrix:
+        """Adjacency matrix between the sorted `positions`, indexed by place in `positions`"""
+        starts, ends = self.indptr[positions], self.indptr[positions + 1]
+        counts = ends - starts
+        # Edge indices of every row, gathered without a Python loop
+        first_edges = np.repeat(starts - np.concatenate(([0], np.cumsum(counts)[:-1])), counts)
+        edges = np.arange(counts.sum()) + first_edges
+        rows = np.repeat(np.arange(len(positions)), counts)
+
+        targets = self.indices[edges]
+        columns = np.minimum(np.searchsorted(positions, targets), len(positions) - 1)
+        inside = positions[columns] == targets
+        return scipy.sparse.csr_matrix(
+            (self.lengths[edges][inside], (rows[inside], columns[inside])),
+            shape=(len(positions), len(positions)))
+
+
+@functools.lru_cache(maxsize=None)
+def open_mapped_graph(directory: str) -> MappedGraph:
+    """Opens each directory once per process, processes forked afterwards inherit the mapping"""
+    return MappedGraph(Path(directory))
+
+
+def write_mapped_graph(G: "nx.MultiDiGraph", directory: Path, cell_size: float = CELL_SIZE) -> Path:
+    """Writes the arrays of `G`, whose nodes must be integer ids with `y` and `x` coordinates"""
+    node_ids = np.array(sorted(G.nodes), dtype=np.int64)
+    coordinates = np.array(
+        [(G.nodes[node]["y"], G.nodes[node]["x"]) for node in node_ids.tolist()], dtype=np.float64).reshape(-1, 2)
+
+    shortest: Dict[Tuple, float] = {}
+    for u, v, length in G.edges(data="length"):
+        if u != v and length < shortest.get((u, v), math.inf):
+            shortest[u, v] = length
+    sources = np.searchsorted(node_ids, np.array([u for u, _ in shortest], dtype=np.int64))
+    targets = np.searchsorted(node_ids, np.array([v for _, v in shortest], dtype=np.int64))
+    lengths = np.array(list(shortest.values()), dtype=np.float64)
+    order = np.lexsort((targets, sources))
+    indptr = np.concatenate(([0], np.cumsum(np.bincount(sources, minlength=len(node_ids))))).astype(np.int64)
+
+    keys = _cell_key(_cell(coordinates[:, 0], cell_size), _cell(coordinates[:, 1], cell_size))
+    cell_nodes = np.argsort(keys, kind="stable")
+    cell_keys, counts = np.unique(keys[cell_nodes], return_counts=True)
+    cell_offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+
+    arrays = {
+        "node_ids": node_ids,
+        "coordinates": coordinates,
+        "indptr": indptr,
+        "indices": targets[order].astype(np.int64),
+        "lengths": lengths[order],
+        "cell_keys": cell_keys.astype(np.int64),
+        "cell_offsets": cell_offsets,
+        "cell_nodes": cell_nodes.astype(np.int64),
+    }
+    # Data derived from the region, e.g. stored shortest paths, is invalidated by a new version
+    meta = {"cell_size": cell_size, "nodes": len(node_ids), "edges": len(lengths), "version": uuid.uuid4().hex}
+
+    # A new version, swapped in atomically, so readers never find a partial or missing graph
+    return write_arrays(directory, arrays, meta)
+
+
+def largest_component(matrix: scipy.sparse.csr_matrix) -> np.ndarray:
+    """Mask of the largest weakly connected component, as kept by `OSMNetwork`"""
+    _, labels = csgraph.connected_components(matrix, directed=True, connection="weak")
+    return labels == np.argmax(np.bincount(labels))
+
+
+def _cell(degrees, cell_size: float):
+    return np.floor(np.asarray(degrees)/cell_size).astype(np.int64)
+
+
+def _cell_key(row, column):
+    return (np.asarray(row, dtype=np.int64) + _CELL_OFFSET)*_CELL_STRIDE + np.asarray(column, dtype=np.int64) + _CELL_OFFSET
+
+
+@click.command(context_settings=dict(max_content_width=600))
+@click.option("--lat", type=float, required=True)
+@click.option("--lng", type=float, required=True)
+@click.option("--distance", type=click.IntRange(1), required=True, help="Radius of the region in meters")
+@click.option("--network-type", default="walk", show_default=True)
+@click.option("--output", type=click.Path(file_okay=False), required=True)
+def _cli(lat, lng, distance, network_type, output):
+    """Downloads a region from OSM and writes it as a mapped graph"""
+    import osmnx
+    G = osmnx.graph_from_point((lat, lng), dist=distance, network_type=network_type)
+    directory = write_mapped_graph(G, Path(output))
+    click.echo(f"Wrote {G.number_of_nodes()} nodes and {G.number_of_edges()} edges to {directory}", err=True)
+
+
+if __name__ == "__main__":
+    _cli()
@@ -0,0 +1,216 @@
+"""Stage timers and counters for pipeline requests, exported in the Prometheus text format
+
+https://prometheus.io/docs/instrumenting/exposition_formats/
+"""
+from contextlib import contextmanager
+import resource
+import sys
+import threading
+import time
+
+from typing import Dict, Iterator, List, Optional, Tuple
+
+# Seconds, from a cached request to a solver that runs out its time limit
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 15, 30, 60)
+
+# Callers served by each coalesced pipeline computation
+WAITER_BUCKETS = (1, 2, 5, 10, 25, 50, 100)
+
+# `ru_maxrss` is in kilobytes on Linux and bytes on macOS
+_MAXRSS_UNIT = 1 if sys.platform == "darwin" else 1024
+
+
+def max_resident_bytes() -> int:
+    """Peak resident memory of this process"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * _MAXRSS_UNIT
+
+
+@contextmanager
+def timed(statistics: Dict, key: str) -> Iterator[None]:
+    """Adds the seconds spent in the block to `statistics[key]`"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        statistics[key] = statistics.get(key, 0) + time.perf_counter() - start
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (), buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._values: Dict[Tuple, Dict] = {}
+
+    def observe(self, value: float, *label_values: str) -> None:
+        series = self._values.setdefault(
+            label_values, {"buckets": [0]*len(self.buckets), "sum": 0.0, "count": 0})
+        for i, bucket in enumerate(self.buckets):
+            if value <= bucket:
+                series["buckets"][i] += 1
+        series["sum"] += value
+        series["count"] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for label_values, series in sorted(self._values.items()):
+            for bucket, count in zip(self.buckets, series["buckets"]):
+                lines.append(f"{self.name}_bucket{_labels(self.labels, label_values, le=bucket)} {count}")
+            lines.append(f"""{self.name}_bucket{_labels(self.labels, label_values, le="+Inf")} {series["count"]}""")
+            lines.append(f"""{self.name}_sum{_labels(self.labels, label_values)} {series["sum"]}""")
+            lines.append(f"""{self.name}_count{_labels(self.labels, label_values)} {series["count"]}""")
+        return lines
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (), kind: str = "counter"):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.kind = kind
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, value: float = 1, *label_values: str) -> None:
+        self._values[label_values] = self._values.get(label_values, 0) + value
+
+    def set(self, value: Optional[float], *label_values: str) -> None:
+        """`None`, e.g. the objective of a model without a solution, removes the series"""
+        if value is None:
+            self._values.pop(label_values, None)
+        else:
+            self._values[label_values] = value
+
+    def clear(self) -> None:
+        self._values = {}
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for label_values, value in sorted(self._values.items()):
+            # Not a valid sample value
+            if value is None:
+                continue
+            lines.append(f"{self.name}{_labels(self.labels, label_values)} {value}")
+        return lines
+
+
+def Gauge(name: str, help: str, labels: Tuple[str, ...] = ()) -> Counter:
+    return Counter(name, help, labels, kind="gauge")
+
+
+class Registry:
+    """Process wide metrics, shared by every request thread"""
+
+    def __init__(self, prefix: str = "running_routes"):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self.requests = Counter(f"{prefix}_requests_total", "Pipeline requests", ("status",))
+        self.request_seconds = Histogram(f"{prefix}_request_seconds", "End to end pipeline latency")
+        self.stage_seconds = Histogram(f"{prefix}_stage_seconds", "Latency of each pipeline stage", ("stage",))
+        self.counters = Counter(f"{prefix}_events_total", "Events counted during pipeline requests", ("event",))
+        self.last_request = Gauge(f"{prefix}_last_request", "Gauges recorded by the latest request", ("gauge",))
+        self.max_resident_bytes = Gauge(f"{prefix}_max_resident_bytes", "Peak resident memory of the process")
+        self.flight_callers = Histogram(
+            f"{prefix}_flight_callers", "Requests served by each pipeline computation", buckets=WAITER_BUCKETS)
+        # Aggregated over the in-flight computations, a series per request key would be unbounded
+        self.in_flight = Gauge(f"{prefix}_in_flight", "Pipeline computations in flight")
+        self.in_flight_waiters = Gauge(
+            f"{prefix}_in_flight_waiters", "Requests waiting on an in-flight pipeline computation")
+
+    def observe(self, metrics: "PipelineMetrics", status: str = "ok") -> None:
+        with self._lock:
+            self.requests.inc(1, status)
+            self.request_seconds.observe(metrics.total_seconds)
+            for stage, seconds in metrics.stage_seconds.items():
+                self.stage_seconds.observe(seconds, stage)
+            for event, count in metrics.counters.items():
+                self.counters.inc(count, event)
+            for gauge, value in metrics.gauges.items():
+                self.last_request.set(value, gauge)
+            self.max_resident_bytes.set(max_resident_bytes())
+
+    def observe_flight(self, callers: int) -> None:
+        """Callers after the first shared its computation, which `observe` already counted"""
+        with self._lock:
+            self.flight_callers.observe(callers)
+            if callers > 1:
+                self.requests.inc(callers - 1, "coalesced")
+
+    def render(self, in_flight_waiters: Optional[Dict[str, int]] = None) -> str:
+        """`in_flight_waiters`, the waiters of each in-flight computation, are exported as totals"""
+        with self._lock:
+            self.max_resident_bytes.set(max_resident_bytes())
+            in_flight_waiters = in_flight_waiters or {}
+            self.in_flight.set(len(in_flight_waiters))
+            self.in_flight_waiters.set(sum(in_flight_waiters.values()))
+            metrics = [
+                self.requests, self.request_seconds, self.stage_seconds,
+                self.counters, self.last_request, self.max_resident_bytes,
+                self.flight_callers, self.in_flight, self.in_flight_waiters]
+            lines = [line for metric in metrics for line in metric.render()]
+        return "\n".join(lines) + "\n"
+
+
+class PipelineMetrics:
+    """Timings, counters and gauges of a single pipeline request
+
+    Stages are timed by the pipeline, the network and model report finer grained
+    `statistics` which are folded in with `record_statistics`. Keys ending in `_seconds`
+    become sub-stages, keys ending in `_total` become counters and everything else a gauge.
+    """
+
+    def __init__(self):
+        self.stage_seconds: Dict[str, float] = {}
+        self.stage_memory: Dict[str, int] = {}
+        self.counters: Dict[str, float] = {}
+        self.gauges: Dict[str, float] = {}
+        self.degradations: List[Dict] = []
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        start_memory = max_resident_bytes()
+        with timed(self.stage_seconds, name):
+            yield
+        self.stage_memory[name] = max_resident_bytes() - start_memory
+
+    def record_statistics(self, stage: str, statistics: Optional[Dict]) -> None:
+        for key, value in (statistics or {}).items():
+            if key.endswith("_seconds"):
+                self.stage_seconds[f"{stage}.{key[:-len('_seconds')]}"] = value
+            elif key.endswith("_total"):
+                name = f"{stage}.{key[:-len('_total')]}"
+                self.counters[name] = self.counters.get(name, 0) + value
+            else:
+                self.gauges[f"{stage}.{key}"] = value
+
+    def record_degradations(self, deadline: float, degradations: List[Dict]) -> None:
+        """Parameters lowered to meet a `deadline` of that many seconds"""
+        self.gauges["deadline.seconds"] = deadline
+        self.counters["deadline.degradations"] = self.counters.get("deadline.degradations", 0) + len(degradations)
+        self.degradations.extend(degradations)
+
+    @property
+    def total_seconds(self) -> float:
+        """Sub-stages, named `stage.sub_stage`, are already part of their stage"""
+        return sum(seconds for stage, seconds in self.stage_seconds.items() if "." not in stage)
+
+    def as_dict(self) -> Dict:
+        return {
+            "total_seconds": self.total_seconds,
+            "stage_seconds": self.stage_seconds,
+            "stage_memory_bytes": self.stage_memory,
+            "counters": self.counters,
+            "gauges": self.gauges,
+            "degradations": self.degradations,
+        }
+
+
+def _labels(names: Tuple[str, ...], values: Tuple, **extra) -> str:
+    pairs = list(zip(names, values)) + list(extra.items())
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
@@ -1,21 +1,43 @@
 from abc import ABC, abstractmethod
+from collections import OrderedDict
+import hashlib
 import itertools
 import math
+import threading
 
-import networkx as nx
+import numpy as np
 from ortools.constraint_solver import routing_enums_pb2
 from ortools.constraint_solver import pywrapcp
-import osmnx
-import shapely
+import shapely.geometry
 from sklearn.cluster import KMeans
 
+from running_routes.deadline import Deadline
+from running_routes.geometry import EARTH_RADIUS
+from running_routes.metrics import timed
 from running_routes.network import NetworkFactory
+from running_routes.tour import Tour
 
 from typing import Dict, List, Tuple, Optional
 
+# Sizing samples under a deadline
+# - a single source Dijkstra costs about this much per graph node, networks with faster queries only do better
+# - at most this share of the model's time is spent on shortest paths between samples
+DIJKSTRA_SECONDS_PER_NODE = 1e-5
+SHORTEST_PATH_SHARE = 0.3
+MIN_SAMPLE_SIZE = 10
+MIN_SOLVER_SECONDS = 0.1
+
+# KMeans centres of this many recent (graph, sample size) pairs are kept, so repeated
+# requests on the same graph, e.g. a warmed hot region, skip the clustering
+KMEANS_CACHE_SIZE = 64
+
+# Under a deadline, the sample may grow up to `adaptive_sample_percent` of the nodes and
+# `adaptive_max_sample_size` when the time allows, and shrinks below the usual size when it does not
 CP_DEFAULT_PARAMETERS = {
     "sample_percent": 0.2,
     "max_sample_size": 100,
+    "adaptive_sample_percent": 0.5,
+    "adaptive_max_sample_size": 200,
     "seed": 1234,
     "time_limit": 10
 }
@@ -28,8 +50,18 @@ class ModelFactory(ABC):
         """Load parameters"""
 
     @abstractmethod
-    def solve(self, n: int, distance: int, start_coordinate: Dict, network: NetworkFactory) -> List[List]:
-        """Creates and solves the model"""
+    def solve(
+            self, n: int, distance: int, start_coordinate: Dict, network: NetworkFactory,
+            deadline: Optional[Deadline] = None) -> List[Tour]:
+        """Creates and solves the model, adapting its effort to `deadline` when given"""
+
+    def sample(self, start_coordinate: Dict, network: NetworkFactory, deadline: Optional[Deadline] = None) -> List:
+        """Returns the start node followed by the sample nodes the model routes between"""
+        sample_size = adaptive_sample_size(len(network.coordinates), self.parameters, deadline)
+        sample_coordinates = self._downsample(
+            network, self.parameters["sample_percent"], self.parameters["max_sample_size"], self.parameters["seed"],
+            sample_size=sample_size)
+        return self._find_sample_nodes(start_coordinate, sample_coordinates, network)
 
 
 class CPModel(ModelFactory):
@@ -43,39 +75,62 @@ class CPModel(ModelFactory):
 
     def __init__(self, **parameters):
         self.parameters = parameters
+        self.statistics: Dict = {}
 
         # Set default parameters
         for key, value in CP_DEFAULT_PARAMETERS.items():
             if key not in self.parameters:
                 self.parameters[key] = value
 
-    def solve(self, n: int, distance: int, start_coordinate: Dict, network: NetworkFactory) -> List[List]:
-        sample_coordinates = self._downsample(
-            network, self.parameters["sample_percent"], self.parameters["max_sample_size"], self.parameters["seed"])
-        sample_nodes = self._find_sample_nodes(start_coordinate, sample_coordinates, network)
-        distance_matrix = self._construct_distance_matrix(sample_nodes, network)
-        manager, routing = self._construct_cp_model(n, distance, distance_matrix)
-        assignment = self._solve_cp_model(
-            routing, self.parameters["time_limit"])
+    def solve(
+            self, n: int, distance: int, start_coordinate: Dict, network: NetworkFactory,
+            deadline: Optional[Deadline] = None) -> List[Tour]:
+        self.statistics = {}
+        with timed(self.statistics, "downsample_seconds"):
+            sample_nodes = self.sample(start_coordinate, network, deadline)
+        with timed(self.statistics, "distance_matrix_seconds"):
+            distance_matrix = self._construct_distance_matrix(sample_nodes, network)
+        with timed(self.statistics, "solver_seconds"):
+            manager, routing = self._construct_cp_model(n, distance, distance_matrix)
+            time_limit = self.parameters["time_limit"]
+            if deadline:
+                # Guided local search always runs out its time limit
+                time_limit = max(MIN_SOLVER_SECONDS, min(time_limit, deadline.remaining()))
+                if time_limit < self.parameters["time_limit"]:
+                    deadline.degrade("model", "time_limit", self.parameters["time_limit"], round(time_limit, 3))
+            assignment = self._solve_cp_model(routing, time_limit)
         results = self._generate_results(
             n, sample_nodes, network,
             routing, manager,
             assignment)
+        # Leg lengths come from the network, whose distance matrix may hold shorter lengths over the
+        # region of a contraction hierarchy. Without one its rows are cached, so lookups are cheap
+        results = [Tour.from_nodes(tour, network) for tour in results]
+
+        # OR-tools search statistics
+        solver = routing.solver()
+        self.statistics.update({
+            "sample_size": len(sample_nodes),
+            "time_limit": time_limit,
+            "solver_status": routing.status(),
+            "objective": assignment.ObjectiveValue() if assignment else None,
+            "solver_branches_total": solver.Branches(),
+            "solver_failures_total": solver.Failures(),
+            "solver_solutions_total": solver.Solutions(),
+        })
         return results
 
-    def _downsample(self, network: NetworkFactory, sample_percent: float, max_sample_size: int, seed: int) -> List[Dict]:
-        """Downsample using KMeans"""
-        coordinates = [
-            [data["y"], data["x"]]
-            for _, data in network.nodes.items()
-        ]
-        percent_sample_size = int(len(coordinates)*sample_percent)
-        sample_size = percent_sample_size if percent_sample_size < max_sample_size else max_sample_size
-        kmeans = KMeans(n_clusters=sample_size,
-                        random_state=seed).fit(coordinates)
+    def _downsample(
+            self, network: NetworkFactory, sample_percent: float, max_sample_size: int, seed: int,
+            sample_size: Optional[int] = None) -> List[Dict]:
+        """Downsample using KMeans, `sample_size` overrides the size given by the percent and maximum"""
+        coordinates = network.coordinates
+        if sample_size is None:
+            percent_sample_size = int(len(coordinates)*sample_percent)
+            sample_size = percent_sample_size if percent_sample_size < max_sample_size else max_sample_size
         sample_coordinates = [
             {"lat": center[0], "lng": center[1]}
-            for center in kmeans.cluster_centers_
+            for center in kmeans_centers(coordinates, sample_size, seed)
         ]
         return sample_coordinates
 
@@ -91,18 +146,8 @@ class CPModel(ModelFactory):
         return sample_nodes
 
     def _construct_distance_matrix(self, sample_nodes: List, network: NetworkFactory) -> List[List[float]]:
-        # If there are no path between source and target, return `self.total_length`
-        distance_matrix = []
-        for source in sample_nodes:
-            distance_from_source = []
-            for target in sample_nodes:
-                try:
-                    length = network.length(source, target)
-                except nx.NodeNotFound:
-                    length = self.distance
-                distance_from_source.append(length)
-            distance_matrix.append(distance_from_source)
-
+        # Sample nodes come from the network, so every pair has a length
+        distance_matrix = network.lengths(sample_nodes, sample_nodes)
         return distance_matrix
 
     def _construct_cp_model(
@@ -153,7 +198,7 @@ class CPModel(ModelFactory):
             routing_enums_pb2.FirstSolutionStrategy.PATH_CHEAPEST_ARC)
         search_parameters.local_search_metaheuristic = (
             routing_enums_pb2.LocalSearchMetaheuristic.GUIDED_LOCAL_SEARCH)
-        search_parameters.time_limit.seconds = time_limit
+        search_parameters.time_limit.FromMilliseconds(int(time_limit*1000))
 
         assignment = routing.SolveWithParameters(search_parameters)
         return assignment
@@ -188,6 +233,8 @@ class CPModel(ModelFactory):
 SAVINGS_DEFAULT_PARAMETERS = {
     "sample_percent": 0.2,
     "max_sample_size": 100,
+    "adaptive_sample_percent": 0.5,
+    "adaptive_max_sample_size": 200,
     "seed": 1234,
     "max_node": 8
 }
@@ -201,40 +248,51 @@ class SavingsModel(ModelFactory):
 
     def __init__(self, **parameters):
         self.parameters = parameters
+        self.statistics: Dict = {}
 
         # Set default parameters
         for key, value in SAVINGS_DEFAULT_PARAMETERS.items():
             if key not in self.parameters:
                 self.parameters[key] = value
 
-    def solve(self, n: int, distance: int, start_coordinate: Dict, network: NetworkFactory) -> List[List]:
-        sample_coordinates = self._downsample(
-            network, self.parameters["sample_percent"], self.parameters["max_sample_size"], self.parameters["seed"])
-        sample_nodes = self._find_sample_nodes(start_coordinate, sample_coordinates, network)
-        savings = self._calculate_savings(sample_nodes, network)
+    def solve(
+            self, n: int, distance: int, start_coordinate: Dict, network: NetworkFactory,
+            deadline: Optional[Deadline] = None) -> List[Tour]:
+        self.statistics = {}
+        with timed(self.statistics, "downsample_seconds"):
+            sample_nodes = self.sample(start_coordinate, network, deadline)
+        with timed(self.statistics, "savings_seconds"):
+            savings = self._calculate_savings(sample_nodes, network)
 
         depot = sample_nodes[0]
         routes = [[depot, node, depot] for node in sample_nodes[1:]]
 
-        for saving in savings:
-            routes = self._merge_routes(saving, routes, network, self.parameters["max_node"], distance)
+        with timed(self.statistics, "merge_seconds"):
+            for saving in savings:
+                routes = self._merge_routes(saving, routes, network, self.parameters["max_node"], distance)
+
+        with timed(self.statistics, "circularity_filter_seconds"):
+            results = self._circularity_filter(n, routes, network)
+        results = [Tour.from_nodes(route, network) for route in results]
 
-        results = self._circularity_filter(n, routes, network)
+        self.statistics.update({
+            "sample_size": len(sample_nodes),
+            "merge_attempts_total": len(savings),
+            "merges_total": len(sample_nodes) - 1 - len(routes),
+        })
         return results
 
-    def _downsample(self, network: NetworkFactory, sample_percent: float, max_sample_size: int, seed: int) -> List[Dict]:
-        """Downsample using KMeans"""
-        coordinates = [
-            [data["y"], data["x"]]
-            for _, data in network.nodes.items()
-        ]
-        percent_sample_size = int(len(coordinates)*sample_percent)
-        sample_size = percent_sample_size if percent_sample_size < max_sample_size else max_sample_size
-        kmeans = KMeans(n_clusters=sample_size,
-                        random_state=seed).fit(coordinates)
+    def _downsample(
+            self, network: NetworkFactory, sample_percent: float, max_sample_size: int, seed: int,
+            sample_size: Optional[int] = None) -> List[Dict]:
+        """Downsample using KMeans, `sample_size` overrides the size given by the percent and maximum"""
+        coordinates = network.coordinates
+        if sample_size is None:
+            percent_sample_size = int(len(coordinates)*sample_percent)
+            sample_size = percent_sample_size if percent_sample_size < max_sample_size else max_sample_size
         sample_coordinates = [
             {"lat": center[0], "lng": center[1]}
-            for center in kmeans.cluster_centers_
+            for center in kmeans_centers(coordinates, sample_size, seed)
         ]
         return sample_coordinates
 
@@ -253,10 +311,10 @@ class SavingsModel(ModelFactory):
         # If there are no path between source and target, return `self.total_length`
         savings = {}
 
-        depot = sample_nodes[0]
-        for source, target in itertools.combinations(sample_nodes[1:], 2):
-            savings[source, target] = network.length(
-                depot, source) + network.length(target, depot) - network.length(source, target)
+        # One many-to-many query instead of a length query per pair
+        lengths = network.lengths(sample_nodes, sample_nodes)
+        for (i, source), (j, target) in itertools.combinations(list(enumerate(sample_nodes))[1:], 2):
+            savings[source, target] = lengths[0][i] + lengths[j][0] - lengths[i][j]
 
         # https://stackoverflow.com/a/613218
         sorted_savings = {edge: length for edge, length in sorted(savings.items(), key=lambda item: item[1])}
@@ -382,20 +440,65 @@ class SavingsModel(ModelFactory):
                 extended_route.extend(network.path(source, target))
             extended_route += [extended_route[0]]
             extended_route = [group[0] for group in itertools.groupby(extended_route)]
-
-            subgraph = network.graph.subgraph(extended_route)
-            projected_subgraph = osmnx.projection.project_graph(subgraph)
-            y_coordinates = nx.get_node_attributes(projected_subgraph, "y")
-            x_coordinates = nx.get_node_attributes(projected_subgraph, "x")
-
-            routes_to_xy = [
-                [x_coordinates[node], y_coordinates[node]]
-                for node in extended_route]
-            polygon = shapely.geometry.Polygon(routes_to_xy)
-            area = polygon.area
-            perimeter = polygon.length
-            measurement[i] = 4*math.pi * area / perimeter**2
+            measurement[i] = circularity(network.node_coordinates(extended_route))
         sorted_data = [i for i, _ in sorted(measurement.items(), key=lambda item: item[1], reverse=True)]
 
         results = [routes[i] for i in sorted_data[:n]]
-        return results
\ No newline at end of file
+        return results
+
+
+_kmeans_cache: "OrderedDict[Tuple, np.ndarray]" = OrderedDict()
+_kmeans_lock = threading.Lock()
+
+
+def kmeans_centers(coordinates: np.ndarray, sample_size: int, seed: int) -> np.ndarray:
+    """KMeans cluster centres of `coordinates`, cached by the coordinates' content"""
+    coordinates = np.ascontiguousarray(coordinates, dtype=np.float64)
+    key = (hashlib.sha1(coordinates.tobytes()).hexdigest(), len(coordinates), sample_size, seed)
+    with _kmeans_lock:
+        if key in _kmeans_cache:
+            _kmeans_cache.move_to_end(key)
+            return _kmeans_cache[key]
+    centers = KMeans(n_clusters=sample_size, random_state=seed).fit(coordinates).cluster_centers_
+    with _kmeans_lock:
+        _kmeans_cache[key] = centers
+        while len(_kmeans_cache) > KMEANS_CACHE_SIZE:
+            _kmeans_cache.popitem(last=False)
+    return centers
+
+
+def adaptive_sample_size(nodes: int, parameters: Dict, deadline: Optional[Deadline] = None) -> int:
+    """Number of nodes to sample from a graph of `nodes`
+
+    Without a deadline this is `sample_percent` of the nodes, at most `max_sample_size`. Under a deadline
+    it is as many as the shortest paths between them can afford, within the adaptive limits, and a
+    sample smaller than the usual size is recorded as a degradation.
+    """
+    sample_size = min(int(nodes*parameters["sample_percent"]), parameters["max_sample_size"])
+    if deadline is None:
+        return sample_size
+
+    affordable = int(deadline.remaining()*SHORTEST_PATH_SHARE/(DIJKSTRA_SECONDS_PER_NODE*max(nodes, 1)))
+    upper = min(int(nodes*parameters["adaptive_sample_percent"]), parameters["adaptive_max_sample_size"])
+    adaptive_size = max(1, min(affordable, upper), min(MIN_SAMPLE_SIZE, upper))
+    if adaptive_size < sample_size:
+        deadline.degrade("model", "sample_size", sample_size, adaptive_size)
+    return adaptive_size
+
+
+def circularity(coordinates: np.ndarray) -> float:
+    """Circularity of the polygon traced by (lat, lng) `coordinates`
+
+    https://sciencing.com/calculate-circularity-5138742.html
+    The coordinates are projected to meters around their centre with an equirectangular
+    projection, which is accurate enough at the size of a running route.
+    """
+    # A closed polygon needs at least three distinct points
+    if len(coordinates) < 4:
+        return 0
+    latitude = np.radians(coordinates[:, 0])
+    longitude = np.radians(coordinates[:, 1])
+    x = EARTH_RADIUS*longitude*math.cos(latitude.mean())
+    y = EARTH_RADIUS*latitude
+    polygon = shapely.geometry.Polygon(np.column_stack([x - x.mean(), y - y.mean()]))
+    return 4*math.pi * polygon.area / polygon.length**2
@@ -1,9 +1,48 @@
 from abc import ABC, abstractmethod, abstractproperty
+import itertools
+import math
+import random
+import sys
 
 import networkx as nx
+import numpy as np
 import osmnx
+import scipy.sparse
+from scipy.sparse import csgraph
+from sklearn.neighbors import BallTree
 
-from typing import Dict, List
+from running_routes.coarsening import coarsen_graph
+from running_routes.contraction import ContractionHierarchy, load_hierarchy
+from running_routes.graph_cache import GraphCache
+from running_routes.mapped_graph import largest_component, open_mapped_graph
+from running_routes.metrics import timed
+from running_routes.path_store import ShortestPathStore, region_row, slice_row
+from typing import Dict, Iterator, List, Mapping, Optional, Tuple, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from running_routes.tiled_fetch import TiledFetcher
+
+MAPPED_DEFAULT_PARAMETERS = {
+    "contraction_hierarchy": False,
+}
+
+OSM_DEFAULT_PARAMETERS = {
+    "contraction_hierarchy": False,
+    "compact": False,
+    "isochrone": False,
+    # Meters, areas wider than this are downloaded as tiles of this size in parallel
+    "tile_size": None,
+    "fetch_workers": 4,
+    "coarsen": False,
+    # Runs shorter than this are modelled on the full graph
+    "coarsen_min_distance": 3000,
+    # Super-node cells are `distance/coarsen_resolution` meters wide, so the coarse graph size is independent of distance
+    "coarsen_resolution": 80,
+}
+
+# Attributes the pipeline reads, `compact` graphs keep only these
+NODE_ATTRIBUTES = ("x", "y")
+EDGE_ATTRIBUTES = ("length",)
 
 
 class NetworkFactory(ABC):
@@ -23,16 +62,149 @@ class NetworkFactory(ABC):
     def nodes(self) -> Dict:
         """Returns node data"""
 
+    @abstractproperty
+    def coordinates(self) -> np.ndarray:
+        """Returns the (lat, lng) of every node, ordered by node position"""
+
+    @abstractproperty
+    def node_ids(self) -> np.ndarray:
+        """Returns the node id of every node, ordered by node position"""
+
+    @abstractmethod
+    def node_index(self, nodes: List) -> np.ndarray:
+        """Returns the position of `nodes`"""
+
+    @abstractmethod
+    def node_coordinates(self, nodes: List) -> np.ndarray:
+        """Returns the (lat, lng) of `nodes`"""
+
+    def lengths(self, sources: List, targets: List) -> List[List[float]]:
+        """Returns the length from every source to every target"""
+        return [[self.length(source, target) for target in targets] for source in sources]
+
+    def model_view(self) -> "NetworkFactory":
+        """Returns the network the model solves on, whose nodes are also nodes of this network"""
+        return self
+
+    def preprocess(self) -> None:
+        """Builds the data derived from the created network's region, once, before requests need it"""
+
+    def adjacency(self) -> scipy.sparse.csr_matrix:
+        """Returns the length of the shortest edge between every pair of nodes, indexed by node position"""
+        raise NotImplementedError
+
 
 class OSMNetwork(NetworkFactory):
-    """Create a network using OSMnx's api"""
+    """Create a network using OSMnx's api
+
+    Downloads are stored in `graph_cache`, when given, and later requests inside a
+    cached area are sliced from it instead of downloading again.
+
+    With `contraction_hierarchy`, distances are answered by the contraction hierarchy of the
+    graph's region, i.e. its `graph_cache` entry, without a Dijkstra per source. `create` only
+    loads a hierarchy, `preprocess` builds it once per region, offline or while prewarming.
+    `path` and `length` take the region's shortest path when it stays inside the graph, which is
+    then also the graph's, and search the graph otherwise. The many-to-many `lengths` run over
+    the whole region, so they can be shorter than within the graph where a shortest path leaves
+    it, and models only use them to rank candidates.
+
+    With a `path_store`, the shortest paths of frequently searched sources over the graph's
+    region, its `graph_cache` entry, are kept on disk and reused by later requests in the region.
+    Targets whose shortest path in the region leaves the request's graph are searched again on it.
+
+    With `isochrone`, the graph is further trimmed to the nodes a loop of `distance` can
+    reach, i.e. whose walk there and back from the start is at most `distance`.
+
+    With a `tile_size`, areas wider than it are downloaded as tiles fetched in parallel by
+    `fetch_workers` threads over one pooled session, retrying failed tiles with backoff.
+
+    With `coarsen`, runs of at least `coarsen_min_distance` are modelled on a coarsened copy of
+    the graph, see `running_routes.coarsening`, returned by `model_view`. Its nodes are nodes of
+    the full graph, so the local search and assembler work on the tours unchanged.
 
-    def __init__(self, **parameters) -> None:
-        self.graph: nx.DiGraph = None
+    With `compact`, the truncated graph keeps only the attributes the pipeline reads, parallel
+    edges collapse to the shortest one and nodes are relabelled 0..n-1 in OSM id order.
+    `osm_ids` maps the labels back to OSM node ids.
+    """
+
+    def __init__(
+            self, graph_cache: Optional[GraphCache] = None, path_store: Optional[ShortestPathStore] = None,
+            **parameters) -> None:
+        self._graph: nx.DiGraph = None
+        self.graph_cache = graph_cache
+        self.path_store = path_store
         self.parameters: Dict = parameters
 
+        # Set default parameters
+        for key, value in OSM_DEFAULT_PARAMETERS.items():
+            if key not in self.parameters:
+                self.parameters[key] = value
+
         self._length: Dict = {}
         self._path: Dict = {}
+        self.hierarchy: Optional[ContractionHierarchy] = None
+        # Graph cache key of the region the graph was sliced from
+        self.region_key: Optional[str] = None
+        self._model_view: Optional[OSMNetwork] = None
+        self.statistics: Dict = {}
+        # OSM node id of each node of a compact graph
+        self.osm_ids: Optional[np.ndarray] = None
+        self.fetcher: Optional["TiledFetcher"] = None
+        if self.parameters["tile_size"]:
+            # Only imported when tiling is enabled
+            from running_routes.tiled_fetch import TiledFetcher
+            self.fetcher = TiledFetcher(tile_size=self.parameters["tile_size"], workers=self.parameters["fetch_workers"])
+        if self.parameters["contraction_hierarchy"] and graph_cache is None:
+            raise ValueError("contraction_hierarchy needs a graph_cache, whose entries are the hierarchies' regions")
+        if path_store is not None and graph_cache is None:
+            raise ValueError("path_store needs a graph_cache, whose entries are the stored paths' regions")
+        # Graph cache key and graph of the region stored paths are searched on, loaded when first needed
+        self._region: Optional[Tuple[str, nx.MultiDiGraph]] = None
+
+        # Node attributes indexed by node position, built once per graph
+        self._node_ids: np.ndarray = None
+        self._node_index: Dict = None
+        self._coordinates: np.ndarray = None
+        self._spatial_index: Optional[BallTree] = None
+        # Arguments of the `create` that built the graph
+        self._created: Optional[Tuple] = None
+
+    @property
+    def graph(self) -> nx.DiGraph:
+        return self._graph
+
+    @graph.setter
+    def graph(self, graph: nx.DiGraph) -> None:
+        """Replacing the graph invalidates everything derived from the previous graph"""
+        self._graph = graph
+        self._length = {}
+        self._path = {}
+        self.hierarchy = None
+        self.region_key = None
+        self._model_view = None
+        self.statistics = {
+            "nodes": graph.number_of_nodes() if graph is not None else 0,
+            "edges": graph.number_of_edges() if graph is not None else 0,
+            "dijkstra_runs_total": 0,
+            "cache_hits_total": 0,
+            "hierarchy_queries_total": 0,
+            "hierarchy_outside_total": 0,
+            "path_store_hits_total": 0,
+            "path_store_writes_total": 0,
+        }
+        # Hierarchy answers of (source, target), None when their path leaves the graph
+        self._hierarchy_paths: Dict[Tuple, Optional[Tuple[float, List]]] = {}
+        self._node_ids = None
+        self._node_index = None
+        self._coordinates = None
+        self._spatial_index = None
+        self._created = None
+        self._distance: Optional[int] = None
+        # Sources whose paths come from a region row, which may leave some targets unknown
+        self._partial: set = set()
+        self._sorted_node_ids: np.ndarray = None
+        self._sorted_index: Dict = None
+        self.osm_ids = None
 
     def create(self, start_coordinate: Dict, distance: int, network_type: str = "walk") -> None:
         """Downloads the graph and truncates any nodes outside `distance` radius
@@ -42,52 +214,227 @@ class OSMNetwork(NetworkFactory):
             distance (int): distance in meters
             network_type (str, optional): network type according to OSM. Defaults to "walk".
                 https://osmnx.readthedocs.io/en/stable/osmnx.html#module-osmnx.graph    
+
+        Creating the same network again keeps the graph and everything derived from it,
+        e.g. a network warmed for a hot start point
         """
+        created = (start_coordinate["lat"], start_coordinate["lng"], distance, network_type)
+        if self.graph is not None and created == self._created:
+            self._reset_counters()
+            self.statistics["network_reused_total"] = 1
+            return
         radius = distance/2
-        G = osmnx.graph_from_point(
+        statistics = {"network_reused_total": 0}
+        G, region_key = None, None
+        if self.graph_cache:
+            with timed(statistics, "graph_cache_seconds"):
+                region_key = self.graph_cache.find(start_coordinate, radius, network_type)
+                G = self.graph_cache.load(region_key) if region_key is not None else None
+            statistics["graph_cache_hits_total"] = int(G is not None)
+        if G is None:
+            with timed(statistics, "download_seconds"):
+                if self._tiled(radius):
+                    G, fetch_statistics = self.fetcher.fetch(start_coordinate, radius, network_type)
+                    statistics.update(fetch_statistics)
+                else:
+                    G = self._download(start_coordinate, radius, network_type)
+            if self.graph_cache:
+                region_key = self.graph_cache.put(start_coordinate, radius, network_type, G)
+        with timed(statistics, "truncate_seconds"):
+            G = self._truncate(G, start_coordinate, radius)
+        if self.parameters["isochrone"]:
+            with timed(statistics, "isochrone_seconds"):
+                nodes = G.number_of_nodes()
+                G = self._isochrone(G, start_coordinate, distance)
+            statistics["isochrone_removed_nodes"] = nodes - G.number_of_nodes()
+        osm_ids = None
+        if self.parameters["compact"]:
+            with timed(statistics, "compact_seconds"):
+                statistics["graph_bytes_before"] = graph_memory_bytes(G)
+                G, osm_ids = compact_graph(G)
+        statistics["graph_bytes"] = graph_memory_bytes(G)
+        self.graph = G
+        self.osm_ids = osm_ids
+        self.region_key = region_key
+        self._distance = distance
+        if self.parameters["contraction_hierarchy"]:
+            with timed(statistics, "hierarchy_load_seconds"):
+                self.hierarchy = self._load_hierarchy()
+            statistics["hierarchy_missing_total"] = int(self.hierarchy is None)
+        if self.parameters["coarsen"] and distance >= self.parameters["coarsen_min_distance"]:
+            with timed(statistics, "coarsen_seconds"):
+                self._model_view = self._coarsen(distance)
+            statistics["coarse_nodes"] = self._model_view.statistics["nodes"]
+            statistics["coarse_edges"] = self._model_view.statistics["edges"]
+        self.statistics.update(statistics)
+        self._created = created
+
+    def _reset_counters(self) -> None:
+        """Statistics of a reused graph only count the current request"""
+        self.statistics = {
+            key: 0 if key.endswith("_total") else value
+            for key, value in self.statistics.items() if not key.endswith("_seconds")}
+
+    def model_view(self) -> NetworkFactory:
+        return self._model_view or self
+
+    def _coarsen(self, distance: int) -> "OSMNetwork":
+        coarse, members = coarsen_graph(self.graph, distance/self.parameters["coarsen_resolution"])
+        view = OSMNetwork()
+        view.graph = coarse
+        # Full graph nodes merged into each super-node
+        view.members = members
+        return view
+
+    # Name of the hierarchy stored next to each graph cache entry
+    HIERARCHY_FILE = "hierarchy.pickle"
+
+    def preprocess(self) -> Optional[ContractionHierarchy]:
+        """Builds and stores the contraction hierarchy of the graph's region, unless it exists"""
+        if not self.graph:
+            raise Exception("Graph has not been created")
+        if not self.parameters["contraction_hierarchy"]:
+            return None
+        self.hierarchy = self._load_hierarchy() or self.build_region_hierarchy(self.graph_cache, self.region_key)
+        return self.hierarchy
+
+    @classmethod
+    def build_region_hierarchy(cls, graph_cache: GraphCache, region_key: str) -> ContractionHierarchy:
+        """Builds the hierarchy of a graph cache entry over OSM node ids"""
+        G = graph_cache.load(region_key)
+        if G is None:
+            raise ValueError(f"Graph cache entry {region_key} has been evicted")
+        hierarchy = ContractionHierarchy.build(G, fingerprint=region_key)
+        hierarchy.save(graph_cache.sidecar(region_key, cls.HIERARCHY_FILE))
+        return hierarchy
+
+    def _load_hierarchy(self) -> Optional[ContractionHierarchy]:
+        path = self.graph_cache.sidecar(self.region_key, self.HIERARCHY_FILE)
+        try:
+            return load_hierarchy(str(path))
+        except FileNotFoundError:
+            return None
+
+    def _download(self, start_coordinate: Dict, radius: float, network_type: str) -> nx.MultiDiGraph:
+        """Downloads the graph within the bounding box of `radius` around `start_coordinate`"""
+        return osmnx.graph_from_point(
             (start_coordinate["lat"], start_coordinate["lng"]),
             dist=radius,
             network_type=network_type,
         )
-        nodes_outside_radius = [
-            node
-            for node, data in G.nodes.data()
-            if osmnx.distance.great_circle_vec(
-                start_coordinate["lat"], start_coordinate["lng"],
-                data["y"], data["x"]
-            ) > radius
-        ]
+
+    def _tiled(self, radius: float) -> bool:
+        return self.fetcher is not None and 2*radius > self.parameters["tile_size"]
+
+    def _truncate(self, G: nx.MultiDiGraph, start_coordinate: Dict, radius: float) -> nx.MultiDiGraph:
+        """Removes nodes outside `radius` and keeps the largest connected component"""
+        nodes = list(G.nodes)
+        distances = osmnx.distance.great_circle_vec(
+            start_coordinate["lat"], start_coordinate["lng"],
+            np.array([G.nodes[node]["y"] for node in nodes]),
+            np.array([G.nodes[node]["x"] for node in nodes]),
+        )
+        nodes_outside_radius = [node for node, node_distance in zip(nodes, distances) if node_distance > radius]
         G.remove_nodes_from(nodes_outside_radius)
         G = osmnx.utils_graph.get_largest_component(G)
-        self.graph = G
+        return G
+
+    def _isochrone(self, G: nx.MultiDiGraph, start_coordinate: Dict, distance: float) -> nx.MultiDiGraph:
+        """Keeps the nodes that a loop of at most `distance` from the node nearest the start can visit
+
+        Any loop through a node is at least as long as the shortest walk there plus the shortest walk back,
+        which rivers, railways and one-way streets can make much longer than the great-circle distance.
+        """
+        nodes = list(G.nodes)
+        distances = osmnx.distance.great_circle_vec(
+            start_coordinate["lat"], start_coordinate["lng"],
+            np.array([G.nodes[node]["y"] for node in nodes]),
+            np.array([G.nodes[node]["x"] for node in nodes]),
+        )
+        start = nodes[int(np.argmin(distances))]
+        outbound = nx.single_source_dijkstra_path_length(G, start, cutoff=distance, weight="length")
+        inbound = nx.single_source_dijkstra_path_length(G.reverse(copy=False), start, cutoff=distance, weight="length")
+        reachable = [node for node, length in outbound.items() if length + inbound.get(node, math.inf) <= distance]
+        return G.subgraph(reachable).copy()
 
     def path(self, source, target) -> List:
         if not self.graph:
             raise Exception("Graph has not been created")
+        if self.hierarchy:
+            shortest_path = self._hierarchy_path(source, target)
+            if shortest_path is not None:
+                return shortest_path[1]
         if source not in self._path:
             self._calculate_dijkstras(source)
+        else:
+            self.statistics["cache_hits_total"] += 1
         if target not in self.graph:
             raise nx.NodeNotFound(f"{target}")
+        if source in self._partial and target not in self._length[source]:
+            self._dijkstra(source)
 
         return self._path[source][target]
 
     def length(self, source, target) -> float:
         if not self.graph:
             raise Exception("Graph has not been created")
+        if self.hierarchy:
+            shortest_path = self._hierarchy_path(source, target)
+            if shortest_path is not None:
+                return shortest_path[0]
         if source not in self._length:
             self._calculate_dijkstras(source)
+        else:
+            self.statistics["cache_hits_total"] += 1
         if target not in self.graph:
             raise nx.NodeNotFound(f"{target}")
+        if source in self._partial and target not in self._length[source]:
+            self._dijkstra(source)
 
         return self._length[source][target]
 
+    def lengths(self, sources: List, targets: List) -> List[List[float]]:
+        if not self.graph:
+            raise Exception("Graph has not been created")
+        if self.hierarchy:
+            self.statistics["hierarchy_queries_total"] += 1
+            return self.hierarchy.many_to_many(
+                self.osm_node_ids(sources).tolist(), self.osm_node_ids(targets).tolist())
+        return super().lengths(sources, targets)
+
+    def _hierarchy_path(self, source, target) -> Optional[Tuple[float, List]]:
+        """Length and nodes of the region's shortest path, None when it leaves the graph"""
+        key = (source, target)
+        if key in self._hierarchy_paths:
+            self.statistics["cache_hits_total"] += 1
+            return self._hierarchy_paths[key]
+        for node in key:
+            if node not in self.graph:
+                raise nx.NodeNotFound(f"{node}")
+        self._build_sorted_node_ids()
+        # Compact labels are positions in the sorted OSM ids, other graphs are labelled by OSM id
+        sorted_osm_ids = self.osm_ids if self.osm_ids is not None else self._sorted_node_ids
+        self.statistics["hierarchy_queries_total"] += 1
+        shortest_path = _contained_path(self.hierarchy, *self.osm_node_ids(list(key)).tolist(), sorted_osm_ids)
+        if shortest_path is None:
+            self.statistics["hierarchy_outside_total"] += 1
+        else:
+            shortest_path = (shortest_path[0], self._sorted_node_ids[shortest_path[1]].tolist())
+        self._hierarchy_paths[key] = shortest_path
+        return shortest_path
+
     def nearest_nodes(self, locations) -> List:
-        osm_nodes = osmnx.distance.nearest_nodes(
-            self.graph,
-            [location["lng"] for location in locations],
-            [location["lat"] for location in locations]
-        )
-        return osm_nodes
+        """Nearest node of each location by great circle distance, as `osmnx.distance.nearest_nodes`"""
+        points = np.radians([(location["lat"], location["lng"]) for location in locations]).reshape(-1, 2)
+        _, positions = self.spatial_index.query(points, k=1)
+        return self.node_ids[positions[:, 0]].tolist()
+
+    @property
+    def spatial_index(self) -> BallTree:
+        """Ball tree of the node coordinates, built once per graph"""
+        if self._spatial_index is None:
+            self._spatial_index = BallTree(np.radians(self.coordinates), metric="haversine")
+        return self._spatial_index
 
     @property
     def nodes(self):
@@ -95,8 +442,591 @@ class OSMNetwork(NetworkFactory):
             raise Exception("Graph has not been created")
         return {node: data for node, data in self.graph.nodes(data=True)}
 
+    @property
+    def node_ids(self) -> np.ndarray:
+        """Node ids ordered by node position"""
+        self._build_node_store()
+        return self._node_ids
+
+    @property
+    def coordinates(self) -> np.ndarray:
+        self._build_node_store()
+        return self._coordinates
+
+    def node_index(self, nodes: List) -> np.ndarray:
+        """Returns the position of `nodes` in the node store"""
+        self._build_node_store()
+        try:
+            return np.fromiter(
+                (self._node_index[node] for node in nodes), dtype=np.int64, count=len(nodes))
+        except KeyError as error:
+            raise nx.NodeNotFound(f"{error.args[0]}")
+
+    def node_coordinates(self, nodes: List) -> np.ndarray:
+        return self.coordinates[self.node_index(nodes)]
+
+    def adjacency(self) -> scipy.sparse.csr_matrix:
+        self._build_node_store()
+        shortest: Dict[Tuple, float] = {}
+        for u, v, length in self.graph.edges(data="length"):
+            if u != v and length < shortest.get((u, v), math.inf):
+                shortest[u, v] = length
+        rows = self.node_index([u for u, _ in shortest])
+        columns = self.node_index([v for _, v in shortest])
+        lengths = np.fromiter(shortest.values(), dtype=np.float64, count=len(shortest))
+        return scipy.sparse.csr_matrix((lengths, (rows, columns)), shape=(len(self._node_ids),)*2)
+
+    def osm_node_ids(self, nodes: List) -> np.ndarray:
+        """Returns the OSM node ids of `nodes`, which differ from their labels in compact graphs"""
+        if self.osm_ids is None:
+            return np.asarray(nodes)
+        return self.osm_ids[np.asarray(nodes, dtype=np.int64)]
+
+    def _build_node_store(self) -> None:
+        if not self.graph:
+            raise Exception("Graph has not been created")
+        if self._coordinates is not None:
+            return
+
+        node_ids, coordinates = [], []
+        for node, data in self.graph.nodes(data=True):
+            node_ids.append(node)
+            coordinates.append((data["y"], data["x"]))
+        self._node_ids = np.array(node_ids)
+        self._node_index = {node: index for index, node in enumerate(node_ids)}
+        self._coordinates = np.array(coordinates, dtype=np.float64).reshape(-1, 2)
+
     def _calculate_dijkstras(self, source):
+        if self.path_store is not None and self.region_key is not None and source in self.graph:
+            if self._load_row(source):
+                return
+        self._dijkstra(source)
+
+    def _dijkstra(self, source) -> None:
         length, path = nx.single_source_dijkstra(
             self.graph, source, weight="length")
         self._length[source] = length
         self._path[source] = path
+        self._partial.discard(source)
+        self.statistics["dijkstra_runs_total"] += 1
+
+    def _load_row(self, source) -> bool:
+        """Answers the source from its region row, stored or searched for a frequent source"""
+        region_key, cutoff = self.region_key, self.path_store.parameters["cutoff_factor"]*self._distance
+        node = self.osm_node_ids([source]).tolist()[0]
+        rows = self.path_store.load(region_key, [node], cutoff)
+        self.statistics["path_store_hits_total"] += len(rows)
+        if not rows and self.path_store.frequent(region_key, [node]):
+            G = self._region_graph()
+            if G is None:
+                return False
+            rows = {node: _networkx_row(G, node, cutoff)}
+            self.statistics["path_store_writes_total"] += self.path_store.save(region_key, rows, cutoff)
+        if not rows:
+            return False
+
+        self._build_sorted_node_ids()
+        lengths, predecessors = slice_row(rows[node], self.osm_node_ids(self._sorted_node_ids))
+        known = ~np.isnan(lengths)
+        self._length[source] = dict(zip(self._sorted_node_ids[known].tolist(), lengths[known].tolist()))
+        self._path[source] = PredecessorPaths(source, self._sorted_node_ids, self._sorted_index, predecessors)
+        self._partial.add(source)
+        return True
+
+    def _region_graph(self) -> Optional[nx.MultiDiGraph]:
+        """Graph cache entry of the region, kept while requests stay in it"""
+        if self._region is None or self._region[0] != self.region_key:
+            G = self.graph_cache.load(self.region_key)
+            if G is None:
+                # Evicted since the request's graph was loaded
+                return None
+            self._region = (self.region_key, G)
+        return self._region[1]
+
+    def _build_sorted_node_ids(self) -> None:
+        if self._sorted_node_ids is None:
+            self._sorted_node_ids = np.sort(self.node_ids)
+            self._sorted_index = {node: index for index, node in enumerate(self._sorted_node_ids.tolist())}
+
+
+def _contained_path(
+        hierarchy: ContractionHierarchy, source, target, sorted_ids: np.ndarray) -> Optional[Tuple[float, np.ndarray]]:
+    """Length of the region's shortest path between OSM ids and its nodes' positions in `sorted_ids`
+
+    The OSM ids of a graph inside the region, where it is an induced subgraph: a region shortest path
+    through its nodes is also its shortest path. None when the path leaves it, or there is none.
+    """
+    try:
+        length, path = hierarchy.shortest_path(source, target)
+    except nx.NetworkXNoPath:
+        return None
+    positions = np.searchsorted(sorted_ids, path)
+    if (positions >= len(sorted_ids)).any() or (sorted_ids[positions] != path).any():
+        return None
+    return length, positions
+
+
+def _networkx_row(G: nx.MultiDiGraph, source, cutoff: float):
+    """Region row of the nodes within `cutoff` of `source`"""
+    predecessors, lengths = nx.dijkstra_predecessor_and_distance(G, source, cutoff=cutoff, weight="length")
+    targets = sorted(lengths)
+    position = {node: index for index, node in enumerate(targets)}
+    return region_row(
+        targets, [lengths[node] for node in targets],
+        [position[predecessors[node][0]] if predecessors[node] else -1 for node in targets])
+
+
+class PredecessorPaths(Mapping):
+    """Shortest paths from `source`, rebuilt on access from each node's predecessor"""
+
+    def __init__(self, source, node_ids: np.ndarray, index: Dict, predecessors: np.ndarray):
+        self.source = source
+        self.node_ids = node_ids
+        # Position of each node in `node_ids`
+        self.index = index
+        self.predecessors = predecessors
+
+    def __getitem__(self, target) -> List:
+        if target == self.source:
+            return [target]
+        position = self.index[target]
+        if self.predecessors[position] < 0:
+            raise KeyError(target)
+        path = [position]
+        while self.node_ids[path[-1]] != self.source:
+            path.append(self.predecessors[path[-1]])
+        return self.node_ids[path[::-1]].tolist()
+
+    def __iter__(self) -> Iterator:
+        return (
+            node for node, predecessor in zip(self.node_ids.tolist(), self.predecessors.tolist())
+            if predecessor >= 0 or node == self.source)
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+
+class MappedNetwork(NetworkFactory):
+    """Create networks from a regional graph stored as memory-mapped arrays
+
+    The region is written once with `running_routes.mapped_graph`. Every network in a process
+    shares one read-only mapping of it, and so does every process mapping the same `directory`,
+    so extra gunicorn workers add little memory. Requests must lie inside the region.
+
+    With a `path_store`, the shortest paths of frequently searched sources over the region are
+    kept on disk and reused by later requests anywhere in the region. Targets whose shortest path
+    in the region leaves the slice are searched again on the slice. The store is emptied when the
+    region's version changes, i.e. when it is written again.
+
+    With `contraction_hierarchy`, distances are answered by the region's contraction hierarchy,
+    stored in `directory` by `preprocess` and loaded once per process, as for `OSMNetwork`:
+    `path` and `length` only take region paths inside the slice.
+    """
+
+    # Name of the hierarchy stored in the region's directory
+    HIERARCHY_FILE = "hierarchy.pickle"
+
+    def __init__(self, directory: str, path_store: Optional[ShortestPathStore] = None, **parameters) -> None:
+        self.mapped_graph = open_mapped_graph(str(directory))
+        self.path_store = path_store
+        if path_store is not None:
+            path_store.check_version(self.mapped_graph.version)
+        self.parameters: Dict = parameters
+
+        # Set default parameters
+        for key, value in MAPPED_DEFAULT_PARAMETERS.items():
+            if key not in self.parameters:
+                self.parameters[key] = value
+
+        self.hierarchy: Optional[ContractionHierarchy] = None
+        if self.parameters["contraction_hierarchy"]:
+            self.hierarchy = self._load_hierarchy()
+        self._reset()
+
+    def _reset(self) -> None:
+        # Positions of the network's nodes in the mapped graph, sorted, and their adjacency matrix
+        self._positions: np.ndarray = None
+        self._matrix = None
+        self._node_ids: np.ndarray = None
+        self._coordinates: np.ndarray = None
+        self._spatial_index: Optional[BallTree] = None
+        self._length: Dict = {}
+        self._predecessors: Dict = {}
+        # Sources whose rows come from a region row, which may leave some targets unknown
+        self._partial: set = set()
+        self._start: Optional[Dict] = None
+        self._distance: Optional[int] = None
+        # Hierarchy answers of (source, target), None when their path leaves the slice
+        self._hierarchy_paths: Dict[Tuple, Optional[Tuple[float, List]]] = {}
+        self.statistics: Dict = {}
+
+    def create(self, start_coordinate: Dict, distance: int, network_type: str = "walk") -> None:
+        """Slices the nodes within `distance` radius from the mapped graph
+
+        `network_type` is fixed when the region is written
+        """
+        self._reset()
+        radius = distance/2
+        statistics = {}
+        with timed(statistics, "slice_seconds"):
+            positions = self.mapped_graph.within(start_coordinate["lat"], start_coordinate["lng"], radius)
+            if not len(positions):
+                raise ValueError("Found no graph nodes within the requested polygon")
+            matrix = self.mapped_graph.subgraph(positions)
+            keep = largest_component(matrix)
+            self._positions = positions[keep]
+            self._matrix = matrix[keep][:, keep].tocsr()
+            self._node_ids = np.asarray(self.mapped_graph.node_ids[self._positions])
+            self._coordinates = np.asarray(self.mapped_graph.coordinates[self._positions])
+        self._start, self._distance = start_coordinate, distance
+        self.statistics = {
+            "nodes": len(self._positions),
+            "edges": self._matrix.nnz,
+            "dijkstra_runs_total": 0,
+            "cache_hits_total": 0,
+            "hierarchy_queries_total": 0,
+            "hierarchy_outside_total": 0,
+            "path_store_hits_total": 0,
+            "path_store_writes_total": 0,
+        }
+        if self.parameters["contraction_hierarchy"]:
+            statistics["hierarchy_missing_total"] = int(self.hierarchy is None)
+        self.statistics.update(statistics)
+
+    def preprocess(self) -> Optional[ContractionHierarchy]:
+        """Builds and stores the contraction hierarchy of the region, unless it exists"""
+        if not self.parameters["contraction_hierarchy"]:
+            return None
+        if self.hierarchy is None:
+            mapped_graph = self.mapped_graph
+            hierarchy = ContractionHierarchy.from_csr(
+                mapped_graph.node_ids, mapped_graph.indptr, mapped_graph.indices, mapped_graph.lengths,
+                fingerprint=mapped_graph.version)
+            hierarchy.save(mapped_graph.directory / self.HIERARCHY_FILE)
+            self.hierarchy = hierarchy
+        return self.hierarchy
+
+    def _load_hierarchy(self) -> Optional[ContractionHierarchy]:
+        try:
+            hierarchy = load_hierarchy(str(self.mapped_graph.directory / self.HIERARCHY_FILE))
+        except FileNotFoundError:
+            return None
+        # Built for an earlier version of the region
+        return hierarchy if hierarchy.fingerprint == self.mapped_graph.version else None
+
+    def path(self, source, target) -> List:
+        source_index, target_index = self.node_index([source, target])
+        if self.hierarchy:
+            shortest_path = self._hierarchy_path(source, target)
+            if shortest_path is not None:
+                return shortest_path[1]
+        self._calculate_dijkstras([source_index])
+        self._complete([source_index], [target_index])
+        predecessors = self._predecessors[source_index]
+        if source_index != target_index and predecessors[target_index] < 0:
+            raise nx.NetworkXNoPath(f"No path between {source} and {target}")
+
+        path = [target_index]
+        while path[-1] != source_index:
+            path.append(predecessors[path[-1]])
+        return self._node_ids[path[::-1]].tolist()
+
+    def length(self, source, target) -> float:
+        source_index, target_index = self.node_index([source, target])
+        if self.hierarchy:
+            shortest_path = self._hierarchy_path(source, target)
+            if shortest_path is not None:
+                return shortest_path[0]
+        self._calculate_dijkstras([source_index])
+        self._complete([source_index], [target_index])
+        return float(self._length[source_index][target_index])
+
+    def lengths(self, sources: List, targets: List) -> List[List[float]]:
+        source_indices = self.node_index(sources)
+        target_indices = self.node_index(targets)
+        if self.hierarchy:
+            self.statistics["hierarchy_queries_total"] += 1
+            return self.hierarchy.many_to_many(
+                self._node_ids[source_indices].tolist(), self._node_ids[target_indices].tolist())
+        self._calculate_dijkstras(source_indices)
+        self._complete(source_indices, target_indices)
+        return [self._length[source][target_indices].tolist() for source in source_indices]
+
+    def _hierarchy_path(self, source, target) -> Optional[Tuple[float, List]]:
+        """Length and nodes of the region's shortest path, None when it leaves the slice"""
+        key = (source, target)
+        if key in self._hierarchy_paths:
+            self.statistics["cache_hits_total"] += 1
+            return self._hierarchy_paths[key]
+        self.statistics["hierarchy_queries_total"] += 1
+        shortest_path = _contained_path(self.hierarchy, source, target, self._node_ids)
+        if shortest_path is None:
+            self.statistics["hierarchy_outside_total"] += 1
+        else:
+            shortest_path = (shortest_path[0], self._node_ids[shortest_path[1]].tolist())
+        self._hierarchy_paths[key] = shortest_path
+        return shortest_path
+
+    def nearest_nodes(self, locations) -> List:
+        """Nearest node of each location by great circle distance, from a ball tree of the slice"""
+        points = np.radians([(location["lat"], location["lng"]) for location in locations]).reshape(-1, 2)
+        _, positions = self.spatial_index.query(points, k=1)
+        return self.node_ids[positions[:, 0]].tolist()
+
+    @property
+    def spatial_index(self) -> BallTree:
+        """Ball tree of the slice's node coordinates, built once per network"""
+        if self._spatial_index is None:
+            self._spatial_index = BallTree(np.radians(self.coordinates), metric="haversine")
+        return self._spatial_index
+
+    @property
+    def nodes(self) -> Dict:
+        return {node: {"y": lat, "x": lng} for node, (lat, lng) in zip(self.node_ids.tolist(), self.coordinates.tolist())}
+
+    @property
+    def node_ids(self) -> np.ndarray:
+        """Node ids ordered by node position"""
+        if self._positions is None:
+            raise Exception("Graph has not been created")
+        return self._node_ids
+
+    @property
+    def coordinates(self) -> np.ndarray:
+        if self._positions is None:
+            raise Exception("Graph has not been created")
+        return self._coordinates
+
+    def node_index(self, nodes: List) -> np.ndarray:
+        """Returns the position of `nodes` in the network"""
+        node_ids = self.node_ids
+        try:
+            nodes = np.asarray(nodes, dtype=np.int64)
+        except (TypeError, ValueError):
+            raise nx.NodeNotFound(f"{nodes}")
+        index = np.minimum(np.searchsorted(node_ids, nodes), len(node_ids) - 1)
+        missing = node_ids[index] != nodes
+        if missing.any():
+            raise nx.NodeNotFound(f"{nodes[missing][0]}")
+        return index
+
+    def node_coordinates(self, nodes: List) -> np.ndarray:
+        return self.coordinates[self.node_index(nodes)]
+
+    def adjacency(self) -> scipy.sparse.csr_matrix:
+        if self._positions is None:
+            raise Exception("Graph has not been created")
+        return self._matrix
+
+    def _calculate_dijkstras(self, sources: np.ndarray) -> None:
+        """Runs the uncached sources in a single call"""
+        missing = [source for source in dict.fromkeys(np.asarray(sources).tolist()) if source not in self._length]
+        self.statistics["cache_hits_total"] += len(sources) - len(missing)
+        if missing and self.path_store is not None:
+            missing = self._load_rows(missing)
+        if missing:
+            self._dijkstra(missing)
+
+    def _dijkstra(self, sources: List[int]) -> None:
+        lengths, predecessors = csgraph.dijkstra(self._matrix, indices=sources, return_predecessors=True)
+        for source, source_lengths, source_predecessors in zip(sources, lengths, predecessors):
+            self._length[source] = source_lengths
+            self._predecessors[source] = source_predecessors
+            self._partial.discard(source)
+        self.statistics["dijkstra_runs_total"] += len(sources)
+
+    def _complete(self, sources: np.ndarray, targets: np.ndarray) -> None:
+        """Searches the slice from the sources whose region rows leave some of `targets` unknown"""
+        incomplete = [
+            source for source in dict.fromkeys(np.asarray(sources).tolist())
+            if source in self._partial and np.isnan(self._length[source][targets]).any()]
+        if incomplete:
+            self._dijkstra(incomplete)
+
+    def _load_rows(self, sources: List[int]) -> List[int]:
+        """Answers sources from their region rows, stored or searched for frequent sources
+
+        Returns the sources left to search on the slice
+        """
+        region, cutoff = self.mapped_graph.version, self.path_store.parameters["cutoff_factor"]*self._distance
+        nodes = self._node_ids[sources].tolist()
+        rows = self.path_store.load(region, nodes, cutoff)
+        self.statistics["path_store_hits_total"] += len(rows)
+        frequent = self.path_store.frequent(region, [node for node in nodes if node not in rows])
+        if frequent:
+            searched = self._region_rows(frequent, cutoff)
+            self.statistics["path_store_writes_total"] += self.path_store.save(region, searched, cutoff)
+            rows.update(searched)
+
+        for source, node in zip(sources, nodes):
+            if node in rows:
+                self._length[source], self._predecessors[source] = slice_row(rows[node], self._node_ids)
+                self._partial.add(source)
+        return [source for source in sources if source not in self._length]
+
+    def _region_rows(self, nodes: List[int], cutoff: float, chunk_size: int = 16) -> Dict:
+        """Searches the region from `nodes` up to `cutoff`, on the part of it such paths can reach"""
+        positions = self.mapped_graph.within(self._start["lat"], self._start["lng"], self._distance/2 + cutoff)
+        matrix = self.mapped_graph.subgraph(positions)
+        region_node_ids = np.asarray(self.mapped_graph.node_ids[positions])
+        indices = np.searchsorted(positions, self.mapped_graph.positions(nodes))
+
+        rows = {}
+        # In chunks, the dense results span the whole searched area
+        for start in range(0, len(nodes), chunk_size):
+            lengths, predecessors = csgraph.dijkstra(
+                matrix, indices=indices[start:start + chunk_size], limit=cutoff, return_predecessors=True)
+            for node, node_lengths, node_predecessors in zip(nodes[start:start + chunk_size], lengths, predecessors):
+                reached = np.flatnonzero(np.isfinite(node_lengths))
+                row_position = np.full(len(positions), -1, dtype=np.int64)
+                row_position[reached] = np.arange(len(reached))
+                reached_predecessors = node_predecessors[reached]
+                rows[node] = region_row(
+                    region_node_ids[reached], node_lengths[reached],
+                    np.where(reached_predecessors >= 0, row_position[np.maximum(reached_predecessors, 0)], -1))
+            self.statistics["dijkstra_runs_total"] += len(lengths)
+        return rows
+
+
+class ArrayNetwork(NetworkFactory):
+    """A created network held as arrays, to send it to another process
+
+    `from_network` takes the node ids, coordinates and adjacency of a created network, which pickle
+    far smaller than its graph and need no download on the other side. Node positions are the
+    network's, so tours cross over as their indices. Shortest paths are searched with scipy, their
+    lengths are the network's but where several paths are shortest it may take another one.
+    """
+
+    def __init__(self, node_ids: np.ndarray, coordinates: np.ndarray, matrix: scipy.sparse.csr_matrix) -> None:
+        self._node_ids = np.asarray(node_ids)
+        self._coordinates = np.asarray(coordinates, dtype=np.float64).reshape(-1, 2)
+        self._matrix = matrix
+        # Node positions in node id order, node ids of graph networks need not be sorted
+        self._order = np.argsort(self._node_ids, kind="stable")
+        self._sorted_ids = self._node_ids[self._order]
+        self._length: Dict = {}
+        self._predecessors: Dict = {}
+        self.statistics: Dict = {
+            "nodes": len(self._node_ids),
+            "edges": matrix.nnz,
+            "dijkstra_runs_total": 0,
+            "cache_hits_total": 0,
+        }
+
+    @classmethod
+    def from_network(cls, network: NetworkFactory) -> "ArrayNetwork":
+        return cls(network.node_ids, network.coordinates, network.adjacency())
+
+    def create(self, start_coordinate: Dict, distance: int, network_type: str = "walk") -> None:
+        """The network is created from its arrays"""
+
+    def path(self, source, target) -> List:
+        source_index, target_index = self.node_index([source, target])
+        predecessors = self._dijkstra(source_index)[1]
+        if source_index != target_index and predecessors[target_index] < 0:
+            raise nx.NetworkXNoPath(f"No path between {source} and {target}")
+
+        path = [target_index]
+        while path[-1] != source_index:
+            path.append(predecessors[path[-1]])
+        return self._node_ids[path[::-1]].tolist()
+
+    def length(self, source, target) -> float:
+        source_index, target_index = self.node_index([source, target])
+        return float(self._dijkstra(source_index)[0][target_index])
+
+    def _dijkstra(self, source: int) -> Tuple[np.ndarray, np.ndarray]:
+        if source in self._length:
+            self.statistics["cache_hits_total"] += 1
+        else:
+            self._length[source], self._predecessors[source] = csgraph.dijkstra(
+                self._matrix, indices=source, return_predecessors=True)
+            self.statistics["dijkstra_runs_total"] += 1
+        return self._length[source], self._predecessors[source]
+
+    @property
+    def nodes(self) -> Dict:
+        return {node: {"y": lat, "x": lng} for node, (lat, lng) in zip(self._node_ids.tolist(), self._coordinates.tolist())}
+
+    @property
+    def node_ids(self) -> np.ndarray:
+        """Node ids ordered by node position"""
+        return self._node_ids
+
+    @property
+    def coordinates(self) -> np.ndarray:
+        return self._coordinates
+
+    def node_index(self, nodes: List) -> np.ndarray:
+        """Returns the position of `nodes` in the network"""
+        nodes = np.asarray(nodes)
+        index = np.minimum(np.searchsorted(self._sorted_ids, nodes), len(self._sorted_ids) - 1)
+        missing = self._sorted_ids[index] != nodes
+        if missing.any():
+            raise nx.NodeNotFound(f"{nodes[missing][0]}")
+        return self._order[index]
+
+    def node_coordinates(self, nodes: List) -> np.ndarray:
+        return self._coordinates[self.node_index(nodes)]
+
+    def adjacency(self) -> scipy.sparse.csr_matrix:
+        return self._matrix
+
+
+def compact_graph(G: nx.MultiDiGraph) -> Tuple[nx.DiGraph, np.ndarray]:
+    """Copy of `G` with only the attributes the pipeline reads, and nodes relabelled 0..n-1
+
+    Parallel edges collapse to the shortest one, which leaves every shortest path unchanged.
+    Returns the graph and the OSM id of each new label, sorted so ids map back with a binary search.
+    """
+    osm_ids = np.array(sorted(G.nodes), dtype=np.int64)
+    label = {node: index for index, node in enumerate(osm_ids.tolist())}
+
+    shortest: Dict[Tuple, Dict] = {}
+    for u, v, data in G.edges(data=True):
+        edge = (label[u], label[v])
+        if edge not in shortest or data["length"] < shortest[edge]["length"]:
+            shortest[edge] = {key: data[key] for key in EDGE_ATTRIBUTES}
+
+    compact = nx.DiGraph(crs=G.graph.get("crs"))
+    # Added in label order, so a node's label is also its position in the node store
+    compact.add_nodes_from(
+        (index, {key: G.nodes[node][key] for key in NODE_ATTRIBUTES}) for index, node in enumerate(osm_ids.tolist()))
+    compact.add_edges_from((u, v, data) for (u, v), data in shortest.items())
+    return compact, osm_ids
+
+
+def graph_memory_bytes(G: nx.Graph, sample_size: int = 500) -> int:
+    """Estimates the memory held by the graph's nodes, edges and their attributes
+
+    Sizes a sample of the nodes and edges, so it is cheap enough to report on every request
+    """
+    nodes = list(G.nodes)
+    if not nodes:
+        return 0
+    node_sample = random.Random(0).sample(nodes, min(len(nodes), sample_size))
+    # Directed graphs keep a dict of successors and a dict of predecessors per node
+    adjacencies = [G._adj, G._pred] if G.is_directed() else [G._adj]
+    node_bytes = sum(
+        _deep_size(node) + _deep_size(G.nodes[node]) + sum(sys.getsizeof(adjacency[node]) for adjacency in adjacencies)
+        for node in node_sample)/len(node_sample)
+
+    edge_sample = list(itertools.islice(G.edges(data=True), sample_size))
+    edge_bytes = sum(_deep_size(data) for *_, data in edge_sample)/max(len(edge_sample), 1)
+    if G.is_multigraph():
+        # Parallel edges between a pair of nodes are held in a dict keyed by edge key
+        edge_bytes += sys.getsizeof({0: None})
+    return int(len(nodes)*node_bytes + G.number_of_edges()*edge_bytes)
+
+
+def _deep_size(value) -> int:
+    """Size of `value` and of the containers and values inside it"""
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(_deep_size(key) + _deep_size(item) for key, item in value.items())
+    elif isinstance(value, (list, tuple, set)):
+        size += sum(_deep_size(item) for item in value)
+    elif getattr(value, "geom_type", None) == "LineString":
+        # Shapely keeps the coordinates outside the Python object
+        size += 16*len(value.coords)
+    return size
@@ -0,0 +1,250 @@
+"""On-disk store of shortest path rows, shared across requests and processes
+
+A row holds the shortest paths from one source node over a regional graph, e.g. a graph cache
+entry or a mapped graph, to every node within a `cutoff` length: the reached nodes' OSM ids,
+sorted, their lengths and the position of each node's predecessor in the row. Rows are keyed by
+the region and the source's OSM node id, which are the same for every request in the region, so
+nearby requests share them. `slice_row` answers a request's graph from a region row.
+
+Reads are plain queries, they never take sqlite's write lock. The uses and last use of each
+row are counted in memory and written in batches, at most every `flush_interval` seconds.
+
+The store is scoped to a `version` of the regional graph. Opening it with a different
+version, e.g. after the region is rebuilt, empties it.
+"""
+from contextlib import contextmanager
+import os
+from pathlib import Path
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+PATH_STORE_DEFAULT_PARAMETERS = {
+    # Rows are only written once their source has been searched this many times
+    "min_uses": 2,
+    # Least recently used rows beyond this are deleted
+    "max_rows": 2000,
+    # Rows reach nodes up to this multiple of the request distance from their source
+    "cutoff_factor": 1.0,
+    # Seconds between writes of the counted uses
+    "flush_interval": 10,
+}
+
+# Reached nodes' OSM ids, sorted, their lengths, and the row position of each node's predecessor, -1 for the source
+Row = Tuple[np.ndarray, np.ndarray, np.ndarray]
+
+
+class ShortestPathStore:
+    def __init__(self, path: Path, version: Optional[str] = None, **parameters):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.parameters = parameters
+
+        # Set default parameters
+        for key, value in PATH_STORE_DEFAULT_PARAMETERS.items():
+            if key not in self.parameters:
+                self.parameters[key] = value
+
+        # Reentrant, the counts are swapped out inside the transaction that writes them
+        self._lock = threading.RLock()
+        self._connection: Optional[sqlite3.Connection] = None
+        self._pid: Optional[int] = None
+        # Counted since the last flush, keyed by (region, source)
+        self._uses: Dict[Tuple[str, int], int] = {}
+        self._last_used: Dict[Tuple[str, int], float] = {}
+        self._flushed = time.time()
+        with self._transaction() as cursor:
+            cursor.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            cursor.execute(
+                "CREATE TABLE IF NOT EXISTS region_rows ("
+                "region TEXT, source INTEGER, cutoff REAL, targets BLOB, lengths BLOB, predecessors BLOB, "
+                "last_used REAL, PRIMARY KEY (region, source))")
+            cursor.execute(
+                "CREATE TABLE IF NOT EXISTS region_uses ("
+                "region TEXT, source INTEGER, count INTEGER, PRIMARY KEY (region, source))")
+            cursor.execute("CREATE INDEX IF NOT EXISTS region_rows_last_used ON region_rows (last_used)")
+        self.version = version
+        if version is not None:
+            self.check_version(version)
+
+    def check_version(self, version: str) -> bool:
+        """Empties the store if it holds rows of another version, returns whether it did"""
+        with self._transaction() as cursor:
+            stored = cursor.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+            if stored is not None and stored[0] == version:
+                return False
+            cursor.execute("DELETE FROM region_rows")
+            cursor.execute("DELETE FROM region_uses")
+            cursor.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)", (version,))
+        with self._lock:
+            self._uses.clear()
+            self._last_used.clear()
+        self.version = version
+        return stored is not None
+
+    def load(self, region: str, sources: Iterable[int], cutoff: float) -> Dict[int, Row]:
+        """Rows of the `sources` stored for `region` that reach at least `cutoff`"""
+        sources = [int(source) for source in sources]
+        if not sources:
+            return {}
+        rows = {}
+        with self._read() as cursor:
+            for chunk in _chunks(sources):
+                query = (
+                    "SELECT source, targets, lengths, predecessors FROM region_rows "
+                    f"WHERE region = ? AND cutoff >= ? AND source IN ({','.join('?'*len(chunk))})")
+                for source, targets, lengths, predecessors in cursor.execute(query, (region, cutoff, *chunk)):
+                    rows[source] = (
+                        np.frombuffer(targets, dtype=np.int64), np.frombuffer(lengths, dtype=np.float64),
+                        np.frombuffer(predecessors, dtype=np.int32))
+        now = time.time()
+        with self._lock:
+            self._last_used.update(((region, source), now) for source in rows)
+        self._maybe_flush()
+        return rows
+
+    def frequent(self, region: str, sources: Iterable[int]) -> List[int]:
+        """Counts a search of each source, returns those searched often enough for their rows to be stored"""
+        sources = [int(source) for source in sources]
+        if not sources:
+            return []
+        stored = {}
+        with self._read() as cursor:
+            for chunk in _chunks(sources):
+                query = f"SELECT source, count FROM region_uses WHERE region = ? AND source IN ({','.join('?'*len(chunk))})"
+                stored.update(cursor.execute(query, (region, *chunk)))
+        with self._lock:
+            for source in sources:
+                self._uses[region, source] = self._uses.get((region, source), 0) + 1
+            frequent = [
+                source for source in sources
+                if stored.get(source, 0) + self._uses[region, source] >= self.parameters["min_uses"]]
+        self._maybe_flush()
+        return frequent
+
+    def save(self, region: str, rows: Dict[int, Row], cutoff: float) -> int:
+        """Writes the rows, computed up to `cutoff`, along with the counted uses
+
+        Returns the number of rows written
+        """
+        if not rows:
+            return 0
+        now = time.time()
+        with self._lock:
+            self._last_used.update(((region, int(source)), now) for source in rows)
+        with self._transaction() as cursor:
+            self._write_counts(cursor)
+            cursor.executemany(
+                "INSERT OR REPLACE INTO region_rows VALUES (?, ?, ?, ?, ?, ?, ?)", [
+                    (region, int(source), cutoff,
+                     np.ascontiguousarray(targets, dtype=np.int64).tobytes(),
+                     np.ascontiguousarray(lengths, dtype=np.float64).tobytes(),
+                     np.ascontiguousarray(predecessors, dtype=np.int32).tobytes(),
+                     now)
+                    for source, (targets, lengths, predecessors) in rows.items()])
+            cursor.execute(
+                "DELETE FROM region_rows WHERE rowid IN "
+                "(SELECT rowid FROM region_rows ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.parameters["max_rows"],))
+        return len(rows)
+
+    def flush(self) -> None:
+        """Writes the uses counted since the last flush"""
+        with self._transaction() as cursor:
+            self._write_counts(cursor)
+
+    def __len__(self) -> int:
+        with self._read() as cursor:
+            return cursor.execute("SELECT COUNT(*) FROM region_rows").fetchone()[0]
+
+    def _maybe_flush(self) -> None:
+        if time.time() - self._flushed >= self.parameters["flush_interval"]:
+            self.flush()
+
+    def _write_counts(self, cursor: sqlite3.Cursor) -> None:
+        with self._lock:
+            uses, self._uses = self._uses, {}
+            last_used, self._last_used = self._last_used, {}
+            self._flushed = time.time()
+        cursor.executemany(
+            "INSERT INTO region_uses VALUES (?, ?, ?) "
+            "ON CONFLICT (region, source) DO UPDATE SET count = count + excluded.count",
+            [(region, source, count) for (region, source), count in uses.items()])
+        cursor.executemany(
+            "UPDATE region_rows SET last_used = MAX(last_used, ?) WHERE region = ? AND source = ?",
+            [(used, region, source) for (region, source), used in last_used.items()])
+
+    def _cursor(self) -> sqlite3.Cursor:
+        # Connections must not be shared with forked processes, e.g. gunicorn workers
+        if self._pid != os.getpid():
+            self._connection = sqlite3.connect(
+                self.path, timeout=30, check_same_thread=False, isolation_level=None)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._pid = os.getpid()
+        return self._connection.cursor()
+
+    @contextmanager
+    def _read(self) -> Iterator[sqlite3.Cursor]:
+        """Autocommit reads, which WAL mode serves without blocking or being blocked by writers"""
+        with self._lock:
+            yield self._cursor()
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Cursor]:
+        """Serialises the threads sharing the connection, sqlite serialises the processes"""
+        with self._lock:
+            cursor = self._cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                yield cursor
+            except BaseException:
+                cursor.execute("ROLLBACK")
+                raise
+            cursor.execute("COMMIT")
+
+
+def region_row(targets: np.ndarray, lengths: np.ndarray, predecessors: np.ndarray) -> Row:
+    """Row of the reached nodes, from `targets` sorted OSM ids with their `lengths` and the
+    position in `targets` of each node's predecessor, negative for the source
+    """
+    return (
+        np.asarray(targets, dtype=np.int64), np.asarray(lengths, dtype=np.float64),
+        np.where(np.asarray(predecessors) < 0, -1, predecessors).astype(np.int32))
+
+
+def slice_row(row: Row, node_ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Lengths and predecessors of a region row over a slice of the region, aligned with its sorted OSM `node_ids`
+
+    A region's shortest path is also the slice's when every node on it is in the slice. Other
+    nodes, and nodes beyond the row's cutoff, are unknown: their length is NaN. Predecessors are
+    positions in `node_ids`, -1 for the source and unknown nodes.
+    """
+    targets, lengths, predecessors = row
+    positions = np.minimum(np.searchsorted(node_ids, targets), max(len(node_ids) - 1, 0))
+    valid = node_ids[positions] == targets if len(node_ids) else np.zeros(len(targets), dtype=bool)
+
+    # Pointer jumping: after k rounds a node is valid when its 2^k nearest ancestors are in the slice
+    ancestors = np.where(predecessors < 0, np.arange(len(targets)), predecessors)
+    while True:
+        valid = valid & valid[ancestors]
+        next_ancestors = ancestors[ancestors]
+        if np.array_equal(next_ancestors, ancestors):
+            break
+        ancestors = next_ancestors
+
+    slice_lengths = np.full(len(node_ids), np.nan)
+    slice_lengths[positions[valid]] = lengths[valid]
+    slice_predecessors = np.full(len(node_ids), -1, dtype=np.int64)
+    has_predecessor = valid & (predecessors >= 0)
+    slice_predecessors[positions[has_predecessor]] = positions[predecessors[has_predecessor]]
+    return slice_lengths, slice_predecessors
+
+
+def _chunks(values, size: int = 500):
+    """sqlite limits the number of parameters in a query"""
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
@@ -1,11 +1,24 @@
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+from pathlib import Path
+
 import click
+import numpy as np
+
+from running_routes import registry
+from running_routes.deadline import Deadline, MODEL_SHARE
+from running_routes.metrics import PipelineMetrics
+from running_routes.profiling import RequestProfiler
+from running_routes.tour import Tour, as_tours
 
-from running_routes.assembler import TourAssembler, AssemblerFactory
-from running_routes.local_search import LocalSearchFactory, BacktrackEliminationLocalSearch
-from running_routes.model import ModelFactory, CPModel
-from running_routes.network import NetworkFactory, OSMNetwork
+from typing import Dict, List, Optional, Tuple, TYPE_CHECKING
 
-from typing import Dict, List, Optional
+# Implementations are resolved through the registry, so importing the pipeline stays fast
+if TYPE_CHECKING:
+    from running_routes.assembler import AssemblerFactory
+    from running_routes.local_search import LocalSearchFactory
+    from running_routes.model import ModelFactory
+    from running_routes.network import NetworkFactory
 
 _HELP_COMMAND_STRING = """I want to run {distance}m, {n} times , around {lat, lng}.
 
@@ -16,18 +29,163 @@ distance = 200, n = 5, lat = -37.8102361, lng = 144.9627652
 """
 
 
+# State shared with the local search worker processes
+_WORKER_STATE: Dict = {}
+
+
+class LocalSearchPool:
+    """Long-lived processes that run the local searches of many requests
+
+    Create one per server process, e.g. in gunicorn's `post_fork` hook, before the process starts
+    any threads: the workers are started here, once, never while a request is running. Each tour
+    is sent with the node ids, coordinates and adjacency of the request's network, see
+    `running_routes.network.ArrayNetwork`, so the workers search the caller's network without
+    downloading or building one. Where several paths are shortest a worker may take another one
+    than the caller's network would.
+    """
+
+    def __init__(self, workers: int, local_searches: List["LocalSearchFactory"]):
+        self.workers = workers
+        # Forked where possible for a fast start, the workers need nothing that does not pickle
+        self.executor = ProcessPoolExecutor(
+            max_workers=workers, mp_context=_fork_context(), initializer=_initialise_pool_worker,
+            initargs=(local_searches,))
+        # Start every worker now rather than on the first request
+        list(self.executor.map(_ping, range(workers)))
+
+    def search(self, tours: List[Tour], distance: int, network: "NetworkFactory") -> List[Tour]:
+        arrays = (network.node_ids, network.coordinates, network.adjacency())
+        tasks = [(arrays, distance, tour.indices, tour.leg_lengths) for tour in as_tours(tours, network)]
+        return [
+            Tour(indices, network.node_ids, leg_lengths)
+            for indices, leg_lengths in self.executor.map(_search_pool_tour, tasks)]
+
+    def shutdown(self) -> None:
+        self.executor.shutdown()
+
+
 def pipeline(
         n: int, start_coordinate: Dict, distance: int,
-        network: NetworkFactory, model: ModelFactory,
-        assembler: AssemblerFactory,
-        local_searches: Optional[List[LocalSearchFactory]] = None,
+        network: "NetworkFactory", model: "ModelFactory",
+        assembler: "AssemblerFactory",
+        local_searches: Optional[List["LocalSearchFactory"]] = None,
+        workers: int = 1,
+        metrics: Optional[PipelineMetrics] = None,
+        deadline: Optional[float] = None,
+        pool: Optional[LocalSearchPool] = None,
 ):
-    network.create(start_coordinate, distance)
-    tours = model.solve(n, distance, start_coordinate, network)
+    """Runs every stage, within `deadline` seconds when given
+
+    The local searches run in `pool` when given. Otherwise `workers` processes are forked for this
+    call only, which suits a single run, e.g. the CLI, but not a threaded server.
+
+    Under a deadline the model adapts its sample size and solver time limit to the time left
+    after the network is created, and the local search is skipped once the deadline has passed.
+    Every such degradation is recorded in `metrics.degradations`.
+    """
+    metrics = metrics or PipelineMetrics()
+    local_searches = local_searches or []
+    budget = Deadline(deadline) if deadline is not None else None
+    with metrics.stage("network"):
+        network.create(start_coordinate, distance)
+    with metrics.stage("model"):
+        # Possibly coarser than `network`, its tours are made of `network` nodes
+        model_network = network.model_view()
+        if budget:
+            tours = model.solve(n, distance, start_coordinate, model_network, deadline=budget.split(MODEL_SHARE))
+        else:
+            tours = model.solve(n, distance, start_coordinate, model_network)
+        if model_network is not network:
+            # Positions and leg lengths refer to the model's network
+            tours = [Tour.from_nodes(tour.nodes(), network) for tour in tours]
+    with metrics.stage("local_search"):
+        if budget and budget.expired() and local_searches:
+            budget.degrade("local_search", "local_searches", len(local_searches), 0)
+        else:
+            if pool is not None and local_searches and len(tours) > 1:
+                tours = pool.search(tours, distance, network)
+            else:
+                tours = _local_search(tours, distance, network, local_searches, workers)
+    with metrics.stage("assembler"):
+        routes = assembler.generate_output(tours, distance, network)
+
+    metrics.record_statistics("network", getattr(network, "statistics", None))
+    metrics.record_statistics("model", getattr(model, "statistics", None))
+    if budget:
+        metrics.record_degradations(deadline, budget.degradations)
+    return routes
+
+
+def _local_search(
+        tours: List[Tour], distance: int, network: "NetworkFactory",
+        local_searches: List["LocalSearchFactory"], workers: int = 1) -> List[Tour]:
+    """Chains `local_searches` over each tour, spreading the tours across `workers` processes
+
+    Tours are independent of each other, so each worker runs the whole chain for one tour.
+    Workers are forked where possible so the network is shared copy-on-write instead of pickled.
+    """
+    if not local_searches:
+        return tours
+    if workers <= 1 or len(tours) <= 1:
+        return [_chain_local_searches(tour, distance, network, local_searches) for tour in tours]
+
+    with ProcessPoolExecutor(
+            max_workers=min(workers, len(tours)), mp_context=_fork_context(),
+            initializer=_initialise_worker, initargs=(distance, network, local_searches)) as executor:
+        # Tours cross processes as arrays, the workers already hold the node store
+        arrays = [(tour.indices, tour.leg_lengths) for tour in as_tours(tours, network)]
+        return [
+            Tour(indices, network.node_ids, leg_lengths)
+            for indices, leg_lengths in executor.map(_search_tour, arrays)]
+
+
+def _chain_local_searches(
+        tour: Tour, distance: int, network: "NetworkFactory",
+        local_searches: List["LocalSearchFactory"]) -> Tour:
+    tours = [tour]
     for local_search in local_searches:
         tours = local_search.iterate(tours, distance, network)
-    routes = assembler.generate_output(tours, distance, network)
-    return routes
+    return tours[0]
+
+
+def _initialise_worker(distance: int, network: "NetworkFactory", local_searches: List["LocalSearchFactory"]) -> None:
+    _WORKER_STATE["distance"] = distance
+    _WORKER_STATE["network"] = network
+    _WORKER_STATE["local_searches"] = local_searches
+
+
+def _fork_context():
+    if "fork" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("fork")
+    return None
+
+
+def _initialise_pool_worker(local_searches: List["LocalSearchFactory"]) -> None:
+    _WORKER_STATE["local_searches"] = local_searches
+
+
+def _ping(_) -> None:
+    pass
+
+
+def _search_pool_tour(task: Tuple[Tuple, int, np.ndarray, np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+    # Imported here, the parent imports the network through the registry
+    from running_routes.network import ArrayNetwork
+
+    arrays, distance, indices, leg_lengths = task
+    network = ArrayNetwork(*arrays)
+    tour = _chain_local_searches(
+        Tour(indices, network.node_ids, leg_lengths), distance, network, _WORKER_STATE["local_searches"])
+    return tour.indices, tour.leg_lengths
+
+
+def _search_tour(arrays: Tuple[np.ndarray, np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+    network = _WORKER_STATE["network"]
+    indices, leg_lengths = arrays
+    tour = _chain_local_searches(
+        Tour(indices, network.node_ids, leg_lengths), _WORKER_STATE["distance"], network,
+        _WORKER_STATE["local_searches"])
+    return tour.indices, tour.leg_lengths
 
 
 @click.command(context_settings=dict(max_content_width=600), help=_HELP_COMMAND_STRING)
@@ -35,16 +193,46 @@ def pipeline(
 @click.option("--n", type=click.IntRange(1, 10), required=True)
 @click.option("--lat", type=float, required=True)
 @click.option("--lng", type=float, required=True)
-def _cli(distance, n, lat, lng):
-    network = OSMNetwork()
-    model = CPModel()
-    local_searches = [BacktrackEliminationLocalSearch()]
-    assembler = TourAssembler()
-
-    routes = pipeline(
-        n, {"lat": lat, "lng": lng}, distance,
-        network=network, model=model, local_searches=local_searches,
-        assembler=assembler)
+@click.option("--workers", type=click.IntRange(1), default=1, show_default=True,
+              help="Number of processes used by the local search")
+@click.option("--model", "model_name", type=click.Choice(registry.names("model")), default="cp", show_default=True)
+@click.option("--local-search", "local_search_names", type=click.Choice(registry.names("local_search")),
+              multiple=True, default=["backtrack_elimination"], show_default=True,
+              help="Local searches chained in the order given")
+@click.option("--profile-dir", type=click.Path(file_okay=False), default=None,
+              help="Write a cProfile profile and the solver statistics of this run to the directory")
+@click.option("--deadline", type=click.FloatRange(0, min_open=True), default=None,
+              help="Seconds the whole pipeline should take, the model adapts its effort to it")
+@click.option("--mapped-graph", type=click.Path(file_okay=False, exists=True), default=None,
+              help="Slice the network from a regional graph written by running_routes.mapped_graph")
+@click.option("--coarsen", is_flag=True, default=False,
+              help="Model long runs on a coarsened copy of the OSM network")
+def _cli(distance, n, lat, lng, workers, profile_dir, model_name, local_search_names, mapped_graph, deadline, coarsen):
+    if mapped_graph:
+        network = registry.create("network", "mapped", directory=mapped_graph)
+    else:
+        network = registry.create("network", "osm", coarsen=coarsen)
+    model = registry.create("model", model_name)
+    local_searches = [registry.create("local_search", name) for name in local_search_names]
+    assembler = registry.create("assembler", "tour")
+    metrics = PipelineMetrics()
+
+    def run_pipeline():
+        return pipeline(
+            n, {"lat": lat, "lng": lng}, distance,
+            network=network, model=model, local_searches=local_searches,
+            assembler=assembler, workers=workers, metrics=metrics, deadline=deadline)
+
+    if profile_dir:
+        arguments = {"distance": distance, "n": n, "lat": lat, "lng": lng}
+        with RequestProfiler(profile_dir).profile(metadata={"arguments": arguments}) as profile:
+            try:
+                routes = run_pipeline()
+            finally:
+                profile["metrics"] = metrics.as_dict()
+        click.echo(f"""Profile written to {Path(profile_dir) / profile["request_id"]}""", err=True)
+    else:
+        routes = run_pipeline()
 
     for route in routes:
         print(route)
@@ -0,0 +1,115 @@
+"""Warms the networks of hot start points before they are requested
+
+Each hot region is a start point and run distance, e.g. a park's entrance and 5000m. Warming
+creates a network dedicated to the region, which downloads its graph into the graph cache,
+builds the contraction hierarchy of the graph's region if enabled and missing, and its node store
+and spatial index, samples it with the model,
+whose KMeans centres are cached, and answers the shortest paths from the start node to the sample.
+Requests for the region are then served by its warm network, whose `create` is a no-op.
+"""
+import json
+import logging
+from pathlib import Path
+import threading
+import time
+
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Tuple
+
+if TYPE_CHECKING:
+    from running_routes.model import ModelFactory
+    from running_routes.network import NetworkFactory
+
+logger = logging.getLogger(__name__)
+
+
+class Prewarmer:
+    """Warms `regions`, dicts of `lat`, `lng` and `distance`, with networks built by `build_network`
+
+    `ready` is set once every region has been attempted, a region that fails to warm is
+    reported by `status` and served like any other request.
+    """
+
+    def __init__(
+            self, regions: List[Dict], build_network: Callable[[], "NetworkFactory"],
+            model: "ModelFactory", network_type: str = "walk"):
+        self.regions = regions
+        self.build_network = build_network
+        self.model = model
+        self.network_type = network_type
+        self.ready = threading.Event()
+        self.networks: Dict[Tuple, "NetworkFactory"] = {}
+        self.errors: Dict[Tuple, str] = {}
+        self.seconds: Dict[Tuple, float] = {}
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        if not regions:
+            self.ready.set()
+
+    def warm(self) -> None:
+        for region in self.regions:
+            key = region_key(region)
+            if key in self.networks:
+                continue
+            start = time.perf_counter()
+            try:
+                self.networks[key] = self._warm_region(region)
+            except Exception as error:
+                logger.exception("Failed to warm %s", key)
+                self.errors[key] = repr(error)
+            self.seconds[key] = round(time.perf_counter() - start, 3)
+        self.ready.set()
+
+    def start(self) -> threading.Thread:
+        """Warms in a background thread, once"""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self.warm, name="prewarm", daemon=True)
+                self._thread.start()
+            return self._thread
+
+    def network_for(self, start_coordinate: Dict, distance: int) -> Optional["NetworkFactory"]:
+        """Warm network of the region, or None, `start_coordinate` must be rounded like the regions"""
+        return self.networks.get(region_key(dict(start_coordinate, distance=distance)))
+
+    def status(self) -> Dict:
+        return {
+            "ready": self.ready.is_set(),
+            "regions": [
+                {
+                    "lat": key[0], "lng": key[1], "distance": key[2],
+                    "warm": key in self.networks,
+                    "seconds": self.seconds.get(key),
+                    **({"error": self.errors[key]} if key in self.errors else {}),
+                }
+                for key in map(region_key, self.regions)],
+        }
+
+    def _warm_region(self, region: Dict) -> "NetworkFactory":
+        start_coordinate = {"lat": region["lat"], "lng": region["lng"]}
+        network = self.build_network()
+        network.create(start_coordinate, region["distance"], self.network_type)
+        network.preprocess()
+        model_network = network.model_view()
+        sample_nodes = self.model.sample(start_coordinate, model_network)
+        # Tours start and end at the first sample node. Point-to-point queries, as `lengths` runs
+        # on a loaded hierarchy without caching anything, while `length` caches the hierarchy's
+        # answers and searches the graph where they leave it
+        depot = sample_nodes[0]
+        for warmed_network in {id(network): network, id(model_network): model_network}.values():
+            for node in sample_nodes:
+                warmed_network.length(depot, node)
+        return network
+
+
+def region_key(region: Dict) -> Tuple:
+    return (region["lat"], region["lng"], int(region["distance"]))
+
+
+def load_regions(path: Path, precision: int) -> List[Dict]:
+    """Reads a json list of regions, rounding their coordinates like request coordinates"""
+    with Path(path).open() as f:
+        regions = json.load(f)
+    return [
+        {"lat": round(float(region["lat"]), precision), "lng": round(float(region["lng"]), precision),
+         "distance": int(region["distance"])}
+        for region in regions]
@@ -0,0 +1,101 @@
+"""Opt-in cProfile capture of single pipeline requests
+
+Each profiled request writes to `<directory>/<request_id>/`
+- `profile.prof`: raw cProfile output, open with `python -m pstats` or snakeviz
+- `profile.txt`: the slowest functions by cumulative time
+- `metadata.json`: request arguments and the pipeline metrics, including OR-tools search statistics
+"""
+from collections import deque
+from contextlib import contextmanager
+import cProfile
+import io
+import json
+from pathlib import Path
+import pstats
+import re
+import threading
+import time
+import uuid
+
+from typing import Dict, Iterator, Optional
+
+# Number of functions kept in the text summary
+SUMMARY_LENGTH = 50
+
+
+class RateLimiter:
+    """Allows at most `limit` events in any sliding window of `period` seconds"""
+
+    def __init__(self, limit: int = 1, period: float = 60):
+        self.limit = limit
+        self.period = period
+        self._events = deque()
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            while self._events and now - self._events[0] >= self.period:
+                self._events.popleft()
+            if len(self._events) >= self.limit:
+                return False
+            self._events.append(now)
+            return True
+
+
+class RequestProfiler:
+    """Profiles requests that ask for it, within the rate limit
+
+    Profiling slows a request down noticeably, the rate limit keeps it from
+    being used to degrade the service.
+    """
+
+    def __init__(self, directory: Path, limit: int = 1, period: float = 60):
+        self.directory = Path(directory)
+        self.rate_limiter = RateLimiter(limit, period)
+        # cProfile can only profile one request at a time
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        return self.rate_limiter.allow()
+
+    @contextmanager
+    def profile(self, request_id: Optional[str] = None, metadata: Optional[Dict] = None) -> Iterator[Dict]:
+        """Profiles the block and writes the artifacts once it finishes
+
+        Yields `metadata`, so the caller can add to it, e.g. the request's metrics
+        """
+        request_id = sanitise_request_id(request_id)
+        metadata = dict(metadata or {}, request_id=request_id)
+        profiler = cProfile.Profile()
+        with self._lock:
+            start = time.perf_counter()
+            profiler.enable()
+            try:
+                yield metadata
+            except Exception as error:
+                metadata["error"] = repr(error)
+                raise
+            finally:
+                profiler.disable()
+                metadata["seconds"] = time.perf_counter() - start
+                self._write(request_id, profiler, metadata)
+
+    def _write(self, request_id: str, profiler: cProfile.Profile, metadata: Dict) -> Path:
+        directory = self.directory / request_id
+        directory.mkdir(parents=True, exist_ok=True)
+        profiler.dump_stats(directory / "profile.prof")
+
+        summary = io.StringIO()
+        pstats.Stats(profiler, stream=summary).sort_stats("cumulative").print_stats(SUMMARY_LENGTH)
+        (directory / "profile.txt").write_text(summary.getvalue())
+
+        with (directory / "metadata.json").open("w") as f:
+            json.dump(metadata, f, indent=2, default=str)
+        return directory
+
+
+def sanitise_request_id(request_id: Optional[str]) -> str:
+    """Request ids become directory names, so only keep safe characters"""
+    request_id = re.sub(r"[^A-Za-z0-9_.-]", "", request_id or "").lstrip(".")[:64]
+    return request_id or uuid.uuid4().hex
@@ -0,0 +1,66 @@
+"""Resolves networks, models, local searches and assemblers by name
+
+Implementations are registered as import paths, so their heavy dependencies (osmnx,
+ortools, scikit-learn, shapely) are only imported when an implementation is first used.
+`preload` imports everything up front, e.g. in a gunicorn master before it forks workers.
+"""
+import importlib
+import threading
+
+from typing import Dict, Iterable, Optional
+
+REGISTRY: Dict[str, Dict[str, str]] = {
+    "network": {
+        "osm": "running_routes.network:OSMNetwork",
+        "mapped": "running_routes.network:MappedNetwork",
+    },
+    "model": {
+        "cp": "running_routes.model:CPModel",
+        "savings": "running_routes.model:SavingsModel",
+    },
+    "local_search": {
+        "backtrack_elimination": "running_routes.local_search:BacktrackEliminationLocalSearch",
+    },
+    "assembler": {
+        "tour": "running_routes.assembler:TourAssembler",
+        "rest_api": "running_routes.assembler:RestAPIAssembler",
+    },
+}
+
+_resolved: Dict[str, type] = {}
+_lock = threading.Lock()
+
+
+def register(kind: str, name: str, path: str) -> None:
+    """Registers `path`, formatted as `module:attribute`, as the implementation `name` of `kind`"""
+    REGISTRY.setdefault(kind, {})[name] = path
+    _resolved.pop(path, None)
+
+
+def names(kind: str) -> Iterable[str]:
+    return list(REGISTRY[kind])
+
+
+def resolve(kind: str, name: str) -> type:
+    try:
+        path = REGISTRY[kind][name]
+    except KeyError:
+        raise ValueError(f"Unknown {kind} {name}, expected one of {names(kind) if kind in REGISTRY else []}")
+
+    if path not in _resolved:
+        with _lock:
+            module_name, attribute = path.split(":")
+            _resolved[path] = getattr(importlib.import_module(module_name), attribute)
+    return _resolved[path]
+
+
+def create(kind: str, name: str, **parameters):
+    """Instantiates the implementation `name` of `kind`"""
+    return resolve(kind, name)(**parameters)
+
+
+def preload(kinds: Optional[Iterable[str]] = None) -> None:
+    """Imports every registered implementation of `kinds`, defaults to all kinds"""
+    for kind in kinds or list(REGISTRY):
+        for name in names(kind):
+            resolve(kind, name)
@@ -0,0 +1,60 @@
+"""Coalesces concurrent identical calls into one computation"""
+import threading
+
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+        # Callers attached after the first one
+        self.waiters = 0
+
+
+class SingleFlight:
+    """Runs at most one call per key at a time
+
+    Callers arriving while a call with the same key is in flight wait for it and share its
+    result, or its exception, instead of starting their own. Finished calls are not cached.
+    `on_complete(key, callers)` is called once per computation with the number of callers it served.
+    """
+
+    def __init__(self, on_complete: Optional[Callable[[Hashable, int], None]] = None):
+        self.on_complete = on_complete
+        self._calls: Dict[Hashable, _Call] = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: Hashable, function: Callable[[], Any]) -> Tuple[Any, bool]:
+        """Returns the result of `function` and whether it was shared with an earlier caller"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                call.waiters += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = function()
+        except BaseException as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+            if self.on_complete:
+                self.on_complete(key, 1 + call.waiters)
+        return call.result, False
+
+    def waiters(self) -> Dict[Hashable, int]:
+        """Callers waiting on each in-flight key, excluding the caller computing it"""
+        with self._lock:
+            return {key: call.waiters for key, call in self._calls.items()}
@@ -0,0 +1,107 @@
+"""Downloads large areas from the Overpass API as tiles fetched in parallel
+
+A single Overpass query for a 5 km radius is slow and prone to time out. The area is split
+into square tiles, each tile is downloaded on a thread pool with osmnx's `graph_from_bbox`,
+failed downloads are retried with exponential backoff, and the unsimplified tile graphs are
+composed into one graph and simplified once, so streets crossing tile borders join up.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import inspect
+import math
+import time
+
+import networkx as nx
+import osmnx
+
+from running_routes.geometry import degree_deltas, great_circle
+
+from typing import Dict, List, Optional, Tuple
+
+TILED_FETCH_DEFAULT_PARAMETERS = {
+    # Meters along each side of a tile
+    "tile_size": 2000,
+    "workers": 4,
+    "retries": 4,
+    # Retries wait backoff * 2**(retry - 1) seconds
+    "backoff": 0.5,
+}
+
+Bounds = Tuple[float, float, float, float]
+
+
+class TiledFetcher:
+    """Shared by concurrent downloads, so it keeps no state about any one of them"""
+
+    def __init__(self, **parameters):
+        self.parameters = parameters
+
+        # Set default parameters
+        for key, value in TILED_FETCH_DEFAULT_PARAMETERS.items():
+            if key not in self.parameters:
+                self.parameters[key] = value
+
+    def fetch(self, start_coordinate: Dict, radius: float, network_type: str) -> Tuple[nx.MultiDiGraph, Dict]:
+        """Graph of every street in the tiles that overlap the circle of `radius` around `start_coordinate`
+
+        The graph reaches past the circle, the caller truncates it. Also returns the download's
+        `tiles_total` and `retries_total`.
+        """
+        tiles = circle_tiles(start_coordinate, radius, self.parameters["tile_size"])
+        with ThreadPoolExecutor(max_workers=min(self.parameters["workers"], len(tiles))) as executor:
+            results = list(executor.map(lambda tile: self._download_tile(tile, network_type), tiles))
+
+        graphs = [graph for graph, _ in results if graph is not None]
+        if not graphs:
+            raise ValueError("Found no graph nodes within the requested polygon")
+        # Ways crossing tile borders are returned by every tile they cross, composing merges them by OSM id
+        G = osmnx.simplify_graph(nx.compose_all(graphs))
+        return G, {"tiles_total": len(tiles), "retries_total": sum(retries for _, retries in results)}
+
+    def _download_tile(self, tile: Bounds, network_type: str) -> Tuple[Optional[nx.MultiDiGraph], int]:
+        """The tile's unsimplified graph, None for a tile without streets, and the retries it took"""
+        for retry in range(self.parameters["retries"] + 1):
+            try:
+                G = osmnx.graph_from_bbox(
+                    **_bbox_arguments(tile), network_type=network_type,
+                    simplify=False, retain_all=True, truncate_by_edge=True)
+                return G, retry
+            except Exception as error:
+                if _is_empty_tile(error):
+                    return None, retry
+                if retry == self.parameters["retries"]:
+                    raise
+                time.sleep(self.parameters["backoff"]*2**retry)
+
+
+def circle_tiles(start_coordinate: Dict, radius: float, tile_size: float) -> List[Bounds]:
+    """(south, west, north, east) of the square tiles covering the circle, skipping tiles outside it"""
+    lat, lng = start_coordinate["lat"], start_coordinate["lng"]
+    lat_delta, lng_delta = degree_deltas(lat, radius)
+    count = max(1, math.ceil(2*radius/tile_size))
+    lat_step, lng_step = 2*lat_delta/count, 2*lng_delta/count
+
+    tiles = []
+    for row in range(count):
+        for column in range(count):
+            south, west = lat - lat_delta + row*lat_step, lng - lng_delta + column*lng_step
+            north, east = south + lat_step, west + lng_step
+            # Closest point of the tile to the centre
+            closest_lat, closest_lng = min(max(lat, south), north), min(max(lng, west), east)
+            if great_circle(lat, lng, closest_lat, closest_lng) <= radius:
+                tiles.append((south, west, north, east))
+    return tiles
+
+
+def _bbox_arguments(tile: Bounds) -> Dict:
+    south, west, north, east = tile
+    # osmnx 1.9 takes the bounds as one `bbox`, earlier releases as separate arguments
+    if "bbox" in inspect.signature(osmnx.graph_from_bbox).parameters:
+        return {"bbox": (north, south, east, west)}
+    return {"north": north, "south": south, "east": east, "west": west}
+
+
+def _is_empty_tile(error: Exception) -> bool:
+    """osmnx reports a tile without streets, e.g. over water, under different names across releases"""
+    return (
+        type(error).__name__ in ("EmptyOverpassResponse", "InsufficientResponseError")
+        or "no graph nodes" in str(error).lower())
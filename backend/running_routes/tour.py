@@ -0,0 +1,78 @@
+"""Tours passed between the model, local search and assembler stages
+
+A tour stores the positions of its nodes in the network's node store as an int32 array, and
+the length of each leg, so stages look up coordinates and route distances with array indexing
+instead of per node dict lookups and shortest path queries. Node ids are only materialised
+where a network method needs them, e.g. `network.path`.
+
+Tours still behave as sequences of node ids, so code and tests written against lists of
+node ids keep working, and stages accept plain lists through `as_tours`.
+"""
+from collections.abc import Sequence
+
+import numpy as np
+
+from typing import Iterator, List, Optional, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from running_routes.network import NetworkFactory
+
+
+class Tour(Sequence):
+    __slots__ = ("indices", "leg_lengths", "node_ids")
+
+    def __init__(self, indices: np.ndarray, node_ids: np.ndarray, leg_lengths: np.ndarray):
+        self.indices = np.asarray(indices, dtype=np.int32)
+        # The network's node store, shared by every tour on the network
+        self.node_ids = node_ids
+        self.leg_lengths = np.asarray(leg_lengths, dtype=np.float64)
+        if len(self.leg_lengths) != max(len(self.indices) - 1, 0):
+            raise ValueError(f"{len(self.indices)} nodes need {len(self.indices) - 1} leg lengths")
+
+    @classmethod
+    def from_nodes(
+            cls, nodes, network: "NetworkFactory", leg_lengths: Optional[List[float]] = None) -> "Tour":
+        """Tour through the node ids `nodes`, leg lengths are looked up in `network` unless given"""
+        nodes = nodes.tolist() if isinstance(nodes, np.ndarray) else list(nodes)
+        if leg_lengths is None:
+            leg_lengths = [network.length(source, target) for source, target in zip(nodes, nodes[1:])]
+        return cls(network.node_index(nodes), network.node_ids, leg_lengths)
+
+    def nodes(self) -> np.ndarray:
+        return self.node_ids[self.indices]
+
+    def coordinates(self, network: "NetworkFactory") -> np.ndarray:
+        """(lat, lng) of each node, `network` must be the network the tour was built on"""
+        return network.coordinates[self.indices]
+
+    @property
+    def length(self) -> float:
+        return float(self.leg_lengths.sum())
+
+    def __len__(self) -> int:
+        return len(self.indices)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.node_ids[self.indices[index]].tolist()
+        return self.node_ids[self.indices[index]].item()
+
+    def __iter__(self) -> Iterator:
+        return iter(self.nodes().tolist())
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, Tour):
+            return np.array_equal(self.nodes(), other.nodes())
+        if isinstance(other, (list, tuple, np.ndarray)):
+            return self.nodes().tolist() == list(other)
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self) -> str:
+        return f"Tour({self.nodes().tolist()})"
+
+
+def as_tours(tours, network: "NetworkFactory") -> List[Tour]:
+    """Converts tours given as lists of node ids, leaving tours as they are"""
+    return [tour if isinstance(tour, Tour) else Tour.from_nodes(tour, network) for tour in tours]
@@ -0,0 +1,12 @@
+import pytest
+
+from benchmarks.fixtures import grid_graph
+from running_routes.network import OSMNetwork
+
+
+@pytest.fixture
+def grid_network():
+    """A 5x5 grid network, so tests do not need to download OSM data"""
+    network = OSMNetwork()
+    network.graph = grid_graph()
+    return network
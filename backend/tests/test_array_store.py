@@ -0,0 +1,33 @@
+import json
+
+import numpy as np
+
+from running_routes.array_store import META_FILE, read_arrays, write_arrays
+
+
+def test_versions(tmp_path):
+    directory = write_arrays(tmp_path / "region", {"values": np.arange(3)}, {"version": "a"})
+    version, meta, arrays = read_arrays(directory, ["values"])
+    assert meta == {"version": "a"} and arrays["values"].tolist() == [0, 1, 2]
+
+    # The directory is repointed at the new version, readers keep the version they opened
+    write_arrays(directory, {"values": np.arange(4)}, {"version": "b"})
+    assert read_arrays(directory, ["values"])[1] == {"version": "b"}
+    assert version.exists() and arrays["values"].tolist() == [0, 1, 2]
+
+    # Only the current and previous versions are kept
+    write_arrays(directory, {"values": np.arange(5)}, {"version": "c"})
+    assert not version.exists()
+    assert len([path for path in tmp_path.iterdir() if path.is_dir() and not path.is_symlink()]) == 2
+
+
+def test_unversioned_directory(tmp_path):
+    # A directory written before versions were linked
+    directory = tmp_path / "region"
+    directory.mkdir()
+    np.save(directory / "values.npy", np.arange(3))
+    (directory / META_FILE).write_text(json.dumps({"version": "a"}))
+
+    write_arrays(directory, {"values": np.arange(4)}, {"version": "b"})
+    assert directory.is_symlink()
+    assert read_arrays(directory, ["values"])[2]["values"].tolist() == [0, 1, 2, 3]
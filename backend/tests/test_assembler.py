@@ -1,6 +1,7 @@
 import pytest
 
-from running_routes.assembler import RestAPIAssembler, TourAssembler
+from running_routes.assembler import RestAPIAssembler, TourAssembler, decode_polyline, encode_polyline, simplify
+from running_routes.geometry import METERS_PER_DEGREE
 from running_routes.network import OSMNetwork
 
 
@@ -59,4 +60,42 @@ class TestRestAPIAssembler:
         ]
         routes = rest_api_assembler.generate_output(tours, distance, network)
         assert routes["routes"][0]["coordinates"] == coordinates
-        assert int(routes["routes"][0]["distance"]) == 175
\ No newline at end of file
+        assert int(routes["routes"][0]["distance"]) == 175
+
+    def test_generate_output_polyline(self, grid_network):
+        # The full street path is encoded, not just the tour nodes
+        tours = [[0, 12, 24, 0]]
+        assembler = RestAPIAssembler(output="polyline")
+        routes = assembler.generate_output(tours, 5000, grid_network)
+        coordinates = decode_polyline(routes["routes"][0]["polyline"], routes["precision"])
+        street_path = assembler._expand_tour(tours[0], grid_network)
+        assert len(coordinates) == len(street_path) > len(tours[0])
+        assert coordinates[0] == coordinates[-1]
+        assert int(routes["routes"][0]["distance"]) == int(sum(
+            grid_network.length(x, y) for x, y in zip(tours[0], tours[0][1:])))
+
+        # Straight streets collapse when simplified
+        assembler = RestAPIAssembler(output="polyline", tolerance=1)
+        routes = assembler.generate_output(tours, 5000, grid_network)
+        assert len(decode_polyline(routes["routes"][0]["polyline"])) < len(coordinates)
+
+    def test_invalid_output(self):
+        with pytest.raises(ValueError):
+            RestAPIAssembler(output="invalid")
+
+
+def test_simplify():
+    # A street running north at 60 degrees south, where a degree of longitude is half as long
+    lng_per_meter = 1/(METERS_PER_DEGREE*0.5)
+    coordinates = [[-60, 10], [-60.001, 10 + 8*lng_per_meter], [-60.002, 10]]
+    # 8 meters off the straight line
+    assert simplify(coordinates, tolerance=10) == [coordinates[0], coordinates[-1]]
+    assert simplify(coordinates, tolerance=5) == coordinates
+
+
+def test_encode_polyline():
+    # https://developers.google.com/maps/documentation/utilities/polylinealgorithm
+    coordinates = [[38.5, -120.2], [40.7, -120.95], [43.252, -126.453]]
+    assert encode_polyline(coordinates) == "_p~iF~ps|U_ulLnnqC_mqNvxq`@"
+    assert decode_polyline(encode_polyline(coordinates)) == coordinates
+    assert decode_polyline(encode_polyline(coordinates, precision=6), precision=6) == coordinates
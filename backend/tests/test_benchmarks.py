@@ -0,0 +1,21 @@
+from benchmarks.suite import compare, format_report
+
+
+def test_compare():
+    baseline = {"grid-small": {
+        "model": {"seconds": 1.0, "peak_bytes": 10*2**20},
+        "assembler": {"seconds": 1.0, "peak_bytes": 10*2**20},
+    }}
+    results = {"grid-small": {
+        # Slower than the baseline
+        "model": {"seconds": 1.5, "peak_bytes": 10*2**20},
+        # As fast, but with twice the peak memory
+        "assembler": {"seconds": 1.0, "peak_bytes": 20*2**20},
+        "network": {"seconds": 1.0, "peak_bytes": 10*2**20},
+    }}
+    rows = {row["stage"]: row for row in compare(results, baseline)}
+    assert rows["model"]["regression"] and rows["model"]["ratio"] == 1.5
+    assert rows["assembler"]["regression"] and rows["assembler"]["memory_ratio"] == 2
+    # Stages missing from the baseline are reported without a comparison
+    assert not rows["network"]["regression"] and rows["network"]["memory_ratio"] is None
+    assert "2.00x !" in format_report(list(rows.values()))
@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+
+from benchmarks.fixtures import grid_graph
+from running_routes.assembler import RestAPIAssembler
+from running_routes.catalogue import RouteCatalogue, grid_points, write_catalogue
+from running_routes.catalogue_build import build_catalogue
+from running_routes.geometry import great_circle_vec
+from running_routes.mapped_graph import write_mapped_graph
+
+
+@pytest.fixture(scope="module")
+def center():
+    G = grid_graph(30, 30)
+    return {"lat": G.nodes[465]["y"], "lng": G.nodes[465]["x"]}
+
+
+@pytest.fixture(scope="module")
+def catalogue(tmp_path_factory, center):
+    region = write_mapped_graph(grid_graph(30, 30), tmp_path_factory.mktemp("region") / "region")
+    grid, entries = build_catalogue(
+        center, radius=300, spacing=300, distances=[1000, 2000], n=2,
+        network_name="mapped", network_parameters={"directory": str(region)})
+    return RouteCatalogue(write_catalogue(grid, entries, tmp_path_factory.mktemp("catalogue") / "catalogue"))
+
+
+def test_grid_points(center):
+    grid, points = grid_points(center, radius=300, spacing=300)
+    assert [(row, column) for row, column, _ in points] == [(-1, 0), (0, -1), (0, 0), (0, 1), (1, 0)]
+    for row, column, point in points:
+        distance = great_circle_vec(center["lat"], center["lng"], point["lat"], point["lng"])
+        assert distance == pytest.approx(300*np.hypot(row, column), rel=0.01)
+
+
+def test_lookup(catalogue, center):
+    assert len(catalogue) == 10
+    match = catalogue.lookup(center, 2000, 2, max_offset=50)
+    assert match["point"] == pytest.approx(center)
+    assert len(match["routes"]) == 2
+    route = match["routes"][0]
+    # Tours run along their stored street path
+    assert route["path"][0] == pytest.approx(route["coordinates"][0])
+    assert route["distance"] > 0
+
+    # The nearest grid point within the offset answers, otherwise nothing does
+    north = dict(center, lat=center["lat"] + 0.0025)
+    assert catalogue.lookup(north, 2000, 2, max_offset=50)["offset"] < 50
+    assert catalogue.lookup(north, 2000, 2, max_offset=10) is None
+    assert catalogue.lookup(center, 3000, 2, max_offset=50) is None
+    assert catalogue.lookup(center, 2000, 3, max_offset=50) is None
+
+
+def test_format_routes(catalogue, center):
+    routes = catalogue.lookup(center, 1000, 1, max_offset=50)["routes"]
+    output = RestAPIAssembler(output="polyline", precision=6).format_routes(routes)
+    assert output["routes"][0]["distance"] == routes[0]["distance"]
+    output = RestAPIAssembler().format_routes(routes)
+    assert output["routes"][0]["coordinates"] == routes[0]["coordinates"].tolist()
+
+
+def test_rewrite(tmp_path, center):
+    grid, _ = grid_points(center, radius=300, spacing=300)
+    directory = write_catalogue(grid, [], tmp_path / "catalogue")
+    catalogue = RouteCatalogue(directory)
+    point = np.array([[center["lat"], center["lng"]]])
+    route = {"coordinates": point, "path": point, "distance": 1000.0}
+    write_catalogue(grid, [{"row": 0, "column": 0, "point": center, "distance": 1000, "routes": [route]}], directory)
+
+    # Readers opened before the rewrite keep their version, later readers see the new one
+    assert len(catalogue) == 0 and catalogue.directory.exists()
+    assert RouteCatalogue(directory).lookup(center, 1000, 1, max_offset=50)["routes"][0]["distance"] == 1000
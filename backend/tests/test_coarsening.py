@@ -0,0 +1,66 @@
+import math
+
+import networkx as nx
+import pytest
+
+from benchmarks import overpass
+from benchmarks.fixtures import grid_graph
+from running_routes.coarsening import coarsen_graph, merge_chains
+from running_routes.network import OSMNetwork
+
+# Centre of the 20x20 grid served by the stand-in
+CENTER = {"lat": -37.8102361 + 0.0095, "lng": 144.9627652 + 0.0095}
+
+
+def test_merge_chains():
+    H = nx.DiGraph()
+    # Two-way chain 0 - 1 - 2 - 3 branching at 3, and a one-way chain 3 -> 4 -> 0
+    for u, v in [(0, 1), (1, 2), (2, 3), (3, 5)]:
+        H.add_edge(u, v, length=1)
+        H.add_edge(v, u, length=1)
+    H.add_edge(3, 4, length=2)
+    H.add_edge(4, 0, length=2)
+
+    assert merge_chains(H) == 3
+    assert sorted(H.nodes) == [0, 3, 5]
+    assert H[0][3]["length"] == 3
+    assert H[3][0]["length"] == 3
+    assert H[3][5]["length"] == 1
+
+
+def test_coarsen_graph():
+    G = grid_graph(30, 30, spacing=0.0002)
+    coarse, members = coarsen_graph(G, 100)
+
+    assert len(coarse) < len(G)/10
+    # Super-nodes are labelled by one of their members, and every full node belongs to one
+    assert all(node in nodes for node, nodes in members.items())
+    assert sorted(node for nodes in members.values() for node in nodes) == sorted(
+        node for node in G.nodes if G.degree(node) > 4)
+    assert set(coarse.nodes) <= set(G.nodes)
+
+    # Coarse lengths undercount by at most a cell diagonal per super-node crossed
+    full_lengths = dict(nx.single_source_dijkstra_path_length(G, 0, weight="length"))
+    coarse_source = next(node for node, nodes in members.items() if 31 in nodes)
+    coarse_lengths = nx.single_source_dijkstra_path_length(coarse, coarse_source, weight="length")
+    for target, length in coarse_lengths.items():
+        hops = len(nx.shortest_path(coarse, coarse_source, target, weight="length"))
+        assert length <= full_lengths[target] + 2*100*math.sqrt(2)
+        assert length >= full_lengths[target] - 2*100*math.sqrt(2)*hops
+
+
+def test_model_view():
+    with overpass.serve(grid_graph(20, 20)):
+        network = OSMNetwork(coarsen=True, coarsen_min_distance=1000, coarsen_resolution=10)
+        network.create(CENTER, 2000)
+        view = network.model_view()
+        short_network = OSMNetwork(coarsen=True)
+        short_network.create(CENTER, 2000)
+
+    assert view is not network
+    assert 0 < network.statistics["coarse_nodes"] < network.statistics["nodes"]
+    # Tours over the view are tours over the full network
+    tour = list(view.graph.nodes)[:3]
+    assert network.path(tour[0], tour[1])[-1] == tour[1]
+    assert network.node_coordinates(tour) == pytest.approx(view.node_coordinates(tour))
+    assert short_network.model_view() is short_network
@@ -0,0 +1,175 @@
+import itertools
+import math
+import random
+
+import networkx as nx
+import pytest
+
+from benchmarks.fixtures import FixtureNetwork, grid_graph
+from running_routes.contraction import ContractionHierarchy
+from running_routes.graph_cache import GraphCache
+from running_routes.mapped_graph import open_mapped_graph, write_mapped_graph
+from running_routes.model import CPModel, SavingsModel
+from running_routes.network import MappedNetwork, OSMNetwork
+
+
+@pytest.fixture
+def graph():
+    """A grid with uneven edge lengths and a few one-way streets"""
+    generator = random.Random(1234)
+    G = grid_graph(6, 6)
+    for _, _, data in G.edges(data=True):
+        data["length"] *= generator.uniform(0.8, 1.5)
+    for u, v in generator.sample(sorted(G.edges()), 10):
+        if G.out_degree(u) > 1 and G.has_edge(v, u):
+            G.remove_edge(u, v)
+    return G
+
+
+@pytest.fixture
+def hierarchy(graph):
+    return ContractionHierarchy.build(graph)
+
+
+class TestContractionHierarchy:
+    def test_distance(self, graph, hierarchy):
+        for source, target in itertools.product(graph.nodes, repeat=2):
+            try:
+                expected = nx.dijkstra_path_length(graph, source, target, weight="length")
+            except nx.NetworkXNoPath:
+                expected = math.inf
+            assert hierarchy.distance(source, target) == pytest.approx(expected)
+
+    def test_path(self, graph, hierarchy):
+        for source, target in itertools.product(graph.nodes, repeat=2):
+            path = hierarchy.path(source, target)
+            assert path[0] == source and path[-1] == target
+            # Shortcuts are unpacked into edges of the original graph
+            path_length = sum(
+                min(data["length"] for data in graph[u][v].values()) for u, v in zip(path, path[1:]))
+            assert path_length == pytest.approx(hierarchy.distance(source, target))
+
+        with pytest.raises(nx.NodeNotFound):
+            hierarchy.path("invalid", 0)
+
+    def test_many_to_many(self, graph, hierarchy):
+        sources, targets = [0, 7, 35], [35, 14, 0, 21]
+        lengths = hierarchy.many_to_many(sources, targets)
+        for i, source in enumerate(sources):
+            for j, target in enumerate(targets):
+                assert lengths[i][j] == pytest.approx(hierarchy.distance(source, target))
+
+    def test_save(self, tmp_path, graph, hierarchy):
+        hierarchy.save(tmp_path / "hierarchy.pickle")
+        loaded_hierarchy = ContractionHierarchy.load(tmp_path / "hierarchy.pickle")
+        assert loaded_hierarchy.distance(0, 35) == hierarchy.distance(0, 35)
+        assert loaded_hierarchy.path(0, 35) == hierarchy.path(0, 35)
+
+
+class TestOSMNetworkContractionHierarchy:
+    def test_create(self, tmp_path, graph):
+        start_coordinate = {"lat": -37.8102361 + 0.0025, "lng": 144.9627652 + 0.0025}
+        graph_cache = GraphCache(tmp_path)
+        network = FixtureNetwork(graph, graph_cache=graph_cache, contraction_hierarchy=True)
+        network.create(start_coordinate, 2000)
+        # Requests never build a hierarchy, they answer with Dijkstra until the region is preprocessed
+        assert network.hierarchy is None
+        assert network.statistics["hierarchy_missing_total"] == 1
+
+        hierarchy = network.preprocess()
+        assert hierarchy.fingerprint == network.region_key
+        assert graph_cache.sidecar(network.region_key, OSMNetwork.HIERARCHY_FILE).exists()
+
+        # Later requests in the region load the stored hierarchy
+        other_network = FixtureNetwork(graph, graph_cache=graph_cache, contraction_hierarchy=True)
+        other_network.create(start_coordinate, 1000)
+        assert other_network.region_key == network.region_key
+        assert other_network.hierarchy.fingerprint == hierarchy.fingerprint
+        assert other_network.preprocess() is other_network.hierarchy
+        # and share one copy per process
+        third_network = FixtureNetwork(graph, graph_cache=graph_cache, contraction_hierarchy=True)
+        third_network.create(start_coordinate, 1000)
+        assert third_network.hierarchy is other_network.hierarchy
+
+        reference_network = OSMNetwork()
+        reference_network.graph = network.graph
+        for row, reference_row in zip(
+                other_network.lengths([0, 35], [35, 0]), reference_network.lengths([0, 35], [35, 0])):
+            assert row == pytest.approx(reference_row)
+        assert other_network.statistics["dijkstra_runs_total"] == 0
+        assert other_network.statistics["hierarchy_queries_total"] == 1
+
+    @pytest.mark.parametrize("model", [SavingsModel(), CPModel(time_limit=1)])
+    def test_model(self, tmp_path, model):
+        G = grid_graph(20, 20)
+        start_coordinate = {"lat": G.nodes[210]["y"], "lng": G.nodes[210]["x"]}
+        graph_cache = GraphCache(tmp_path)
+        FixtureNetwork(G, graph_cache=graph_cache, contraction_hierarchy=True).create(start_coordinate, 5000)
+        OSMNetwork.build_region_hierarchy(graph_cache, graph_cache.find(start_coordinate, 2500, "walk"))
+
+        network = FixtureNetwork(G, graph_cache=graph_cache, contraction_hierarchy=True)
+        network.create(start_coordinate, 5000)
+        tours = model.solve(3, 5000, start_coordinate, network)
+        assert tours
+        # Point-to-point lengths and paths come from the hierarchy too
+        assert network.statistics["dijkstra_runs_total"] == 0
+        assert network.statistics["hierarchy_queries_total"] > 1
+
+        reference_network = OSMNetwork()
+        reference_network.graph = network.graph
+        for tour in tours:
+            assert tour.leg_lengths == pytest.approx(
+                [reference_network.length(source, target) for source, target in zip(tour, tour[1:])])
+
+    def test_outside_graph(self, tmp_path, graph):
+        start_coordinate = {"lat": -37.8102361 + 0.0025, "lng": 144.9627652 + 0.0025}
+        graph_cache = GraphCache(tmp_path)
+        network = FixtureNetwork(graph, graph_cache=graph_cache, contraction_hierarchy=True)
+        network.create(start_coordinate, 2000)
+        network.preprocess()
+
+        # The region's shortest paths can leave a smaller request's graph, which is searched instead
+        network = FixtureNetwork(graph, graph_cache=graph_cache, contraction_hierarchy=True)
+        network.create(start_coordinate, 500)
+        reference_network = OSMNetwork()
+        reference_network.graph = network.graph
+        for source, target in itertools.product(network.graph.nodes, repeat=2):
+            assert network.length(source, target) == pytest.approx(reference_network.length(source, target))
+            path = network.path(source, target)
+            assert all(node in network.graph for node in path)
+            assert nx.path_weight(network.graph, path, "length") == pytest.approx(reference_network.length(source, target))
+        assert network.statistics["hierarchy_outside_total"] > 0
+
+        with pytest.raises(nx.NodeNotFound):
+            network.length(source, "invalid")
+
+    def test_graph_cache_required(self):
+        with pytest.raises(ValueError):
+            OSMNetwork(contraction_hierarchy=True)
+
+
+class TestMappedNetworkContractionHierarchy:
+    def test_preprocess(self, tmp_path, graph):
+        directory = write_mapped_graph(graph, tmp_path / "region")
+        start_coordinate = {"lat": -37.8102361 + 0.0025, "lng": 144.9627652 + 0.0025}
+        network = MappedNetwork(directory, contraction_hierarchy=True)
+        assert network.hierarchy is None
+        network.preprocess()
+
+        other_network = MappedNetwork(directory, contraction_hierarchy=True)
+        assert other_network.hierarchy is not None
+        other_network.create(start_coordinate, 2000)
+        reference_network = MappedNetwork(directory)
+        reference_network.create(start_coordinate, 2000)
+        nodes = other_network.node_ids[:5].tolist()
+        for row, reference_row in zip(other_network.lengths(nodes, nodes), reference_network.lengths(nodes, nodes)):
+            assert row == pytest.approx(reference_row)
+        for source, target in itertools.product(nodes, repeat=2):
+            assert other_network.length(source, target) == pytest.approx(reference_network.length(source, target))
+            assert other_network.path(source, target) == reference_network.path(source, target)
+        assert other_network.statistics["dijkstra_runs_total"] == 0
+
+        # Writing the region again invalidates its hierarchy
+        write_mapped_graph(graph, directory)
+        open_mapped_graph.cache_clear()
+        assert MappedNetwork(directory, contraction_hierarchy=True).hierarchy is None
@@ -0,0 +1,19 @@
+import numpy as np
+import osmnx
+import pytest
+
+from running_routes.geometry import degree_deltas, great_circle, great_circle_vec
+
+
+def test_great_circle():
+    lat, lng = np.array([-37.81, -37.8, 51.5]), np.array([144.96, 144.97, -0.12])
+    expected = osmnx.distance.great_circle_vec(-37.8102361, 144.9627652, lat, lng)
+    assert great_circle_vec(-37.8102361, 144.9627652, lat, lng) == pytest.approx(expected)
+    assert [great_circle(-37.8102361, 144.9627652, *point) for point in zip(lat, lng)] == pytest.approx(expected)
+
+
+def test_degree_deltas():
+    lat_delta, lng_delta = degree_deltas(60, 1000)
+    assert great_circle(60, 10, 60 + lat_delta, 10) == pytest.approx(1000)
+    # A degree of longitude is half as long at 60 degrees
+    assert lng_delta == pytest.approx(2*lat_delta)
@@ -0,0 +1,119 @@
+import json
+import multiprocessing
+import time
+
+import pytest
+
+from benchmarks import overpass
+from benchmarks.fixtures import grid_graph
+from running_routes.graph_cache import GraphCache
+from running_routes.network import OSMNetwork
+
+# Centre of the 20x20 grid served by the stand-in
+CENTER = {"lat": -37.8102361 + 0.0095, "lng": 144.9627652 + 0.0095}
+OFFSET_CENTER = {"lat": CENTER["lat"] + 0.002, "lng": CENTER["lng"]}
+
+
+@pytest.fixture
+def overpass_stand_in():
+    with overpass.serve(grid_graph(20, 20)) as stand_in:
+        yield stand_in
+
+
+class TestGraphCache:
+    def test_containment(self, tmp_path):
+        cache = GraphCache(tmp_path)
+        G = grid_graph()
+        cache.put(CENTER, 1000, "walk", G)
+
+        # Requests inside the cached circle are hits
+        assert sorted(cache.get(CENTER, 1000, "walk").nodes) == sorted(G.nodes)
+        assert cache.get(OFFSET_CENTER, 500, "walk") is not None
+
+        # Requests leaving the circle, or of another network type, are misses
+        assert cache.get(OFFSET_CENTER, 900, "walk") is None
+        assert cache.get(CENTER, 500, "drive") is None
+
+    def test_smallest_entry(self, tmp_path):
+        cache = GraphCache(tmp_path)
+        cache.put(CENTER, 1000, "walk", grid_graph(10, 10))
+        cache.put(CENTER, 500, "walk", grid_graph(5, 5))
+        assert len(cache.get(CENTER, 400, "walk")) == 25
+        assert len(cache.get(CENTER, 600, "walk")) == 100
+
+    def test_ttl(self, tmp_path, monkeypatch):
+        cache = GraphCache(tmp_path, ttl=60)
+        key = cache.put(CENTER, 1000, "walk", grid_graph())
+        cache.sidecar(key, "hierarchy.pickle").write_bytes(b"")
+        now = time.time()
+        monkeypatch.setattr("running_routes.graph_cache.time.time", lambda: now + 61)
+        assert cache.get(CENTER, 1000, "walk") is None
+        assert cache.entries() == []
+
+        # Removed by the next write
+        key = cache.put(OFFSET_CENTER, 500, "walk", grid_graph())
+        assert sorted(path.name for path in tmp_path.iterdir()) == sorted(["index.json", "index.lock", f"{key}.pickle"])
+
+    def test_eviction(self, tmp_path):
+        cache = GraphCache(tmp_path)
+        cache.put(CENTER, 1000, "walk", grid_graph())
+        entry_bytes = cache.entries()[0]["bytes"]
+
+        # The least recently used entry is evicted first
+        cache = GraphCache(tmp_path, max_bytes=2*entry_bytes)
+        cache.put(OFFSET_CENTER, 1000, "walk", grid_graph())
+        cache.get(CENTER, 1000, "walk")
+        cache.put(CENTER, 2000, "walk", grid_graph())
+        assert sorted(entry["radius"] for entry in cache.entries()) == [1000, 2000]
+        assert cache.get(OFFSET_CENTER, 1000, "walk") is not None
+        assert all(entry["lat"] == CENTER["lat"] for entry in cache.entries())
+
+    def test_read_only_hits(self, tmp_path):
+        cache = GraphCache(tmp_path, flush_interval=60)
+        key = cache.put(CENTER, 1000, "walk", grid_graph())
+        index = (tmp_path / "index.json").read_bytes()
+        assert cache.find(CENTER, 1000, "walk") == key
+        assert cache.find(CENTER, 2000, "walk") is None
+        assert (tmp_path / "index.json").read_bytes() == index
+
+        # The last use is written with the next write
+        cache.put(OFFSET_CENTER, 1000, "walk", grid_graph())
+        entry = next(entry for entry in cache.entries() if entry["lat"] == CENTER["lat"])
+        assert entry["last_used"] > json.loads(index)[key]["last_used"]
+
+    def test_processes(self, tmp_path):
+        # Concurrent writers keep every entry
+        with multiprocessing.get_context("fork").Pool(4) as pool:
+            keys = pool.starmap(_put, [(tmp_path, offset) for offset in range(8)])
+        assert sorted(keys) == sorted(entry["file"].split(".")[0] for entry in GraphCache(tmp_path).entries())
+
+        # Files the index lost are removed by the next write
+        (tmp_path / "orphan.pickle").write_bytes(b"")
+        (tmp_path / "orphan.hierarchy.pickle").write_bytes(b"")
+        GraphCache(tmp_path).put(CENTER, 1000, "walk", grid_graph())
+        assert not (tmp_path / "orphan.pickle").exists() and not (tmp_path / "orphan.hierarchy.pickle").exists()
+        assert len(list(tmp_path.glob("*.pickle"))) == 9
+
+
+def _put(directory, offset):
+    return GraphCache(directory).put(dict(CENTER, lat=CENTER["lat"] + offset/1000), 1000, "walk", grid_graph())
+
+
+class TestOSMNetworkGraphCache:
+    def test_create(self, tmp_path, overpass_stand_in):
+        network = OSMNetwork(graph_cache=GraphCache(tmp_path))
+        network.create(CENTER, 1000)
+        assert len(overpass_stand_in.queries) == 1
+        assert network.statistics["graph_cache_hits_total"] == 0
+
+        # A smaller circle inside the first download is sliced from the cache
+        uncached_network = OSMNetwork()
+        uncached_network.create(OFFSET_CENTER, 400)
+        network.create(OFFSET_CENTER, 400)
+        assert len(overpass_stand_in.queries) == 2
+        assert network.statistics["graph_cache_hits_total"] == 1
+        assert sorted(network.graph.nodes) == sorted(uncached_network.graph.nodes)
+
+        # A larger circle downloads again
+        network.create(CENTER, 1200)
+        assert len(overpass_stand_in.queries) == 3
@@ -0,0 +1,69 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import os
+import threading
+
+import pytest
+
+from benchmarks.load_test import MemorySampler, grid_center, load_mix, replay, summarize, synthetic_mix
+
+
+@pytest.fixture
+def app_url():
+    """Answers /pipeline/ with 500 for n=0, and 200 otherwise"""
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(500 if "n=0" in self.path else 200)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def test_synthetic_mix():
+    mix = synthetic_mix(50, rows=60, seed=1)
+    center = grid_center(60)
+    assert len(mix) == 50
+    assert mix == synthetic_mix(50, rows=60, seed=1)
+    # Runs of 3000m fit inside the 60 x 60 grid, about 5.3km wide
+    assert all(abs(request["lng"] - center["lng"]) < 0.03 - request["distance"]/2/88_000 for request in mix)
+
+
+def test_load_mix(tmp_path):
+    path = tmp_path / "mix.txt"
+    path.write_text('{"n": 1, "lat": -37.8, "lng": 144.9, "distance": 1000}\n\n/pipeline/?n=2&lat=-37.81&lng=144.96&distance=2000\n')
+    assert load_mix(path) == [
+        {"n": 1, "lat": -37.8, "lng": 144.9, "distance": 1000},
+        {"n": "2", "lat": "-37.81", "lng": "144.96", "distance": "2000"},
+    ]
+
+
+def test_replay(app_url):
+    mix = [{"n": 1}, {"n": 0}, {"n": 2}, {"n": 3}]
+    results = replay(app_url, mix, concurrency=3, total_requests=20)
+    summary = summarize(results, seconds=2)
+
+    assert summary["requests"] == 20
+    assert summary["throughput"] == 10
+    assert summary["error_rate"] == 0.25
+    latency = summary["latency_seconds"]
+    assert latency["p50"] <= latency["p90"] <= latency["p99"] <= latency["max"]
+    assert len(replay(app_url, mix, concurrency=2, duration=0.2)) > 0
+
+
+@pytest.mark.skipif(not os.path.exists("/proc/self/statm"), reason="Reads memory from /proc")
+def test_memory_sampler():
+    with MemorySampler(os.getpid(), interval=0.01) as sampler:
+        pass
+    # Without child processes the process itself is the worker
+    (samples,) = sampler.samples.values()
+    summary = summarize([], 1, sampler.samples)
+    worker = summary["workers"][os.getpid()]
+    assert worker["start_bytes"] == samples[0][1]
+    assert worker["growth_bytes"] == samples[-1][1] - samples[0][1]
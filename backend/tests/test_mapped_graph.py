@@ -0,0 +1,120 @@
+import itertools
+import pickle
+import random
+
+import networkx as nx
+import numpy as np
+import pytest
+
+from benchmarks.fixtures import FixtureNetwork, grid_graph
+from running_routes.mapped_graph import MappedGraph, open_mapped_graph, write_mapped_graph
+from running_routes.model import SavingsModel
+from running_routes.network import ArrayNetwork, MappedNetwork
+
+
+@pytest.fixture
+def graph():
+    """A grid with uneven edge lengths, one-way streets and a parallel edge"""
+    generator = random.Random(1234)
+    G = grid_graph(12, 12)
+    for _, _, data in G.edges(data=True):
+        data["length"] *= generator.uniform(0.8, 1.5)
+    for u, v in generator.sample(sorted(G.edges()), 20):
+        if G.out_degree(u) > 1 and G.has_edge(v, u):
+            G.remove_edge(u, v)
+    G.add_edge(0, 1, length=1)
+    return G
+
+
+@pytest.fixture
+def directory(tmp_path, graph):
+    return write_mapped_graph(graph, tmp_path / "region")
+
+
+@pytest.fixture
+def start_coordinate(graph):
+    return {"lat": graph.nodes[66]["y"], "lng": graph.nodes[66]["x"]}
+
+
+class TestMappedGraph:
+    def test_mapped(self, directory, graph):
+        mapped_graph = MappedGraph(directory)
+        assert len(mapped_graph) == graph.number_of_nodes()
+        # Arrays are mapped, not read into memory
+        assert isinstance(mapped_graph.indptr, np.memmap)
+        assert not mapped_graph.lengths.flags.writeable
+
+        # Opened once per process
+        assert open_mapped_graph(str(directory)) is open_mapped_graph(str(directory))
+
+    def test_within(self, directory, graph, start_coordinate):
+        mapped_graph = MappedGraph(directory)
+        positions = mapped_graph.within(start_coordinate["lat"], start_coordinate["lng"], 250)
+        network = FixtureNetwork(graph)
+        expected = network._truncate(graph.copy(), start_coordinate, 250)
+        # Truncation also drops disconnected nodes, the grid has none
+        assert mapped_graph.node_ids[positions].tolist() == sorted(expected.nodes)
+
+        with pytest.raises(KeyError):
+            mapped_graph.positions([0, 1000])
+
+
+class TestMappedNetwork:
+    def test_create(self, directory, graph, start_coordinate):
+        network = MappedNetwork(directory)
+        with pytest.raises(Exception):
+            network.length(0, 1)
+        with pytest.raises(ValueError):
+            network.create({"lat": 0, "lng": 0}, 1000)
+
+        network.create(start_coordinate, 500)
+        reference_network = FixtureNetwork(graph)
+        reference_network.create(start_coordinate, 500)
+        assert network.nodes == {node: {"y": data["y"], "x": data["x"]} for node, data in reference_network.nodes.items()}
+        assert network.statistics["nodes"] == len(reference_network.nodes)
+
+        nodes = sorted(reference_network.nodes)
+        for source, target in itertools.product(nodes[::5], nodes[::3]):
+            assert network.length(source, target) == pytest.approx(reference_network.length(source, target))
+            assert network.path(source, target) == reference_network.path(source, target)
+        for row, reference_row in zip(network.lengths(nodes[:4], nodes), reference_network.lengths(nodes[:4], nodes)):
+            assert row == pytest.approx(reference_row)
+
+        with pytest.raises(nx.NodeNotFound):
+            network.length("invalid", nodes[0])
+        with pytest.raises(nx.NodeNotFound):
+            network.path(nodes[0], 0)
+
+    def test_model(self, directory, graph, start_coordinate):
+        network = MappedNetwork(directory)
+        network.create(start_coordinate, 1000)
+        assert network.nearest_nodes([start_coordinate]) == [66]
+        reference_network = FixtureNetwork(graph)
+        reference_network.create(start_coordinate, 1000)
+        locations = [dict(start_coordinate, lat=start_coordinate["lat"] + offset, lng=start_coordinate["lng"] - offset)
+                     for offset in (0.0004, 0.0011, 0.0023)]
+        assert network.nearest_nodes(locations) == reference_network.nearest_nodes(locations)
+        np.testing.assert_array_equal(network.node_coordinates([66]), [[start_coordinate["lat"], start_coordinate["lng"]]])
+
+        tours = SavingsModel().solve(1, 1000, start_coordinate, network)
+        assert tours and all(tour[0] == tour[-1] == 66 for tour in tours)
+
+
+class TestArrayNetwork:
+    def test_from_network(self, directory, graph, start_coordinate):
+        reference_network = FixtureNetwork(graph)
+        reference_network.create(start_coordinate, 500)
+        mapped_network = MappedNetwork(directory)
+        mapped_network.create(start_coordinate, 500)
+        nodes = sorted(reference_network.nodes)
+
+        for network in (reference_network, mapped_network):
+            array_network = pickle.loads(pickle.dumps(ArrayNetwork.from_network(network)))
+            np.testing.assert_array_equal(array_network.node_ids, network.node_ids)
+            np.testing.assert_array_equal(array_network.node_index(nodes), network.node_index(nodes))
+            for source, target in itertools.product(nodes[::5], nodes[::3]):
+                assert array_network.length(source, target) == pytest.approx(reference_network.length(source, target))
+                assert array_network.path(source, target) == reference_network.path(source, target)
+            assert array_network.statistics["dijkstra_runs_total"] == len(nodes[::5])
+            with pytest.raises(nx.NodeNotFound):
+                array_network.node_index([-1])
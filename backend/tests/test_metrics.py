@@ -0,0 +1,78 @@
+from running_routes.metrics import Histogram, PipelineMetrics, Registry
+
+
+def test_histogram_render():
+    histogram = Histogram("latency_seconds", "Latency", ("stage",), buckets=(0.1, 1))
+    histogram.observe(0.05, "model")
+    histogram.observe(0.5, "model")
+    assert histogram.render() == [
+        "# HELP latency_seconds Latency",
+        "# TYPE latency_seconds histogram",
+        'latency_seconds_bucket{stage="model",le="0.1"} 1',
+        'latency_seconds_bucket{stage="model",le="1"} 2',
+        'latency_seconds_bucket{stage="model",le="+Inf"} 2',
+        'latency_seconds_sum{stage="model"} 0.55',
+        'latency_seconds_count{stage="model"} 2',
+    ]
+
+
+def test_record_statistics():
+    metrics = PipelineMetrics()
+    with metrics.stage("network"):
+        pass
+    metrics.record_statistics("network", {
+        "download_seconds": 0.5, "dijkstra_runs_total": 3, "cache_hits_total": 10, "nodes": 25})
+
+    assert metrics.stage_seconds["network.download"] == 0.5
+    assert metrics.counters == {"network.dijkstra_runs": 3, "network.cache_hits": 10}
+    assert metrics.gauges == {"network.nodes": 25}
+    # Sub-stages are not counted twice
+    assert metrics.total_seconds == metrics.stage_seconds["network"]
+
+
+def test_registry_observe():
+    metrics = PipelineMetrics()
+    with metrics.stage("model"):
+        pass
+    metrics.record_statistics("model", {"solver_branches_total": 7})
+
+    registry = Registry()
+    registry.observe(metrics)
+    registry.observe(metrics, status="error")
+    rendered = registry.render()
+    assert 'running_routes_requests_total{status="ok"} 1' in rendered
+    assert 'running_routes_requests_total{status="error"} 1' in rendered
+    assert 'running_routes_stage_seconds_count{stage="model"} 2' in rendered
+    assert 'running_routes_events_total{event="model.solver_branches"} 14' in rendered
+
+
+def test_registry_missing_gauges():
+    registry = Registry()
+    metrics = PipelineMetrics()
+    metrics.record_statistics("model", {"objective": 1200, "sample_size": 40})
+    registry.observe(metrics)
+    assert 'running_routes_last_request{gauge="model.objective"} 1200' in registry.render()
+
+    # A model without a solution has no objective, which is not a valid sample
+    metrics = PipelineMetrics()
+    metrics.record_statistics("model", {"objective": None, "sample_size": 40})
+    registry.observe(metrics)
+    rendered = registry.render()
+    assert "model.objective" not in rendered and "None" not in rendered
+    assert 'running_routes_last_request{gauge="model.sample_size"} 40' in rendered
+
+
+def test_registry_flights():
+    registry = Registry()
+    registry.observe_flight(3)
+    rendered = registry.render({"n=1,lat=-37.81,lng=144.96,distance=500": 2, "n=1,lat=-37.82,lng=144.96,distance=500": 1})
+    assert 'running_routes_requests_total{status="coalesced"} 2' in rendered
+    assert 'running_routes_flight_callers_count 1' in rendered
+    # Totals, without a series per request key
+    assert 'running_routes_in_flight 2' in rendered
+    assert 'running_routes_in_flight_waiters 3' in rendered
+    assert "lat=" not in rendered
+
+    # Finished computations are dropped
+    rendered = registry.render({})
+    assert 'running_routes_in_flight 0' in rendered and 'running_routes_in_flight_waiters 0' in rendered
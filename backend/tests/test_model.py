@@ -1,7 +1,9 @@
+import math
 import pytest
 
 from running_routes.network import OSMNetwork
-from running_routes.model import CPModel, SavingsModel
+from running_routes.deadline import Deadline
+from running_routes.model import CPModel, SavingsModel, CP_DEFAULT_PARAMETERS, adaptive_sample_size, circularity
 
 @pytest.fixture
 def n():
@@ -207,4 +209,35 @@ class TestSavingsModel:
             [6806666961, 7913378977, 6167279410, 7913378977, 6167279411, 7913378977, 6806666961]
             ]
         output_routes = [[6806666961, 7913378977, 6167279410, 7913378977, 6167279411, 7913378977, 6806666961]]
-        assert output_routes == savings_model._circularity_filter(n, input_routes, network)
\ No newline at end of file
+        assert output_routes == savings_model._circularity_filter(n, input_routes, network)
+
+def test_circularity(grid_network):
+    # A square is more circular than a thin rectangle, and a line has no area
+    square = grid_network.node_coordinates([0, 4, 24, 20, 0])
+    rectangle = grid_network.node_coordinates([0, 4, 9, 5, 0])
+    line = grid_network.node_coordinates([0, 4, 0])
+    # The grid cells are not square in meters, so the grid is slightly less circular than pi/4
+    assert 0.7 < circularity(square) < math.pi/4
+    assert circularity(rectangle) < circularity(square)
+    assert circularity(line) == 0
+
+
+def test_adaptive_sample_size():
+    parameters = CP_DEFAULT_PARAMETERS
+    # Without a deadline the usual percent and maximum apply
+    assert adaptive_sample_size(200, parameters) == 40
+    assert adaptive_sample_size(10000, parameters) == 100
+
+    # Spare time grows the sample within the adaptive limits
+    deadline = Deadline(60)
+    assert adaptive_sample_size(200, parameters, deadline) == 100
+    assert adaptive_sample_size(3000, parameters, deadline) == 200
+    assert deadline.degradations == []
+
+    # A tight deadline on a large graph shrinks it, and reports the degradation
+    deadline = Deadline(0.5)
+    sample_size = adaptive_sample_size(100000, parameters, deadline)
+    assert 10 <= sample_size < 100
+    assert deadline.degradations == [
+        {"stage": "model", "parameter": "sample_size", "requested": 100, "used": sample_size}]
+    assert adaptive_sample_size(100000, parameters, Deadline(0)) == 10
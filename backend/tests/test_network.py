@@ -1,7 +1,9 @@
 import networkx as nx
+import osmnx
 import pytest
 
-from running_routes.network import OSMNetwork
+from benchmarks.fixtures import FixtureNetwork, grid_graph
+from running_routes.network import OSMNetwork, compact_graph, graph_memory_bytes
 
 @pytest.fixture
 def start_coordinate():
@@ -83,3 +85,85 @@ class TestOSMNetwork:
         network = OSMNetwork()
         network.create(start_coordinate, distance)
         assert network.nearest_nodes([start_coordinate]) == [6806666961]
+
+    def test_node_store(self, grid_network):
+        # Coordinates are ordered by node position
+        assert grid_network.coordinates.shape == (25, 2)
+        assert list(grid_network.node_ids) == list(grid_network.graph.nodes)
+        for node, (lat, lng) in zip(grid_network.node_ids, grid_network.coordinates):
+            assert grid_network.graph.nodes[node]["y"] == lat
+            assert grid_network.graph.nodes[node]["x"] == lng
+
+        # Vectorised lookups by node id
+        coordinates = grid_network.node_coordinates([24, 0, 24])
+        assert coordinates.tolist() == [
+            [grid_network.graph.nodes[node]["y"], grid_network.graph.nodes[node]["x"]]
+            for node in [24, 0, 24]]
+        with pytest.raises(nx.NodeNotFound):
+            grid_network.node_coordinates(["invalid"])
+
+        # Replacing the graph invalidates the store
+        grid_network.graph = grid_network.graph.subgraph([0, 1, 5]).copy()
+        assert grid_network.coordinates.shape == (3, 2)
+        with pytest.raises(nx.NodeNotFound):
+            grid_network.node_coordinates([24])
+
+    def test_spatial_index(self, grid_network):
+        locations = [{"lat": lat + 0.0004, "lng": lng - 0.0003} for lat, lng in grid_network.coordinates]
+        assert grid_network.nearest_nodes(locations) == osmnx.distance.nearest_nodes(
+            grid_network.graph, [location["lng"] for location in locations], [location["lat"] for location in locations])
+
+    def test_compact(self):
+        G = nx.relabel_nodes(grid_graph(), {node: 9_000_000_000 - node for node in range(25)})
+        for u, v, data in G.edges(data=True):
+            data.update(osmid=[u, v], name="Swanston Street", highway="footway")
+        G.add_edge(9_000_000_000, 8_999_999_999, length=1, name="Shortcut")
+
+        compact, osm_ids = compact_graph(G)
+        # Labels follow the OSM id order, and only the attributes the pipeline reads remain
+        assert list(compact.nodes) == list(range(25))
+        assert osm_ids.tolist() == sorted(G.nodes)
+        assert all(data.keys() == {"x", "y"} for _, data in compact.nodes(data=True))
+        assert all(data.keys() == {"length"} for *_, data in compact.edges(data=True))
+        # Parallel edges collapse to the shortest
+        assert compact[24][23]["length"] == 1
+        assert compact.number_of_edges() == G.number_of_edges() - 1
+        assert graph_memory_bytes(compact) < graph_memory_bytes(G)
+
+        start_coordinate = {"lat": G.nodes[8_999_999_988]["y"], "lng": G.nodes[8_999_999_988]["x"]}
+        network = FixtureNetwork(G, compact=True)
+        network.create(start_coordinate, 800)
+        reference_network = FixtureNetwork(G)
+        reference_network.create(start_coordinate, 800)
+        assert network.statistics["graph_bytes"] < network.statistics["graph_bytes_before"]
+        path = network.path(0, 24)
+        assert network.osm_node_ids(path).tolist() == reference_network.path(osm_ids[0], osm_ids[24])
+        assert network.length(0, 24) == pytest.approx(reference_network.length(osm_ids[0], osm_ids[24]))
+
+    def test__isochrone(self):
+        # A river between columns 2 and 3 is only crossed in the north east corner
+        G = grid_graph(5, 5)
+        for row in range(4):
+            G.remove_edges_from([(row*5 + 2, row*5 + 3), (row*5 + 3, row*5 + 2)])
+        start_coordinate = {"lat": G.nodes[0]["y"], "lng": G.nodes[0]["x"]}
+        network = OSMNetwork()
+        edge_length = G[0][1][0]["length"]
+        G = network._isochrone(G, start_coordinate, 2.01*(edge_length*2 + G[0][5][0]["length"]*2))
+        assert 12 in G.nodes
+        assert 3 not in G.nodes and 13 not in G.nodes
+
+        # Nodes reachable only by one-way streets count the walk back
+        G = grid_graph(3, 3)
+        assert 1 in network._isochrone(G.copy(), start_coordinate, 2.5*edge_length)
+        G.remove_edge(1, 0)
+        assert 1 not in network._isochrone(G, start_coordinate, 2.5*edge_length)
+
+        network = FixtureNetwork(grid_graph(10, 10), isochrone=True)
+        network.create({"lat": G.nodes[0]["y"], "lng": G.nodes[0]["x"]}, 500)
+        assert network.statistics["isochrone_removed_nodes"] > 0
+
+    def test__truncate(self):
+        # Only the 2x2 block of nodes within 150m of the corner remains
+        network = OSMNetwork()
+        G = network._truncate(grid_graph(), {"lat": -37.8102361, "lng": 144.9627652}, 150)
+        assert sorted(G.nodes) == [0, 1, 5, 6]
@@ -0,0 +1,118 @@
+import numpy as np
+import pytest
+
+from benchmarks.fixtures import FixtureNetwork, grid_graph
+from running_routes.graph_cache import GraphCache
+from running_routes.mapped_graph import write_mapped_graph
+from running_routes.network import MappedNetwork, OSMNetwork
+from running_routes.path_store import ShortestPathStore, region_row, slice_row
+
+
+def row(value):
+    return region_row([10, 11, 12], np.full(3, value), [-1, 0, 1])
+
+
+class TestShortestPathStore:
+    def test_min_uses(self, tmp_path):
+        store = ShortestPathStore(tmp_path / "paths.sqlite", min_uses=2)
+        assert store.frequent("region", [1]) == []
+        # Counted again, e.g. by a later request
+        assert store.frequent("region", [1, 2]) == [1]
+
+        assert store.save("region", {1: row(1.5)}, cutoff=1000) == 1
+        targets, lengths, predecessors = store.load("region", [1, 2], cutoff=1000)[1]
+        assert targets.tolist() == [10, 11, 12] and lengths.tolist() == [1.5]*3 and predecessors.tolist() == [-1, 0, 1]
+        assert store.load("other region", [1], cutoff=1000) == {}
+        # Rows searched with a smaller cutoff do not answer longer runs
+        assert store.load("region", [1], cutoff=2000) == {}
+
+    def test_batched_uses(self, tmp_path):
+        store = ShortestPathStore(tmp_path / "paths.sqlite", min_uses=2, flush_interval=3600)
+        store.frequent("region", [1])
+        # Uses are written in batches, other processes see them after a flush
+        assert ShortestPathStore(tmp_path / "paths.sqlite", min_uses=2).frequent("region", [1]) == []
+        store.flush()
+        assert ShortestPathStore(tmp_path / "paths.sqlite", min_uses=2).frequent("region", [1]) == [1]
+
+    def test_version(self, tmp_path):
+        store = ShortestPathStore(tmp_path / "paths.sqlite", version="a", min_uses=1)
+        store.save("region", {1: row(1)}, cutoff=1000)
+
+        # Reopening the same version keeps the rows, a new version empties the store
+        assert len(ShortestPathStore(tmp_path / "paths.sqlite", version="a")) == 1
+        store = ShortestPathStore(tmp_path / "paths.sqlite", version="b")
+        assert len(store) == 0
+        assert store.check_version("b") is False
+
+    def test_eviction(self, tmp_path):
+        store = ShortestPathStore(tmp_path / "paths.sqlite", min_uses=1, max_rows=2)
+        for source in range(3):
+            store.save("region", {source: row(source)}, cutoff=1000)
+        # The least recently used row is evicted
+        assert sorted(store.load("region", range(3), cutoff=1000)) == [1, 2]
+
+
+def test_slice_row():
+    # A path 10 -> 11 -> 12 -> 13 and an edge 10 -> 14
+    region = region_row([10, 11, 12, 13, 14], [0, 1, 2, 3, 1], [-1, 0, 1, 2, 0])
+    lengths, predecessors = slice_row(region, np.array([10, 11, 13, 14]))
+    # 13 is reached through 12, outside the slice, so its length in the slice is unknown
+    assert lengths[[0, 1, 3]].tolist() == [0, 1, 1] and np.isnan(lengths[2])
+    assert predecessors.tolist() == [-1, 0, -1, 0]
+
+
+@pytest.fixture
+def start_coordinate():
+    G = grid_graph(10, 10)
+    return {"lat": G.nodes[55]["y"], "lng": G.nodes[55]["x"]}
+
+
+def test_osm_network(tmp_path, start_coordinate):
+    store = ShortestPathStore(tmp_path / "paths.sqlite", min_uses=1)
+    graph_cache = GraphCache(tmp_path / "graphs")
+    network = FixtureNetwork(grid_graph(10, 10), graph_cache=graph_cache, path_store=store)
+    network.create(start_coordinate, 1000)
+    reference_network = OSMNetwork()
+    reference_network.graph = network.graph.copy()
+    expected_path = network.path(55, 66)
+    assert network.statistics["path_store_writes_total"] == 1
+
+    # A later request elsewhere in the region reuses the row
+    network = FixtureNetwork(grid_graph(10, 10), graph_cache=graph_cache, path_store=store)
+    network.create(dict(start_coordinate, lat=start_coordinate["lat"] + 0.001), 600)
+    assert network.region_key is not None
+    assert network.path(55, 66) == expected_path
+    assert network.length(55, 66) == pytest.approx(reference_network.length(55, 66))
+    assert network.statistics["path_store_hits_total"] == 1
+    assert network.statistics["dijkstra_runs_total"] == 0
+
+    with pytest.raises(ValueError):
+        OSMNetwork(path_store=store)
+
+
+def test_mapped_network(tmp_path, start_coordinate):
+    directory = write_mapped_graph(grid_graph(10, 10), tmp_path / "region")
+    store = ShortestPathStore(tmp_path / "paths.sqlite", min_uses=1)
+    network = MappedNetwork(directory, path_store=store)
+    network.create(start_coordinate, 500)
+    nodes = network.node_ids[:5].tolist()
+    reference_network = MappedNetwork(directory)
+    reference_network.create(start_coordinate, 500)
+    expected_lengths = reference_network.lengths(nodes, nodes)
+    assert np.allclose(network.lengths(nodes, nodes), expected_lengths)
+    assert network.path(nodes[0], nodes[-1]) == reference_network.path(nodes[0], nodes[-1])
+    assert network.statistics["path_store_writes_total"] == 5
+
+    # Requests elsewhere in the region share the rows, and answer paths leaving the region rows from the slice
+    network = MappedNetwork(directory, path_store=store)
+    network.create(dict(start_coordinate, lng=start_coordinate["lng"] + 0.001), 500)
+    reference_network = MappedNetwork(directory)
+    reference_network.create(dict(start_coordinate, lng=start_coordinate["lng"] + 0.001), 500)
+    nodes = [node for node in nodes if node in network.node_ids]
+    assert np.allclose(network.lengths(nodes, nodes), reference_network.lengths(nodes, nodes))
+    assert network.statistics["path_store_hits_total"] == len(nodes)
+
+    # Rewriting the region invalidates the store
+    directory = write_mapped_graph(grid_graph(10, 10), tmp_path / "other region")
+    MappedNetwork(directory, path_store=store)
+    assert len(store) == 0
@@ -1,10 +1,13 @@
+import numpy as np
 import pytest
 
-from running_routes.assembler import TourAssembler
+from benchmarks.fixtures import FixtureNetwork, grid_graph
+from running_routes.assembler import RestAPIAssembler, TourAssembler
 from running_routes.local_search import BacktrackEliminationLocalSearch
-from running_routes.model import CPModel
+from running_routes.metrics import PipelineMetrics
+from running_routes.model import CPModel, SavingsModel
 from running_routes.network import OSMNetwork
-from running_routes.pipeline import pipeline
+from running_routes.pipeline import LocalSearchPool, pipeline, _local_search
 
 
 @pytest.fixture
@@ -46,3 +49,83 @@ def test_pipeline(n, start_coordinate, distance, network, model, assembler, loca
     pipeline(
         n, start_coordinate, distance,
         network=network, model=model, local_searches=local_searches, assembler=assembler)
+
+
+def test__local_search_workers(grid_network, local_searches):
+    # Tours walk down a street and back again, which the local search removes
+    tours = [[0, 12, 24, 12, 0], [0, 4, 24, 4, 0], [0, 20, 24, 0]]
+    serial_tours = _local_search(tours, 5000, grid_network, local_searches, workers=1)
+    parallel_tours = _local_search(tours, 5000, grid_network, local_searches, workers=2)
+    assert serial_tours == parallel_tours
+
+    # Several local searches are chained per tour
+    chained_tours = _local_search(tours, 5000, grid_network, local_searches*2, workers=2)
+    assert chained_tours == _local_search(serial_tours, 5000, grid_network, local_searches, workers=1)
+
+    # No local searches leave the tours untouched
+    assert tours == _local_search(tours, 5000, grid_network, [], workers=2)
+
+
+def test_local_search_pool(start_coordinate, local_searches):
+    # Uneven lengths, so every shortest path is unique and the workers take the same ones
+    G = grid_graph(10, 10)
+    for index, (_, _, data) in enumerate(G.edges(data=True)):
+        data["length"] += index/1000
+    network = FixtureNetwork(G)
+    network.create(start_coordinate, 800)
+    tours = [[0, 1, 2, 1, 0], [0, 10, 20, 10, 0], [0, 11, 1, 0]]
+    serial_tours = _local_search(tours, 800, network, local_searches, workers=1)
+
+    pool = LocalSearchPool(2, local_searches)
+    try:
+        # The same processes serve every request
+        for _ in range(2):
+            searched_tours = pool.search(tours, 800, network)
+            assert searched_tours == serial_tours
+            assert np.concatenate([tour.leg_lengths for tour in searched_tours]) == pytest.approx(
+                np.concatenate([tour.leg_lengths for tour in serial_tours]))
+        routes = pipeline(
+            2, start_coordinate, 800, network=FixtureNetwork(grid_graph(10, 10)), model=SavingsModel(),
+            local_searches=local_searches, assembler=RestAPIAssembler(), pool=pool)
+        assert routes["routes"]
+    finally:
+        pool.shutdown()
+
+
+def test_pipeline_metrics(start_coordinate, local_searches):
+    network = FixtureNetwork(grid_graph(10, 10))
+    metrics = PipelineMetrics()
+    pipeline(
+        2, start_coordinate, 800,
+        network=network, model=SavingsModel(), local_searches=local_searches,
+        assembler=RestAPIAssembler(), metrics=metrics)
+
+    for stage in ["network", "network.download", "model", "model.downsample", "local_search", "assembler"]:
+        assert stage in metrics.stage_seconds
+    assert metrics.gauges["network.nodes"] == network.graph.number_of_nodes()
+    assert metrics.counters["network.dijkstra_runs"] > 0
+    assert metrics.counters["model.merge_attempts"] > 0
+
+
+def test_pipeline_deadline(start_coordinate, local_searches):
+    network = FixtureNetwork(grid_graph(10, 10))
+    metrics = PipelineMetrics()
+    routes = pipeline(
+        2, start_coordinate, 800,
+        network=network, model=CPModel(time_limit=10), local_searches=local_searches,
+        assembler=RestAPIAssembler(), metrics=metrics, deadline=1)
+
+    assert routes["routes"]
+    # The solver's time limit is cut to fit the deadline
+    assert metrics.stage_seconds["model"] < 2
+    assert {"stage": "model", "parameter": "time_limit"}.items() <= metrics.degradations[0].items()
+    assert metrics.counters["deadline.degradations"] == len(metrics.degradations)
+    assert metrics.as_dict()["degradations"] == metrics.degradations
+
+    # Once the deadline has passed, the local search is skipped
+    metrics = PipelineMetrics()
+    pipeline(
+        2, start_coordinate, 800,
+        network=FixtureNetwork(grid_graph(10, 10)), model=SavingsModel(), local_searches=local_searches,
+        assembler=RestAPIAssembler(), metrics=metrics, deadline=1e-9)
+    assert {"stage": "local_search", "parameter": "local_searches", "requested": 1, "used": 0} in metrics.degradations
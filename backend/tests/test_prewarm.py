@@ -0,0 +1,67 @@
+from benchmarks import overpass
+from benchmarks.fixtures import grid_graph
+from running_routes.assembler import TourAssembler
+from running_routes.graph_cache import GraphCache
+from running_routes.metrics import PipelineMetrics
+from running_routes.model import SavingsModel
+from running_routes.network import OSMNetwork
+from running_routes.pipeline import pipeline
+from running_routes.prewarm import Prewarmer, load_regions
+
+# Centre of the 20x20 grid served by the stand-in
+CENTER = {"lat": -37.8102361 + 0.0095, "lng": 144.9627652 + 0.0095}
+
+
+def test_warm():
+    region = dict(CENTER, distance=1500)
+    prewarmer = Prewarmer([region], OSMNetwork, SavingsModel())
+    assert not prewarmer.ready.is_set()
+    with overpass.serve(grid_graph(20, 20)) as stand_in:
+        prewarmer.warm()
+        network = prewarmer.network_for(CENTER, 1500)
+        assert prewarmer.ready.is_set()
+        assert prewarmer.status()["regions"][0]["warm"]
+        assert network.statistics["dijkstra_runs_total"] == 1
+        assert prewarmer.network_for(CENTER, 2000) is None
+
+        # Requests for the region reuse the graph, the sample and the start node's shortest paths
+        metrics = PipelineMetrics()
+        pipeline(1, CENTER, 1500, network=network, model=SavingsModel(), assembler=TourAssembler(), metrics=metrics)
+    assert len(stand_in.queries) == 1
+    assert metrics.counters["network.network_reused"] == 1
+    assert "network.download" not in metrics.stage_seconds
+
+
+def test_warm_hierarchy(tmp_path):
+    region = dict(CENTER, distance=1500)
+    model = SavingsModel()
+    prewarmer = Prewarmer(
+        [region], lambda: OSMNetwork(graph_cache=GraphCache(tmp_path), contraction_hierarchy=True), model)
+    with overpass.serve(grid_graph(20, 20)):
+        prewarmer.warm()
+    network = prewarmer.network_for(CENTER, 1500)
+    assert network.hierarchy is not None and network.statistics["hierarchy_queries_total"] > 0
+
+    # The start node's paths to the sample are answered already
+    sample_nodes = model.sample(CENTER, network)
+    statistics = dict(network.statistics)
+    for node in sample_nodes:
+        network.path(sample_nodes[0], node)
+    assert network.statistics["hierarchy_queries_total"] == statistics["hierarchy_queries_total"]
+    assert network.statistics["dijkstra_runs_total"] == statistics["dijkstra_runs_total"]
+
+
+def test_warm_failure(tmp_path):
+    path = tmp_path / "regions.json"
+    path.write_text('[{"lat": -37.8102361, "lng": 144.9627652, "distance": 1000}]')
+    regions = load_regions(path, precision=5)
+    assert regions == [{"lat": -37.81024, "lng": 144.96277, "distance": 1000}]
+
+    def build_network():
+        raise ConnectionError("Overpass is down")
+
+    prewarmer = Prewarmer(regions, build_network, SavingsModel())
+    prewarmer.start().join()
+    assert prewarmer.ready.is_set()
+    assert prewarmer.network_for({"lat": -37.81024, "lng": 144.96277}, 1000) is None
+    assert "Overpass is down" in prewarmer.status()["regions"][0]["error"]
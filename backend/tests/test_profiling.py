@@ -0,0 +1,45 @@
+import json
+
+import pytest
+
+from running_routes.profiling import RateLimiter, RequestProfiler, sanitise_request_id
+
+
+def test_rate_limiter(monkeypatch):
+    now = [0]
+    monkeypatch.setattr("running_routes.profiling.time.monotonic", lambda: now[0])
+    rate_limiter = RateLimiter(limit=2, period=60)
+    assert rate_limiter.allow()
+    assert rate_limiter.allow()
+    assert not rate_limiter.allow()
+
+    # Events older than the period no longer count
+    now[0] = 60
+    assert rate_limiter.allow()
+
+
+def test_profile(tmp_path):
+    profiler = RequestProfiler(tmp_path)
+    with profiler.profile("request-1", {"arguments": {"n": 1}}) as metadata:
+        sum(range(1000))
+        metadata["metrics"] = {"counters": {"model.solver_branches": 7}}
+
+    directory = tmp_path / "request-1"
+    assert (directory / "profile.prof").exists()
+    assert "cumulative" in (directory / "profile.txt").read_text()
+    metadata = json.loads((directory / "metadata.json").read_text())
+    assert metadata["arguments"] == {"n": 1}
+    assert metadata["metrics"]["counters"]["model.solver_branches"] == 7
+
+    # Failed requests are still written
+    with pytest.raises(ValueError):
+        with profiler.profile("request-2"):
+            raise ValueError("slow start point")
+    metadata = json.loads((tmp_path / "request-2" / "metadata.json").read_text())
+    assert "slow start point" in metadata["error"]
+
+
+def test_sanitise_request_id():
+    assert sanitise_request_id("abc-123") == "abc-123"
+    assert sanitise_request_id("../../etc/passwd") == "etcpasswd"
+    assert len(sanitise_request_id(None)) == 32
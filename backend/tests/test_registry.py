@@ -0,0 +1,36 @@
+import subprocess
+import sys
+
+import pytest
+
+from running_routes import registry
+
+
+def test_resolve():
+    from running_routes.model import CPModel
+    assert registry.resolve("model", "cp") is CPModel
+    assert registry.create("model", "cp", time_limit=2).parameters["time_limit"] == 2
+
+    with pytest.raises(ValueError):
+        registry.resolve("model", "invalid")
+    with pytest.raises(ValueError):
+        registry.resolve("invalid", "cp")
+
+
+def test_register(monkeypatch):
+    monkeypatch.setitem(registry.REGISTRY, "model", dict(registry.REGISTRY["model"]))
+    registry.register("model", "grid", "benchmarks.fixtures:grid_graph")
+    assert "grid" in registry.names("model")
+    assert len(registry.create("model", "grid", rows=2, columns=2)) == 4
+
+
+def test_lazy_imports():
+    # Importing the pipeline, the registry and the catalogue reader must not pull in the solver or osmnx
+    code = (
+        "import sys\n"
+        "import running_routes.pipeline\n"
+        "import running_routes.catalogue\n"
+        "heavy = {'ortools', 'sklearn', 'osmnx', 'shapely', 'networkx', 'scipy'}.intersection(sys.modules)\n"
+        "assert not heavy, heavy\n"
+    )
+    subprocess.run([sys.executable, "-c", code], check=True)
@@ -0,0 +1,76 @@
+import threading
+
+import pytest
+
+from running_routes.single_flight import SingleFlight
+
+
+def test_do_coalesces():
+    completed = []
+    single_flight = SingleFlight(on_complete=lambda key, callers: completed.append((key, callers)))
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return {"routes": []}
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(single_flight.do("key", compute)))
+    leader.start()
+    started.wait(5)
+    followers = [threading.Thread(target=lambda: results.append(single_flight.do("key", compute))) for _ in range(3)]
+    for follower in followers:
+        follower.start()
+    while single_flight.waiters() != {"key": 3}:
+        pass
+    release.set()
+    for thread in [leader] + followers:
+        thread.join(5)
+
+    assert len(calls) == 1
+    assert sorted(shared for _, shared in results) == [False, True, True, True]
+    # Every caller gets the same result
+    assert all(result is results[0][0] for result, _ in results)
+    assert completed == [("key", 4)]
+    assert single_flight.waiters() == {}
+
+    # Finished calls are not cached
+    single_flight.do("key", compute)
+    assert len(calls) == 2
+
+
+def test_do_shares_errors():
+    single_flight = SingleFlight()
+    started, release = threading.Event(), threading.Event()
+
+    def compute():
+        started.set()
+        release.wait(5)
+        raise ValueError("No routes")
+
+    errors = []
+
+    def call():
+        try:
+            single_flight.do("key", compute)
+        except ValueError as error:
+            errors.append(error)
+
+    threads = [threading.Thread(target=call)]
+    threads[0].start()
+    started.wait(5)
+    threads.append(threading.Thread(target=call))
+    threads[1].start()
+    while single_flight.waiters() != {"key": 1}:
+        pass
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert len(errors) == 2 and errors[0] is errors[1]
+
+    # Different keys run independently
+    assert single_flight.do("a", lambda: 1) == (1, False)
+    assert single_flight.do("b", lambda: 2) == (2, False)
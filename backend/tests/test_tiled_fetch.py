@@ -0,0 +1,48 @@
+import pytest
+
+from benchmarks import overpass
+from benchmarks.fixtures import grid_graph
+from running_routes.network import OSMNetwork
+from running_routes.tiled_fetch import TiledFetcher, circle_tiles
+
+# Centre of the 20x20 grid served by the stand-in
+CENTER = {"lat": -37.8102361 + 0.0095, "lng": 144.9627652 + 0.0095}
+
+
+def test_circle_tiles():
+    tiles = circle_tiles(CENTER, 1000, 250)
+    # The 8x8 tiles of the bounding box, without the 4 corners outside the circle
+    assert len(tiles) == 60
+    south = min(tile[0] for tile in tiles)
+    north = max(tile[2] for tile in tiles)
+    assert south < CENTER["lat"] < north
+    # A tile wider than the circle covers its whole bounding box
+    assert circle_tiles(CENTER, 1000, 5000) == [pytest.approx((
+        south, min(tile[1] for tile in tiles), north, max(tile[3] for tile in tiles)))]
+
+
+def test_fetch():
+    with overpass.serve(grid_graph(20, 20)) as stand_in:
+        untiled = OSMNetwork()
+        untiled.create(CENTER, 1000)
+        tiled = OSMNetwork(tile_size=600)
+        tiled.create(CENTER, 1000)
+
+    # One query for the untiled download, and one per tile
+    assert len(stand_in.queries) == 1 + tiled.statistics["tiles_total"]
+    assert tiled.statistics["tiles_total"] > 1
+    assert sorted(tiled.graph.nodes) == sorted(untiled.graph.nodes)
+    assert sorted(tiled.graph.edges) == sorted(untiled.graph.edges)
+
+
+def test_fetch_retries():
+    fetcher = TiledFetcher(tile_size=600, backoff=0.01)
+    with overpass.serve(grid_graph(20, 20), failures=[503, 502]) as stand_in:
+        G, statistics = fetcher.fetch(CENTER, 500, "walk")
+        # Counts belong to each download, not to the shared fetcher
+        _, next_statistics = fetcher.fetch(CENTER, 500, "walk")
+
+    assert statistics["retries_total"] == 2
+    assert next_statistics["retries_total"] == 0
+    assert len(stand_in.queries) == 2*statistics["tiles_total"] + 2
+    assert G.number_of_nodes() > 0
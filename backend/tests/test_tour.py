@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+
+from running_routes.assembler import RestAPIAssembler
+from running_routes.local_search import BacktrackEliminationLocalSearch
+from running_routes.tour import Tour, as_tours
+
+
+def test_from_nodes(grid_network):
+    tour = Tour.from_nodes([0, 12, 24, 0], grid_network)
+    assert tour.indices.dtype == np.int32
+    assert tour.indices.tolist() == grid_network.node_index([0, 12, 24, 0]).tolist()
+    assert tour.leg_lengths.tolist() == [grid_network.length(0, 12), grid_network.length(12, 24), grid_network.length(24, 0)]
+    assert tour.length == pytest.approx(sum(tour.leg_lengths))
+    assert tour.coordinates(grid_network).tolist() == grid_network.node_coordinates([0, 12, 24, 0]).tolist()
+
+    # Tours read as sequences of node ids
+    assert tour == [0, 12, 24, 0]
+    assert list(tour) == [0, 12, 24, 0]
+    assert tour[1] == 12
+    assert tour[:2] == [0, 12]
+    assert tour == Tour.from_nodes(np.array([0, 12, 24, 0]), grid_network)
+    assert tour != [0, 12, 0]
+
+    with pytest.raises(ValueError):
+        Tour(tour.indices, grid_network.node_ids, tour.leg_lengths[:1])
+
+
+def test_as_tours(grid_network):
+    tour = Tour.from_nodes([0, 1, 0], grid_network, leg_lengths=[1, 2])
+    tours = as_tours([tour, [0, 5, 0]], grid_network)
+    assert tours[0] is tour
+    assert isinstance(tours[1], Tour)
+
+
+def test_stages(grid_network):
+    # The local search returns tours, whose cached leg lengths give the route distances
+    tours = BacktrackEliminationLocalSearch().iterate([[0, 24, 0]], 5000, grid_network)
+    assert isinstance(tours[0], Tour)
+    assert tours == [[24, 0]]
+    routes = RestAPIAssembler().generate_output(tours, 5000, grid_network)
+    assert routes["routes"][0]["distance"] == tours[0].length == grid_network.length(24, 0)
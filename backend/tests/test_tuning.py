@@ -0,0 +1,40 @@
+import json
+
+from benchmarks.fixtures import load_fixture
+from benchmarks.tuning import choose, parameter_grid, pareto_front, save_model_config, start_points, sweep
+
+
+def test_parameter_grid():
+    grid = parameter_grid({"max_node": [4, 8], "sample_percent": [0.1]})
+    assert grid == [{"max_node": 4, "sample_percent": 0.1}, {"max_node": 8, "sample_percent": 0.1}]
+
+
+def test_pareto_front():
+    results = [
+        {"name": "fast", "length_error": 0.3, "circularity": 0.5, "seconds": 1},
+        {"name": "accurate", "length_error": 0.1, "circularity": 0.5, "seconds": 5},
+        {"name": "dominated", "length_error": 0.3, "circularity": 0.4, "seconds": 2},
+        {"name": "round", "length_error": 0.3, "circularity": 0.9, "seconds": 5},
+    ]
+    front = pareto_front(results)
+    assert [result["name"] for result in front] == ["fast", "accurate", "round"]
+    assert choose(front)["name"] == "accurate"
+    assert choose(front, max_seconds=2)["name"] == "fast"
+    assert choose(front, max_seconds=0.5) is None
+
+
+def test_sweep(tmp_path):
+    fixture = load_fixture("grid-small")
+    starts = start_points(fixture, 2)
+    assert starts[0] == fixture["start_coordinate"]
+    assert len(starts) == 2
+
+    results = sweep("savings", [{"max_node": 4}, {"max_node": 8}], ["grid-small"], starts=2)
+    assert [result["parameters"] for result in results] == [{"max_node": 4}, {"max_node": 8}]
+    for result in results:
+        assert len(result["runs"]) == 2
+        assert 0 <= result["length_error"] and 0 <= result["circularity"] <= 1 and result["seconds"] > 0
+
+    path = tmp_path / "model.json"
+    save_model_config(results[0], path)
+    assert json.loads(path.read_text()) == {"model": "savings", "parameters": {"max_node": 4}}